@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Coroutines that compile tbon in an executor, so that asyncio
+             servers aren't blocked while a score is parsed, evaluated
+             and encoded.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from tbon import Compiled, compile_one
+
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+def make_executor(kind='thread', workers=None):
+    """
+    Return a new executor for compiling, 'thread' or 'process'. Threads
+    keep the event loop responsive; processes also compile in parallel.
+    """
+    try:
+        executor = EXECUTORS[kind]
+    except KeyError:
+        msg = "\nUnknown executor kind, '{}'. Must be one of {}."
+        raise ValueError(msg.format(kind, ', '.join(sorted(EXECUTORS))))
+    return executor(workers)
+
+async def compile_async(source, numeric=True, parts=None, include_dir=None,
+                        ignore_velocity=False, midi=True, executor=None,
+                        timeout=None, budget=None, **options):
+    """
+    Compile source in executor, the loop's default executor if None,
+    and return a tbon.Compiled result with its warnings and any error.
+    options are passed to make_midi(). budget is a parser.Budget or
+    None. Raises asyncio.TimeoutError if the result takes longer than
+    timeout seconds. The worker can't be interrupted, so it finishes in
+    the background.
+    """
+    loop = asyncio.get_running_loop()
+    job = loop.run_in_executor(executor, partial(
+        compile_one, source, numeric, parts, include_dir,
+        ignore_velocity, midi, options, budget))
+    return await asyncio.wait_for(job, timeout)
+
+async def compile_many_async(sources, numeric=True, parts=None,
+                             include_dir=None, ignore_velocity=False,
+                             midi=True, executor=None, timeout=None,
+                             budget=None, **options):
+    """
+    Compile each of sources concurrently in executor and return the
+    tbon.Compiled results in the same order. timeout applies to each
+    source, and a source that times out has the asyncio.TimeoutError as
+    its error.
+    """
+    async def one(source):
+        try:
+            return await compile_async(source, numeric, parts, include_dir,
+                                       ignore_velocity, midi, executor,
+                                       timeout, budget, **options)
+        except asyncio.TimeoutError as e:
+            return Compiled(None, None, None, None, None, None, None, e)
+    return await asyncio.gather(*(one(source) for source in sources))
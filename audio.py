@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Renders evaluated tbon to a WAV file with simple synthesized
+             voices, for learning tracks on machines without a synthesizer.
+             Requires NumPy.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import os
+import wave
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from timing import TempoMap
+
+RATE = 44100
+
+## A voice is a sum of harmonics with amplitudes given relative to the
+## fundamental, shaped by a linear attack, an optional exponential decay
+## and a linear release after the note ends. Times are in seconds.
+Voice = namedtuple('Voice', 'harmonics attack decay release')
+
+VOICES = (
+    Voice((1.0, 0.5, 0.25, 0.12, 0.06), 0.005, 0.9, 0.08),   # piano
+    Voice((1.0, 0.0, 0.3, 0.0, 0.1), 0.002, 0.5, 0.2),       # bell
+    Voice((1.0, 0.6, 0.4, 0.3, 0.2), 0.01, None, 0.03),      # organ
+    Voice((1.0, 0.4, 0.2, 0.1), 0.003, 0.5, 0.05),           # pluck
+    Voice((1.0, 0.5, 0.33, 0.25, 0.2, 0.16), 0.06, None, 0.1),  # strings
+    Voice((1.0, 0.0, 0.33, 0.0, 0.2, 0.0, 0.14), 0.03, None, 0.06),  # wind
+    Voice((1.0, 0.3), 0.001, 0.015, 0.01),                    # click
+)
+PIANO, BELL, ORGAN, PLUCK, STRINGS, WIND, CLICK = range(len(VOICES))
+
+## General MIDI instrument families (1-based program numbers).
+FAMILIES = ((1, PIANO), (9, BELL), (17, ORGAN), (25, PLUCK), (41, STRINGS),
+            (57, WIND), (81, ORGAN), (97, STRINGS), (105, PLUCK),
+            (113, CLICK), (121, CLICK))
+FAMILY_STARTS = [f[0] for f in FAMILIES]
+
+## Velocity and channel of notes evaluated with ignore_velocity, which
+## have neither, as the evaluator's defaults.
+DEFAULT_VELOCITY, DEFAULT_CHANNEL = 0.8, 1
+
+## Percussion channel, and the click frequencies of the metronome's
+## high and low wood blocks.
+DRUMS = 10
+CLICK_FREQUENCIES = {76: 1800.0, 77: 1200.0}
+
+## Largest number of samples computed in one vectorized block.
+BLOCK_SAMPLES = 1 << 20
+
+## Samples in one period of a voice's wavetable.
+TABLE_SIZE = 8192
+
+def voice_for(program):
+    """ Return the voice index for a General MIDI program number """
+    return FAMILIES[bisect_right(FAMILY_STARTS, program) - 1][1]
+
+def note_table(tbon, metronome=0, rate=RATE, tempo_scale=1.0):
+    """
+    Return the notes to render as parallel arrays (starts, lengths,
+    frequencies, amplitudes, voices). Starts and lengths are in samples;
+    lengths include the release. metronome is 0 for music only, 1 for
+    metronome only or 2 for both, as in tbon.make_midi. Raises
+    ValueError for a pitch outside the midi range, 0 to 127. Notes at
+    or above half the sample rate can't be rendered and are dropped.
+    """
+    notes = []
+    if metronome != 1:
+        for part in tbon.output:
+            notes.extend(part)
+    if metronome != 0:
+        notes.extend(tbon.metronome_output)
+    ## Notes from ignore_velocity have 3 fields and source maps add a
+    ## span, so only notes of 5 or more fields have velocity and channel.
+    notes = [note[:5] if len(note) >= 5 else
+             tuple(note[:3]) + (DEFAULT_VELOCITY, DEFAULT_CHANNEL)
+             for note in notes if note[0] is not None]
+    if not notes:
+        return tuple(np.zeros(0) for _ in range(5))
+    pitch, start, end, velocity, chan = np.array(notes, dtype=float).T
+    chan = chan.astype(np.int64)
+    outside = (pitch < 0) | (pitch > 127)
+    if outside.any():
+        msg = "\nInvalid pitch, {:g}. Midi pitches are 0 to 127."
+        raise ValueError(msg.format(pitch[outside][0]))
+
+    ## Each channel plays the voice of its latest program change, or the
+    ## piano before the first. The drum channel always clicks.
+    voices = np.full(len(notes), PIANO, dtype=np.int64)
+    programs = {}
+    for m in sorted((m for m in tbon.meta_output if m[0] == 'I'),
+                    key=lambda m: m[1]):
+        times, progs = programs.setdefault(m[4], ([], []))
+        times.append(m[1])
+        progs.append(voice_for(m[2]))
+    for channel, (times, progs) in programs.items():
+        on = chan == channel
+        i = np.searchsorted(times, start[on], side='right') - 1
+        voices[on] = np.where(i >= 0, np.array(progs)[np.maximum(i, 0)],
+                              PIANO)
+    drums = chan == DRUMS
+    voices[drums] = CLICK
+    freqs = 440.0 * 2 ** ((pitch - 69) / 12)
+    freqs[drums] = 440.0 * 2 ** ((pitch[drums] - 57) / 12)
+    for click, freq in CLICK_FREQUENCIES.items():
+        freqs[drums & (pitch == click)] = freq
+
+    tempo_map = TempoMap(tbon.meta_output, tempo_scale)
+    first = tempo_map.seconds_array(start)
+    duration = tempo_map.seconds_array(end) - first
+    ## Decaying voices are inaudible after a few time constants.
+    longest = np.array([6 * v.decay if v.decay else np.inf for v in VOICES])
+    releases = np.array([int(v.release * rate) for v in VOICES])
+    duration = np.minimum(duration, longest[voices])
+    lengths = np.rint(duration * rate).astype(np.int64) + releases[voices]
+    audible = freqs < rate / 2
+    return (np.rint(first[audible] * rate).astype(np.int64),
+            lengths[audible], freqs[audible], velocity[audible],
+            voices[audible])
+
+def envelope(spec, length, rate):
+    """ Return the amplitude envelope of a note length samples long """
+    t = np.arange(length) / rate
+    env = np.minimum(1.0, t / spec.attack)
+    if spec.decay:
+        env *= np.exp(-t / spec.decay)
+    release = min(length, int(spec.release * rate))
+    if release:
+        env[length - release:] *= np.linspace(1.0, 0.0, release)
+    return env
+
+def wavetable(spec):
+    """ Return one period of the voice's waveform as an array """
+    phase = 2 * np.pi * np.arange(TABLE_SIZE) / TABLE_SIZE
+    table = np.zeros(TABLE_SIZE)
+    for h, a in enumerate(spec.harmonics, 1):
+        if a:
+            table += a * np.sin(h * phase)
+    return table
+
+def render_notes(starts, lengths, freqs, amps, voices, rate=RATE):
+    """
+    Render notes into a buffer. Returns (origin, samples) where origin
+    is the sample at which the buffer starts.
+
+    Notes with the same voice and length are synthesized together as one
+    2-D block, one row per distinct frequency, from a wavetable of the
+    voice, so a pitch that recurs with the same length is synthesized
+    only once. The synthesis is vectorized; mixing is not, each note
+    adding its row, scaled by its amplitude, to the buffer as one slice.
+    """
+    if len(starts) == 0:
+        return 0, np.zeros(0, dtype=np.float32)
+    origin = int(starts.min())
+    buf = np.zeros(int((starts + lengths).max()) - origin, dtype=np.float32)
+    tables = {}
+    keys = voices * (int(lengths.max()) + 1) + lengths
+    order = np.argsort(keys, kind='stable')
+    bounds = np.flatnonzero(np.diff(keys[order])) + 1
+    for group in np.split(order, bounds):
+        voice = int(voices[group[0]])
+        if voice not in tables:
+            tables[voice] = wavetable(VOICES[voice])
+        length = int(lengths[group[0]])
+        env = envelope(VOICES[voice], length, rate).astype(np.float32)
+        t = np.arange(length) * (TABLE_SIZE / rate)
+        unique, inverse = np.unique(freqs[group], return_inverse=True)
+        rows = max(1, BLOCK_SAMPLES // max(1, length))
+        for i in range(0, len(unique), rows):
+            index = np.outer(unique[i:i + rows], t).astype(np.int64)
+            block = tables[voice][index % TABLE_SIZE].astype(np.float32)
+            block *= env
+            chunk = (inverse >= i) & (inverse < i + rows)
+            for note, row in zip(group[chunk], inverse[chunk] - i):
+                start = starts[note] - origin
+                buf[start:start + length] += amps[note] * block[row]
+    return origin, buf
+
+def render(tbon, metronome=0, rate=RATE, tempo_scale=1.0,
+           workers=None, slice_seconds=30.0):
+    """
+    Return the evaluated tbon as a float32 array of samples normalized
+    to a peak of 0.9. Long scores are split into slices of slice_seconds
+    by note start time and rendered in a pool of worker processes.
+    workers=1 renders in this process.
+    """
+    starts, lengths, freqs, amps, voices = note_table(tbon, metronome,
+                                                      rate, tempo_scale)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.float32)
+    total = int((starts + lengths).max())
+    slice_length = int(slice_seconds * rate)
+    nslices = int(starts.max()) // slice_length + 1
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or nslices == 1:
+        pieces = [render_notes(starts, lengths, freqs, amps, voices, rate)]
+    else:
+        slices = starts // slice_length
+        jobs = []
+        with ProcessPoolExecutor(min(workers, nslices)) as pool:
+            for n in np.unique(slices):
+                index = slices == n
+                jobs.append(pool.submit(render_notes, starts[index],
+                                        lengths[index], freqs[index],
+                                        amps[index], voices[index], rate))
+            pieces = [job.result() for job in jobs]
+    samples = np.zeros(total, dtype=np.float32)
+    for origin, buf in pieces:
+        samples[origin:origin + len(buf)] += buf
+    peak = np.abs(samples).max()
+    if peak > 0:
+        samples *= 0.9 / peak
+    return samples
+
+def write_wav(samples, outfile, rate=RATE):
+    """ Write samples in -1.0..1.0 to outfile as 16-bit mono PCM """
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+    with wave.open(outfile, 'wb') as output_file:
+        output_file.setnchannels(1)
+        output_file.setsampwidth(2)
+        output_file.setframerate(rate)
+        output_file.writeframes(pcm.tobytes())
+
+def make_wav(tbon, outfile, metronome=0, rate=RATE, tempo_scale=1.0,
+             workers=None):
+    """
+    Render the evaluated tbon output to the specified WAV file name.
+    metronome is 0 for music only, 1 for metronome only, 2 for both.
+    """
+    write_wav(render(tbon, metronome, rate, tempo_scale, workers),
+              outfile, rate)
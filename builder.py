@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Builds scores in Python as lowered trees that the evaluators
+             run directly, so generated music never goes through tbon
+             text and the grammar. to_tbon() writes the equivalent text.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+
+Example:
+    score = Score()
+    score.part(1).bar(key('D'), tempo(90), 'd', ['e', 'f'], HOLD)
+    score.bar(chord('d', note('f', 1), 'a'), HOLD, roll('a', 'd'), REST)
+    MidiEvaluator().eval(score.ast())
+    score.to_tbon() ## 'P=1 K=D T=90 d ef - | (d#fa) - (:ad) _ |'
+"""
+import re
+from collections import namedtuple
+from parser import AstNode, group_repeats
+
+## One element of a score. kind is the grammar rule it stands for and
+## value is the lowered value, or the items of a chord, roll or
+## ornament.
+Item = namedtuple('Item', 'kind value')
+
+HOLD = Item('hold', None)
+REST = Item('rest', None)
+
+PITCHNAME = re.compile(r"[a-g1-7]$", re.I)
+KEYNAME = re.compile(r"[a-gA-G](@|#)?$")
+BEATSPECS = ('2.', '2', '4.', '4', '8.', '8')
+BARLINE = re.compile(r"(\||:|\|:|:\|(x[1-9][0-9]*)?)$")
+
+## Text of each alteration. None is a natural sign.
+ALTERATION_TEXT = {2: '##', 1: '#', 0: '', -1: '@', -2: '@@', None: '%'}
+
+## Meta rule -> text before the value
+META_PREFIX = {
+    'beatspec': 'B=', 'key': 'K=', 'tempo': 'T=', 'relativetempo': 't=',
+    'velocity': 'V=', 'de_emphasis': 'D=', 'channel': 'C=',
+    'instrument': 'I=',
+}
+
+def note(name, alteration=0, octave=0):
+    """
+    Return a pitch. alteration is -2 to 2, or None for a natural sign.
+    octave is the number of octaves up (or down, if negative) from the
+    choice tbon would otherwise make, as with '^' and '/'.
+    """
+    if not PITCHNAME.match(str(name)):
+        msg = "\nInvalid pitch name, '{}'. Must be one of a-g or 1-7."
+        raise ValueError(msg.format(name))
+    if alteration not in ALTERATION_TEXT:
+        msg = "\nInvalid alteration, {}. Must be -2 to 2 or None."
+        raise ValueError(msg.format(alteration))
+    return Item('pitch', (int(octave), alteration, name))
+
+def chord(*items):
+    """
+    Return a chord of pitches, pitch names, HOLD and REST, where HOLD
+    continues the previous chord's note in the same position.
+    """
+    if not items:
+        raise ValueError("\nInvalid chord. A chord needs at least one item.")
+    members = []
+    for item in items:
+        item = subbeat_item(item)
+        if item.kind not in ('pitch', 'hold', 'rest'):
+            msg = "\nInvalid chord item, {!r}."
+            raise ValueError(msg.format(item))
+        members.append(Item('chord' + item.kind, item.value))
+    return Item('chord', tuple(members))
+
+def roll(*pitches):
+    """ Return a roll of two or more pitches or pitch names """
+    return Item('roll', grace_pitches('roll', pitches))
+
+def ornament(*pitches):
+    """ Return an ornament of two or more pitches or pitch names """
+    return Item('ornament', grace_pitches('ornament', pitches))
+
+def grace_pitches(kind, pitches):
+    """ Return the pitch items of a roll or ornament """
+    items = tuple(subbeat_item(pitch) for pitch in pitches)
+    if len(items) < 2 or any(item.kind != 'pitch' for item in items):
+        msg = "\nInvalid {}. It needs two or more pitches."
+        raise ValueError(msg.format(kind))
+    return items
+
+def beatspec(spec):
+    """ Return a beat note meta, B=, one of '2.', '2', '4.', '4', '8.', '8' """
+    if spec not in BEATSPECS:
+        msg = "\nInvalid beat note, '{}'. Must be one of {}."
+        raise ValueError(msg.format(spec, ', '.join(BEATSPECS)))
+    return Item('beatspec', spec)
+
+def key(name):
+    """ Return a key meta, K=, e.g. key('D'), key('b@') """
+    if not KEYNAME.match(str(name)):
+        msg = "\nInvalid key name, '{}'."
+        raise ValueError(msg.format(name))
+    return Item('key', name)
+
+def tempo(bpm):
+    """ Return a tempo meta, T= """
+    return Item('tempo', positive('tempo', bpm))
+
+def relativetempo(factor):
+    """ Return a relative tempo meta, t= """
+    return Item('relativetempo', positive('relative tempo', factor))
+
+def velocity(value):
+    """ Return a velocity meta, V= """
+    return Item('velocity', positive('velocity', value))
+
+def de_emphasis(value):
+    """ Return a de-emphasis meta, D= """
+    return Item('de_emphasis', positive('de-emphasis', value))
+
+def channel(number):
+    """ Return a midi channel meta, C= """
+    return Item('channel', whole('channel', number))
+
+def instrument(number):
+    """ Return an instrument meta, I= """
+    return Item('instrument', whole('instrument', number))
+
+def positive(name, value):
+    """ Return value as a float, which must be written without a sign """
+    value = float(value)
+    if not 0 <= value < float('inf'):
+        msg = "\nInvalid {}, {}. Must be zero or more."
+        raise ValueError(msg.format(name, value))
+    return value
+
+def whole(name, value):
+    """ Return value, which must be a whole number, as an int """
+    if int(value) != value or value < 0:
+        msg = "\nInvalid {}, {}. Must be a whole number."
+        raise ValueError(msg.format(name, value))
+    return int(value)
+
+def subbeat_item(item):
+    """
+    Return item as a subbeat Item. Strings may be a single pitch name,
+    '-' for a hold or '_' or 'z' for a rest.
+    """
+    if isinstance(item, Item):
+        return item
+    if item == '-':
+        return HOLD
+    if item in ('_', 'z'):
+        return REST
+    return note(item)
+
+def beat_items(beat):
+    """
+    Return the subbeat Items of beat, which is a list or tuple of
+    subbeats or a single subbeat.
+    """
+    if isinstance(beat, (list, tuple)) and not isinstance(beat, Item):
+        if not beat:
+            raise ValueError("\nInvalid beat. A beat needs a subbeat.")
+        items = tuple(subbeat_item(item) for item in beat)
+    else:
+        items = (subbeat_item(beat),)
+    for item in items:
+        if item.kind in META_PREFIX:
+            msg = "\nInvalid subbeat, {!r}. Metas can't be part of a beat."
+            raise ValueError(msg.format(item))
+    return items
+
+def number_text(value):
+    """ Return the tbon text of a meta's number """
+    text = repr(value)
+    if 'e' in text:
+        text = '{:.20f}'.format(value).rstrip('0').rstrip('.')
+    elif text.endswith('.0'):
+        text = text[:-2]
+    return text
+
+class Score():
+    """
+    A score built in Python. Add part switches, bars and repeat starts in
+    order, then pass ast() to an evaluator in place of tbon text.
+    """
+    def __init__(self):
+        self.children = []
+
+    def part(self, number):
+        """ Switch to part number. Returns the score. """
+        number = whole('part number', number)
+        if not number:
+            raise ValueError("\nInvalid part number, 0. Must be 1 or more.")
+        if self.children and self.children[-1][0] == 'partswitch':
+            msg = "\nInvalid part switch, P={}. It follows another one."
+            raise ValueError(msg.format(number))
+        self.children.append(('partswitch', number))
+        return self
+
+    def bar(self, *entries, barline='|'):
+        """
+        Add a bar of metas and beats, in order. Each beat is a list of
+        subbeats or a single subbeat, where a subbeat is a pitch, chord,
+        roll, ornament, HOLD, REST or a string as for subbeat_item().
+        barline is one of '|', ':', '|:', ':|' or ':|xN'. Returns the
+        score.
+        """
+        if not entries:
+            raise ValueError("\nInvalid bar. A bar needs a beat or meta.")
+        if not BARLINE.match(barline):
+            msg = "\nInvalid barline, '{}'."
+            raise ValueError(msg.format(barline))
+        items = []
+        for entry in entries:
+            if isinstance(entry, Item) and entry.kind in META_PREFIX:
+                items.append(entry)
+            else:
+                items.append(Item('beat', beat_items(entry)))
+        self.children.append(('bar', tuple(items), barline))
+        return self
+
+    def start_repeat(self):
+        """ Open a repeat between bars, as '|:' does. Returns the score. """
+        self.children.append(('startrepeat',))
+        return self
+
+    def ast(self):
+        """
+        Return the lowered tree. As with parser.lower_bars(), equal bars
+        share their children, whose offsets are relative to the bar's
+        text. The bar nodes have the offsets of the bar in to_tbon().
+        """
+        return Writer().score(self.children)
+
+    def to_tbon(self):
+        """ Return the tbon text of the score """
+        writer = Writer()
+        writer.score(self.children)
+        return ''.join(writer.pieces)
+
+class Writer():
+    """
+    Writes the text of a score and builds its lowered tree in step, so
+    that each node has the offsets of its text.
+    """
+    def __init__(self):
+        self.pieces = []
+        self.pos = 0
+        ## (items, barline) -> (text, children) of each distinct bar
+        self.bars = {}
+
+    def write(self, text):
+        """ Append text and return its start offset """
+        start = self.pos
+        self.pieces.append(text)
+        self.pos += len(text)
+        return start
+
+    def leaf(self, name, text, value=None):
+        """ Write text and return its node """
+        start = self.write(text)
+        return AstNode(name, value, (), start, self.pos)
+
+    def score(self, children):
+        """ Return the score node """
+        nodes = []
+        for index, child in enumerate(children):
+            ## As in a parsed score, a bar starts at the space before it.
+            start = self.pos
+            if index:
+                self.write('\n' if child[0] == 'partswitch' else ' ')
+            if child[0] == 'partswitch':
+                nodes.append(self.leaf('partswitch', 'P={}'.format(child[1]),
+                                       child[1]))
+            elif child[0] == 'startrepeat':
+                nodes.append(self.leaf('startrepeat', '|:'))
+            else:
+                key = child[1:]
+                shared = self.bars.get(key)
+                if shared is None:
+                    shared = self.bars[key] = Writer().bar(*key)
+                self.write(shared[0])
+                nodes.append(AstNode('bar', shared[0], shared[1],
+                                     start, self.pos))
+        return AstNode('score', None, group_repeats(nodes), 0, self.pos)
+
+    def bar(self, items, barline):
+        """ Return the text and child nodes of a bar """
+        nodes = []
+        for item in items:
+            if item.kind == 'beat':
+                nodes.append(self.beat(item.value))
+            else:
+                text = META_PREFIX[item.kind] + (
+                    item.value if isinstance(item.value, str)
+                    else number_text(item.value))
+                nodes.append(self.leaf(item.kind, text, item.value))
+            self.write(' ')
+        nodes.append(self.leaf('barline', barline, barline))
+        return ''.join(self.pieces), tuple(nodes)
+
+    def beat(self, items):
+        """ Return a beat node """
+        start = self.pos
+        nodes = tuple(self.subbeat(item) for item in items)
+        return AstNode('beat', None, nodes, start, self.pos)
+
+    def subbeat(self, item):
+        """ Return a subbeat node """
+        start = self.pos
+        if item.kind == 'hold':
+            nodes = [self.leaf('hold', '-')]
+        elif item.kind == 'rest':
+            nodes = [self.leaf('rest', '_')]
+        elif item.kind == 'pitch':
+            nodes = [self.pitch('pitch', item.value)]
+        elif item.kind == 'chord':
+            nodes = [self.leaf('chordstart', '(')]
+            for member in item.value:
+                if member.kind == 'chordpitch':
+                    nodes.append(self.pitch('chordpitch', member.value))
+                elif member.kind == 'chordhold':
+                    nodes.append(self.leaf('chordhold', '-'))
+                else:
+                    nodes.append(self.leaf('chordrest', '_'))
+            nodes.append(self.leaf('rparen', ')'))
+        else:
+            mark = '(:' if item.kind == 'roll' else '(~'
+            nodes = [self.leaf(item.kind + 'start', mark)]
+            nodes.extend(self.pitch('pitch', pitch.value)
+                         for pitch in item.value)
+            nodes.append(self.leaf('rparen', ')'))
+        return AstNode('subbeat', None, tuple(nodes), start, self.pos)
+
+    def pitch(self, name, value):
+        """ Return a pitch or chordpitch node """
+        octave, alteration, pitchname = value
+        marks = '^' * octave if octave > 0 else '/' * -octave
+        text = marks + ALTERATION_TEXT[alteration] + pitchname
+        return self.leaf(name, text, value)
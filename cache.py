@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Process-wide cache of evaluated tbon and encoded midi files,
+             so that servers answering the same source again don't
+             recompute it.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from tbon import evaluate, midi_bytes
+
+## Rough size in bytes of one evaluated note, for sizing cache entries.
+NOTE_BYTES = 200
+
+CacheStats = namedtuple('CacheStats', 'hits misses evictions entries size')
+
+class ResultCache():
+    """
+    Thread-safe least-recently-used cache bounded by the total size in
+    bytes of its entries. Values are stored with the size given to put().
+    An entry larger than the whole cache isn't stored.
+    """
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the value cached for key or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """ Cache value for key, evicting the least recently used """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        """ Drop every entry. The statistics are kept. """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return the hit, miss and eviction counts and current size """
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.evictions,
+                              len(self.entries), self.size)
+
+## Shared by every caller in the process.
+RESULT_CACHE = ResultCache()
+
+def result_key(source, numeric=True, parts=None, include_dir=None,
+               ignore_velocity=False, options=None):
+    """
+    Return the cache key for evaluating source with the given arguments
+    and, for a midi file, the make_midi() options.
+    """
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return (digest, numeric, None if parts is None else frozenset(parts),
+            include_dir, ignore_velocity,
+            None if options is None else tuple(sorted(options.items())))
+
+def cached_evaluate(source, numeric=True, parts=None, include_dir=None,
+                    ignore_velocity=False, cache=RESULT_CACHE):
+    """
+    Return tbon.evaluate() of source, from cache if it was evaluated
+    before. The evaluator is shared by every caller that gets it from
+    the cache, so it mustn't be modified. Included fragments aren't part
+    of the key, so clear the cache after editing them.
+    """
+    key = result_key(source, numeric, parts, include_dir, ignore_velocity)
+    tbon = cache.get(key)
+    if tbon is None:
+        tbon = evaluate(source, numeric, parts, include_dir, ignore_velocity)
+        ## Build the lazy products now, so that threads sharing the
+        ## evaluator never race to build them.
+        notes = sum(len(part) for part in tbon.output)
+        notes += len(tbon.metronome_output)
+        tbon.beat_map # pylint: disable=pointless-statement
+        cache.put(key, tbon, len(source) + NOTE_BYTES * notes)
+    return tbon
+
+def cached_midi(source, numeric=True, parts=None, include_dir=None,
+                ignore_velocity=False, cache=RESULT_CACHE, **options):
+    """
+    Return the midi file for source as bytes, from cache if it was made
+    before with the same arguments. options are passed to make_midi(),
+    e.g. metronome=2, transpose=-2. The evaluation is cached too, so a
+    new set of options for the same source only re-encodes the midi.
+    Raises ValueError if ignore_velocity is true, since midi needs the
+    velocities and channels it leaves out.
+    """
+    if ignore_velocity:
+        raise ValueError("\nMidi can't be made with ignore_velocity.")
+    key = result_key(source, numeric, parts, include_dir, ignore_velocity,
+                     options)
+    data = cache.get(key)
+    if data is None:
+        tbon = cached_evaluate(source, numeric, parts, include_dir,
+                               ignore_velocity, cache)
+        data = midi_bytes(tbon, **options)
+        cache.put(key, data, len(data))
+    return data
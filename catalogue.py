@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description: Catalogue of a library of tbon files in an SQLite database,
+             so that questions like "which pieces are in 7/8 and E@ with
+             more than 4 parts" are answered without compiling anything.
+             Files are analysed in parallel and only new or changed files
+             are analysed again. An inverted index of melodic n-grams
+             finds a motif in any key and tempo.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc.
+
+Example:
+    catalogue.py index ~/music
+    catalogue.py find --key E@ --meter 7/8 --min-parts 5
+    catalogue.py motif 'c d e c |'
+"""
+import os
+import sys
+import sqlite3
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from excerpt import source_hash
+from motifs import part_grams, motif_line, motif_grams, GRAM_NOTES
+from rekey import KEYNAMES
+from tbon import compile_one
+from timing import TempoMap
+
+## Bumped whenever the tables change. Older catalogues are rebuilt.
+CATALOGUE_VERSION = 4
+
+## Default database, in the directory catalogue.py is run from.
+DEFAULT_DB = 'tbon_catalogue.db'
+
+## Times are in quarter-note beats, as in MidiEvaluator output. Parts
+## are numbered as in the score. beat_map is the bar lengths in beats,
+## separated by spaces. error is the message of a file that doesn't
+## compile, whose other rows are missing. motifs holds the n-gram
+## starting at each note of a part's melody, as from motifs.part_grams(),
+## with its note position, time, bar and beat within the bar.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    path TEXT PRIMARY KEY, mtime REAL, hash TEXT, numeric INTEGER,
+    parts INTEGER, bars INTEGER, beats REAL, seconds REAL,
+    notes INTEGER, low INTEGER, high INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS parts (
+    path TEXT, part INTEGER, bars INTEGER, beat_map TEXT,
+    notes INTEGER, low INTEGER, high INTEGER);
+CREATE TABLE IF NOT EXISTS channels (
+    path TEXT, part INTEGER, channel INTEGER, notes INTEGER);
+CREATE TABLE IF NOT EXISTS instruments (
+    path TEXT, part INTEGER, time REAL, channel INTEGER,
+    instrument INTEGER);
+CREATE TABLE IF NOT EXISTS keys (
+    path TEXT, part INTEGER, time REAL, key TEXT);
+CREATE TABLE IF NOT EXISTS meters (
+    path TEXT, part INTEGER, time REAL, numerator INTEGER,
+    denominator INTEGER);
+CREATE TABLE IF NOT EXISTS tempi (
+    path TEXT, time REAL, bpm REAL);
+CREATE TABLE IF NOT EXISTS motifs (
+    path TEXT, part INTEGER, position INTEGER, time REAL, bar INTEGER,
+    beat REAL, gram TEXT);
+CREATE INDEX IF NOT EXISTS parts_path ON parts (path);
+CREATE INDEX IF NOT EXISTS channels_path ON channels (path);
+CREATE INDEX IF NOT EXISTS instruments_path ON instruments (path);
+CREATE INDEX IF NOT EXISTS keys_key ON keys (key, path);
+CREATE INDEX IF NOT EXISTS keys_path ON keys (path);
+CREATE INDEX IF NOT EXISTS meters_meter ON meters (numerator, denominator,
+                                                   path);
+CREATE INDEX IF NOT EXISTS meters_path ON meters (path);
+CREATE INDEX IF NOT EXISTS tempi_path ON tempi (path);
+CREATE INDEX IF NOT EXISTS motifs_gram ON motifs (gram);
+CREATE INDEX IF NOT EXISTS motifs_path ON motifs (path);
+"""
+
+## Tables with rows for each score, other than scores itself.
+DETAIL_TABLES = ('parts', 'channels', 'instruments', 'keys', 'meters',
+                 'tempi', 'motifs')
+
+## The analysis of one file: the scores row and the rows of each of
+## DETAIL_TABLES, in order, without their path.
+Entry = namedtuple('Entry', 'score ' + ' '.join(DETAIL_TABLES))
+
+## Where Catalogue.find_motif() found a motif. bar and beat are
+## numbered from 0 as in the beat map, and beat is in the bar's own
+## beats, e.g. eighth notes for B=8, while time is in quarter notes.
+MotifMatch = namedtuple('MotifMatch', 'path part bar beat time')
+
+## What Catalogue.update() did.
+UpdateStats = namedtuple('UpdateStats',
+                         'added changed touched unchanged removed failed')
+
+def tbon_files(paths):
+    """
+    Return the sorted absolute names of the .tba and .tbn files in
+    paths, which may be files or directories searched recursively.
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                found.update(os.path.join(folder, f) for f in files
+                             if os.path.splitext(f)[1].lower()
+                             in ('.tba', '.tbn'))
+        else:
+            found.add(path)
+    return sorted(os.path.abspath(f) for f in found)
+
+def analyse(path, source):
+    """
+    Compile source, the text of the file path, without encoding midi and
+    return its Entry. A file that doesn't compile has only its scores
+    row, with the error.
+    """
+    numeric = os.path.splitext(path)[1].lower() == '.tbn'
+    tbon = compile_one(source, numeric, include_dir=os.path.dirname(path),
+                       midi=False)
+    if tbon.error is not None:
+        return error_entry(path, str(tbon.error).strip())
+    parts, channels = [], []
+    pitches = []
+    for partnum, notes in zip(tbon.part_numbers, tbon.output):
+        beats = tbon.beat_map.get(partnum, ())
+        sounding = [note for note in notes if note[0] is not None]
+        part_pitches = [note[0] for note in sounding]
+        pitches.extend(part_pitches)
+        parts.append((partnum, len(beats), ' '.join(str(b) for b in beats),
+                      len(sounding), min(part_pitches, default=None),
+                      max(part_pitches, default=None)))
+        used = Counter(note[4] for note in sounding)
+        channels.extend((partnum, channel, count)
+                        for channel, count in sorted(used.items()))
+    ## Metas hold the part number less one.
+    meta = tbon.meta_output
+    instruments = [(m[3] + 1, m[1], m[4], m[2])
+                   for m in meta if m[0] == 'I']
+    keys = [(m[3] + 1, m[1], KEYNAMES[m[2]]) for m in meta if m[0] == 'K']
+    ## Parts are in C until their first key signature.
+    keyed = {row[0] for row in keys if row[1] == 0}
+    keys = [(partnum, 0, KEYNAMES[(0, 0)]) for partnum in tbon.part_numbers
+            if partnum not in keyed] + keys
+    meters = [(m[4] + 1, m[1], m[2], m[3]) for m in meta if m[0] == 'M']
+    tempi = [(m[1], m[2]) for m in meta if m[0] == 'T']
+    motifs = []
+    for partnum, notes in zip(tbon.part_numbers, tbon.output):
+        meter = sorted(row[1:] for row in meters if row[0] == partnum)
+        motifs.extend((partnum,) + row for row in part_grams(
+            notes, meter, tbon.beat_map.get(partnum, ())))
+    beats = max((note[2] for notes in tbon.output for note in notes),
+                default=0)
+    beats = max([beats] + [note[2] for note in tbon.metronome_output])
+    score = (numeric, len(tbon.part_numbers),
+             max((p[1] for p in parts), default=0), beats,
+             TempoMap(meta).seconds(beats), len(pitches),
+             min(pitches, default=None), max(pitches, default=None), None)
+    return Entry(score, parts, channels, instruments, keys, meters, tempi,
+                 motifs)
+
+def error_entry(path, message):
+    """
+    Return the Entry of a file that can't be catalogued, holding only
+    its scores row with the error message.
+    """
+    numeric = os.path.splitext(path)[1].lower() == '.tbn'
+    return Entry((numeric, None, None, None, None, None, None, None,
+                  message), (), (), (), (), (), (), ())
+
+def analyse_file(job):
+    """
+    analyse() a (path, source) job, for running in a worker. Anything
+    raised is returned as the file's error, so that one bad file
+    doesn't stop the rest being catalogued.
+    """
+    try:
+        return analyse(*job)
+    except Exception as e: # pylint: disable=broad-except
+        return error_entry(job[0], str(e).strip() or repr(e))
+
+class Catalogue():
+    """
+    SQLite catalogue of tbon files. update() brings it up to date with
+    the files on disk; find(), find_motif() and query() answer
+    questions from it.
+    Included fragments aren't tracked, so update(force=True) after
+    editing them.
+    """
+    def __init__(self, filename=DEFAULT_DB):
+        self.db = sqlite3.connect(filename)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOGUE_VERSION:
+            with self.db:
+                for table in ('scores',) + DETAIL_TABLES:
+                    self.db.execute('DROP TABLE IF EXISTS ' + table)
+                self.db.executescript(SCHEMA)
+                self.db.execute('PRAGMA user_version = {}'.format(
+                    CATALOGUE_VERSION))
+
+    def close(self):
+        """ Close the database """
+        self.db.close()
+
+    def update(self, paths, workers=None, force=False, prune=True):
+        """
+        Catalogue the tbon files in paths, which may be files or
+        directories. A file whose mtime is unchanged is skipped, and one
+        whose text is unchanged only has its mtime updated. The rest are
+        analysed, by workers processes if more than one, and written in
+        one transaction. If prune is true, files under paths that no
+        longer exist are dropped. force analyses every file again.
+        Files are read as UTF-8. One that can't be read is catalogued
+        with the error, like one that doesn't compile, and both count as
+        failed. One that vanishes before it is read counts as failed
+        and is dropped.
+        Returns UpdateStats.
+        """
+        files = tbon_files(paths)
+        known = {row[0]: row[1:] for row in
+                 self.db.execute('SELECT path, mtime, hash FROM scores')}
+        jobs, hashes, touched = [], [], []
+        unreadable = []
+        present = set(files)
+        added = unchanged = vanished = 0
+        for path in files:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                present.discard(path)
+                vanished += 1
+                continue
+            old = known.get(path)
+            if old and old[0] == mtime and not force:
+                unchanged += 1
+                continue
+            try:
+                with open(path, encoding='utf-8') as infile:
+                    source = infile.read()
+            except (OSError, UnicodeDecodeError) as e:
+                added += old is None
+                unreadable.append(((path, mtime, None),
+                                   error_entry(path, str(e).strip())))
+                continue
+            digest = source_hash(source)
+            if old and old[1] == digest and not force:
+                touched.append((mtime, path))
+                continue
+            added += old is None
+            jobs.append((path, source))
+            hashes.append((path, mtime, digest))
+        if workers == 1 or len(jobs) < 2:
+            entries = [analyse_file(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                entries = list(executor.map(analyse_file, jobs,
+                                            chunksize=16))
+        for row, entry in unreadable:
+            hashes.append(row)
+            entries.append(entry)
+        roots = [os.path.join(os.path.abspath(p), '') for p in paths
+                 if os.path.isdir(p)]
+        gone = [(path,) for path in known if path not in present and
+                any(path.startswith(root) for root in roots)] \
+            if prune else []
+        with self.db:
+            self.db.executemany('UPDATE scores SET mtime = ? WHERE path = ?',
+                                touched)
+            stale = [(path,) for path, _, _ in hashes] + gone
+            for table in ('scores',) + DETAIL_TABLES:
+                self.db.executemany(
+                    'DELETE FROM {} WHERE path = ?'.format(table), stale)
+            self.db.executemany(
+                'INSERT INTO scores VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                (row + entry.score
+                 for row, entry in zip(hashes, entries)))
+            for index, table in enumerate(DETAIL_TABLES, 1):
+                rows = [(path,) + row
+                        for (path, _, _), entry in zip(hashes, entries)
+                        for row in entry[index]]
+                if rows:
+                    marks = ','.join('?' * len(rows[0]))
+                    self.db.executemany('INSERT INTO {} VALUES ({})'.format(
+                        table, marks), rows)
+        failed = vanished + sum(entry.score[-1] is not None
+                                for entry in entries)
+        return UpdateStats(added, len(hashes) - added, len(touched),
+                           unchanged, len(gone), failed)
+
+    def find(self, key=None, meter=None, min_parts=None, max_parts=None,
+             instrument=None, channel=None, min_seconds=None,
+             max_seconds=None, low=None, high=None):
+        """
+        Return the sorted paths of the scores matching every condition
+        given. key is a key name, e.g. 'E@' or 'c#', and meter a
+        (numerator, denominator) pair or text like '7/8'; either matches
+        if it is used anywhere in the score. instrument and channel
+        match if any part uses them. low and high bound the pitch range.
+        Files that don't compile never match.
+        """
+        where = ['error IS NULL']
+        params = []
+        if key is not None:
+            where.append('path IN (SELECT path FROM keys WHERE key = ?)')
+            params.append(key)
+        if meter is not None:
+            if isinstance(meter, str):
+                meter = tuple(int(n) for n in meter.split('/'))
+            where.append('path IN (SELECT path FROM meters '
+                         'WHERE numerator = ? AND denominator = ?)')
+            params.extend(meter)
+        if instrument is not None:
+            where.append('path IN (SELECT path FROM instruments '
+                         'WHERE instrument = ?)')
+            params.append(instrument)
+        if channel is not None:
+            where.append('path IN (SELECT path FROM channels '
+                         'WHERE channel = ?)')
+            params.append(channel)
+        for column, test, value in (
+                ('parts', '>=', min_parts), ('parts', '<=', max_parts),
+                ('seconds', '>=', min_seconds),
+                ('seconds', '<=', max_seconds),
+                ('low', '>=', low), ('high', '<=', high)):
+            if value is not None:
+                where.append('{} {} ?'.format(column, test))
+                params.append(value)
+        sql = 'SELECT path FROM scores WHERE {} ORDER BY path'.format(
+            ' AND '.join(where))
+        return [row[0] for row in self.db.execute(sql, params)]
+
+    def find_motif(self, snippet, numeric=False):
+        """
+        Return a MotifMatch for every occurrence of the melody of a tbon
+        snippet, e.g. 'c d e c |', in any key and at any tempo, ordered
+        by path, part and time. Pitches are compared by interval and
+        rhythms by the ratios of the times between onsets, so the last
+        note's length doesn't matter. Where notes sound together only
+        the highest counts. Raises ValueError for an invalid snippet.
+        """
+        line = motif_line(snippet, numeric)
+        found = None
+        for offset, gram in motif_grams(line):
+            if len(line) < GRAM_NOTES:
+                ## A short motif matches the start of longer n-grams.
+                rows = self.db.execute(
+                    'SELECT path, part, position, time, bar, beat '
+                    'FROM motifs WHERE gram = ? OR (gram > ? AND gram < ?)',
+                    (gram, gram + ' ', gram + '!'))
+            else:
+                rows = self.db.execute(
+                    'SELECT path, part, position, time, bar, beat '
+                    'FROM motifs WHERE gram = ?', (gram,))
+            hits = {(row[0], row[1], row[2] - offset): row[3:]
+                    for row in rows}
+            if found is None:
+                found = hits
+            else:
+                found = {k: found[k] for k in found if k in hits}
+            if not found:
+                break
+        matches = [MotifMatch(path, part, bar, beat, time)
+                   for (path, part, _), (time, bar, beat) in found.items()]
+        return sorted(matches, key=lambda m: (m.path, m.part, m.time))
+
+    def query(self, sql, params=()):
+        """ Return the rows of any SQL query of the catalogue """
+        return self.db.execute(sql, params).fetchall()
+
+def make_arg_parser():
+    """ Return the argument parser for the command line """
+    arg_parser = argparse.ArgumentParser(
+        description="Catalogue tbon files in an SQLite database and "
+        "search the catalogue.")
+    arg_parser.add_argument('--db', default=DEFAULT_DB,
+                            help="Catalogue file. Default: {}".format(
+                                DEFAULT_DB))
+    commands = arg_parser.add_subparsers(dest='command')
+    index = commands.add_parser(
+        'index', help="Add new and changed files to the catalogue.")
+    index.add_argument('-j', '--jobs', type=int, default=None,
+                       help="Worker processes. Default: one per CPU.")
+    index.add_argument('-f', '--force', action='store_true',
+                       help="Analyse every file, changed or not.")
+    index.add_argument('path', nargs='+',
+                       help="tbon files or directories to search")
+    find = commands.add_parser(
+        'find', help="Print the catalogued files matching every option.")
+    find.add_argument('-k', '--key', help="Key name used, e.g. E@ or c#")
+    find.add_argument('-m', '--meter', help="Meter used, e.g. 7/8")
+    find.add_argument('--min-parts', type=int)
+    find.add_argument('--max-parts', type=int)
+    find.add_argument('-i', '--instrument', type=int,
+                      help="Instrument number used")
+    find.add_argument('-c', '--channel', type=int,
+                      help="Midi channel used")
+    find.add_argument('--min-seconds', type=float)
+    find.add_argument('--max-seconds', type=float)
+    find.add_argument('--low', type=int,
+                      help="Lowest midi pitch allowed")
+    find.add_argument('--high', type=int,
+                      help="Highest midi pitch allowed")
+    motif = commands.add_parser(
+        'motif', help="Print where a motif, given as tbon, is played, "
+        "in any key and at any tempo. Bars and beats are numbered from 0 "
+        "as in the beat map, counting the beats of each bar.")
+    motif.add_argument('-n', '--numeric', action='store_true',
+                       help="The motif uses numeric pitch names.")
+    motif.add_argument('snippet', help="tbon of the motif, e.g. 'c d e c'")
+    sql = commands.add_parser('sql', help="Run an SQL query and print "
+                              "the rows.")
+    sql.add_argument('query')
+    return arg_parser
+
+def main(argv=None):
+    """ Run the command line with argv, sys.argv[1:] if None """
+    args = make_arg_parser().parse_args(argv)
+    if args.command is None:
+        make_arg_parser().print_usage()
+        return 2
+    catalogue = Catalogue(args.db)
+    try:
+        if args.command == 'index':
+            stats = catalogue.update(args.path, args.jobs, args.force)
+            print("{} added, {} changed, {} touched, {} unchanged, "
+                  "{} removed, {} failed".format(*stats))
+        elif args.command == 'find':
+            for path in catalogue.find(
+                    args.key, args.meter, args.min_parts, args.max_parts,
+                    args.instrument, args.channel, args.min_seconds,
+                    args.max_seconds, args.low, args.high):
+                print(path)
+        elif args.command == 'motif':
+            for match in catalogue.find_motif(args.snippet, args.numeric):
+                print("{} part {} bar {} beat {:g}".format(
+                    match.path, match.part, match.bar, match.beat))
+        else:
+            for row in catalogue.query(args.query):
+                print('\t'.join(str(v) for v in row))
+    except (ValueError, sqlite3.Error) as e:
+        print(str(e).strip())
+        return 1
+    finally:
+        catalogue.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description: Compile server that keeps a warm interpreter, with the
+             grammar built and the caches filled, listening on a local
+             Unix socket for tbonc.py.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc.
+
+Protocol: the client sends one JSON line,
+{"argv": [...], "cwd": "...", "prog": "..."}.
+The server runs tbon.main(argv, prog) in cwd and streams back JSON lines,
+{"out": text} and {"err": text}, ending with {"exit": status}.
+"""
+import os
+import sys
+import json
+import socket
+import signal
+import argparse
+import traceback
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+from tbonc import socket_path, owned_socket
+
+class StreamWriter():
+    """ Text stream that sends each write to the client as a JSON line """
+    def __init__(self, wfile, kind):
+        self.wfile = wfile
+        self.kind = kind
+
+    def write(self, text):
+        """ Send text """
+        if text:
+            self.wfile.write(json.dumps({self.kind: text}).encode('utf-8'))
+            self.wfile.write(b'\n')
+        return len(text)
+
+    def flush(self):
+        """ Flush the socket """
+        self.wfile.flush()
+
+class CompileHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one command line. Requests are handled one at a time, since
+    each changes to the client's working directory.
+    """
+    def handle(self):
+        import tbon
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        out = StreamWriter(self.wfile, 'out')
+        err = StreamWriter(self.wfile, 'err')
+        home = os.getcwd()
+        try:
+            os.chdir(request['cwd'])
+            with redirect_stdout(out), redirect_stderr(err):
+                try:
+                    status = tbon.main(request['argv'],
+                                       prog=request.get('prog'))
+                except SystemExit as e:
+                    ## argparse exits for --help and usage errors.
+                    status = e.code if isinstance(e.code, int) else 1
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
+                    status = 1
+        finally:
+            os.chdir(home)
+        self.wfile.write(json.dumps({'exit': status}).encode('utf-8'))
+        self.wfile.write(b'\n')
+
+def warm_up():
+    """ Import and build everything a compile needs """
+    #pylint: disable=unused-variable
+    import tbon
+    import parser
+    import midiutil
+    parser.grammar()
+    parser.grammar('bar')
+
+def make_server(path):
+    """
+    Return a server listening on the Unix socket path, which only this
+    user can connect to. Raises ValueError if a daemon is already
+    listening there or path is something other than a socket of ours.
+    """
+    if os.path.lexists(path):
+        if not owned_socket(path):
+            msg = "\n{} exists and isn't a socket of yours. Not replacing it."
+            raise ValueError(msg.format(path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            ## Left behind by a daemon that didn't exit cleanly.
+            os.unlink(path)
+        else:
+            msg = "\nA tbon daemon is already listening on {}."
+            raise ValueError(msg.format(path))
+        finally:
+            probe.close()
+    ## Created private, so there's no moment when others can connect.
+    umask = os.umask(0o077)
+    try:
+        return socketserver.UnixStreamServer(path, CompileHandler)
+    finally:
+        os.umask(umask)
+
+def serve(path=None):
+    """ Serve compile requests on the Unix socket path until interrupted """
+    path = path or socket_path(create=True)
+    server = make_server(path)
+    warm_up()
+    ## Clean up on kill too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(
+        description="Serve tbon compiles to tbonc.py on a Unix socket.")
+    _parser.add_argument('--socket', default=None,
+                         help="Socket name. Default: $TBON_SOCKET, else "
+                         "tbon.sock in $XDG_RUNTIME_DIR or in a private "
+                         "directory of the temporary directory.")
+    _args = _parser.parse_args()
+    try:
+        serve(_args.socket)
+    except ValueError as e:
+        print(str(e).strip())
+        sys.exit(1)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Differences between two evaluations of a score, as patches
+             that a running player can apply without restarting.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+from collections import Counter, namedtuple
+from operator import itemgetter
+
+## The change from one evaluation to another. removed and inserted are
+## lists of (part number, note), ordered by start time within each part.
+## removed_meta and inserted_meta are meta_output tuples.
+Patch = namedtuple('Patch', 'removed inserted removed_meta inserted_meta')
+
+## Times are rounded to this many places when matching notes, so that
+## rounding differences in recomputed times don't count as changes.
+PLACES = 9
+
+def note_key(note):
+    """ Return the hashable identity of a note. Any source span is ignored. """
+    return ((note[0], round(note[1], PLACES), round(note[2], PLACES))
+            + tuple(note[3:5]))
+
+def diff_notes(old, new):
+    """
+    Return (removed, inserted), the notes of old not in new and the
+    notes of new not in old. Both lists must be sorted by start time, as
+    MidiEvaluator output is. Runs in time linear in their length by
+    walking both in step and comparing only notes that start together.
+    Rests are ignored.
+    """
+    removed, inserted = [], []
+    i = j = 0
+    nold, nnew = len(old), len(new)
+    while i < nold or j < nnew:
+        ## Most notes are unchanged, and identical notes match.
+        if i < nold and j < nnew and old[i] == new[j]:
+            i += 1
+            j += 1
+            continue
+        if j == nnew:
+            start = round(old[i][1], PLACES)
+        elif i == nold:
+            start = round(new[j][1], PLACES)
+        else:
+            start = min(round(old[i][1], PLACES), round(new[j][1], PLACES))
+        group_old, group_new = Counter(), Counter()
+        notes = {}
+        while i < nold and round(old[i][1], PLACES) == start:
+            key = note_key(old[i])
+            group_old[key] += 1
+            notes.setdefault(key, old[i])
+            i += 1
+        while j < nnew and round(new[j][1], PLACES) == start:
+            key = note_key(new[j])
+            group_new[key] += 1
+            notes[key] = new[j]
+            j += 1
+        if group_old == group_new:
+            continue
+        for key, count in (group_old - group_new).items():
+            if key[0] is not None:
+                removed.extend([notes[key]] * count)
+        for key, count in (group_new - group_old).items():
+            if key[0] is not None:
+                inserted.extend([notes[key]] * count)
+    return removed, inserted
+
+def diff(old, new):
+    """
+    Return the Patch that turns the evaluated tbon old into new. Either
+    may be a MidiEvaluator or anything with the same output,
+    part_numbers and meta_output, e.g. a tbon.Compiled result.
+    """
+    removed, inserted = [], []
+    old_parts = dict(zip(old.part_numbers, old.output))
+    new_parts = dict(zip(new.part_numbers, new.output))
+    for partnum in sorted(set(old_parts) | set(new_parts)):
+        gone, added = diff_notes(old_parts.get(partnum, ()),
+                                 new_parts.get(partnum, ()))
+        removed.extend((partnum, note) for note in gone)
+        inserted.extend((partnum, note) for note in added)
+    old_meta, new_meta = Counter(old.meta_output), Counter(new.meta_output)
+    return Patch(removed, inserted,
+                 sorted((old_meta - new_meta).elements(), key=lambda m: m[1]),
+                 sorted((new_meta - old_meta).elements(), key=lambda m: m[1]))
+
+def since(patch, time):
+    """
+    Return the part of patch that takes effect at or after time. A
+    player applies this at a safe point in its lookahead, time being the
+    first beat it hasn't yet sent; notes already sent are left alone.
+    """
+    return Patch([n for n in patch.removed if n[1][1] >= time],
+                 [n for n in patch.inserted if n[1][1] >= time],
+                 [m for m in patch.removed_meta if m[1] >= time],
+                 [m for m in patch.inserted_meta if m[1] >= time])
+
+def apply_patch(parts, patch, time=0):
+    """
+    Return a new dict of part number -> notes sorted by start time, the
+    notes of parts with the changes of patch that start at or after
+    time applied. Earlier notes are kept as they are, since a player has
+    already sent them. Linear in the number of notes.
+    """
+    patch = since(patch, time)
+    removed = {}
+    for partnum, note in patch.removed:
+        removed.setdefault(partnum, Counter())[note_key(note)] += 1
+    inserted = {}
+    for partnum, note in patch.inserted:
+        inserted.setdefault(partnum, []).append(note)
+    result = {}
+    for partnum in sorted(set(parts) | set(inserted)):
+        notes = list(parts.get(partnum, ()))
+        drop = removed.get(partnum)
+        if drop:
+            first = min(key[1] for key in drop)
+            remaining = sum(drop.values())
+            kept = []
+            for index, note in enumerate(notes):
+                if note[1] >= first - 1e-9:
+                    key = note_key(note)
+                    if drop[key]:
+                        drop[key] -= 1
+                        remaining -= 1
+                        if not remaining:
+                            kept.extend(notes[index + 1:])
+                            break
+                        continue
+                kept.append(note)
+            notes = kept
+        if partnum in inserted:
+            ## Two sorted runs, which sort() merges in linear time.
+            notes.extend(inserted[partnum])
+            notes.sort(key=itemgetter(1))
+        result[partnum] = notes
+    return result
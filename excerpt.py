@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Renders a range of bars from a long score without evaluating
+             the whole score, using a checkpoint index of evaluator state.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import os
+import json
+import hashlib
+from bisect import bisect_right
+from collections import namedtuple
+from parser import MidiEvaluator, lower_bars, BLOCKS
+
+## Bars between checkpoints. An excerpt evaluates at most this many
+## bars before its first bar.
+CHECKPOINT_INTERVAL = 16
+
+## Bumped whenever the index format changes.
+INDEX_VERSION = 1
+
+## Quacks enough like a MidiEvaluator for tbon.make_midi.
+Excerpt = namedtuple('Excerpt', 'output meta_output metronome_output '
+                     'beat_map part_numbers')
+
+def source_hash(source):
+    """ Digest identifying the source an index was built from """
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def index_path(filename):
+    """ Return the name of the checkpoint index for a tbon file """
+    return os.path.splitext(filename)[0] + '.tbc'
+
+def build_index(source, pitch_order, interval=CHECKPOINT_INTERVAL):
+    """
+    Evaluate source once and return its checkpoint index: for each part,
+    the source span and start and end beat of every bar and the
+    evaluator state at the start of every interval'th bar. The index is
+    plain JSON data. Raises ValueError if the score has includes or
+    repeats, whose bars don't map to a single place in the source.
+    """
+    ## Checked before includes are resolved, which would read files.
+    ast = lower_bars(source)
+    if any(child.expr_name in BLOCKS for child in ast.children):
+        msg = ("\nBar ranges can't be rendered from scores "
+               "with includes or repeats.")
+        raise ValueError(msg)
+    tbon = MidiEvaluator(pitch_order=pitch_order, block_cache=None,
+                         checkpoint_interval=interval)
+    tbon.eval(ast, verbosity=0)
+    parts = {}
+    for partnum, bars in tbon.bars.items():
+        parts[str(partnum)] = dict(
+            bars=[list(bar) for bar in bars],
+            checkpoints={str(n): state for n, state
+                         in tbon.checkpoints.get(partnum, {}).items()})
+    return dict(version=INDEX_VERSION,
+                source_hash=source_hash(source),
+                pitch_order=''.join(pitch_order),
+                interval=interval,
+                parts=parts)
+
+def save_index(index, filename):
+    """ Write index to filename as JSON """
+    with open(filename, 'w') as outfile:
+        json.dump(index, outfile)
+
+def load_index(source, pitch_order, filename, interval=CHECKPOINT_INTERVAL):
+    """
+    Return the index for source saved in filename, rebuilding and saving
+    it if it's missing or was built from a different source.
+    """
+    try:
+        with open(filename) as infile:
+            index = json.load(infile)
+        if (index['version'] == INDEX_VERSION and
+                index['source_hash'] == source_hash(source) and
+                index['pitch_order'] == ''.join(pitch_order)):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    index = build_index(source, pitch_order, interval)
+    save_index(index, filename)
+    return index
+
+def render_bars(source, index, first, last, pitch_order, parts=None):
+    """
+    Evaluate bars first through last (counting from 0) of the lowest
+    numbered part, and whatever the other parts play at the same time.
+    Returns an Excerpt whose times start at 0 at bar first. If parts is
+    given, only those part numbers are included.
+
+    Each part restores the checkpoint nearest before its first bar and
+    parses and evaluates only the bars from there on, so the cost is
+    proportional to the length of the excerpt. The tempo, key, meter
+    and instrument in effect at the start of the excerpt are written at
+    time 0.
+    """
+    indexed = sorted(index['parts'].items(), key=lambda item: int(item[0]))
+    reference = indexed[0][1]['bars']
+    if not 0 <= first <= last < len(reference):
+        msg = "\nInvalid bar range, {} to {}. The score has bars 0 to {}."
+        raise ValueError(msg.format(first, last, len(reference) - 1))
+    window_start = reference[first][2]
+    length = reference[last][3] - window_start
+    interval = index['interval']
+    output, meta, clicks, beat_map, part_numbers = [], [], [], {}, []
+    for partnum, info in indexed:
+        partnum = int(partnum)
+        ## Part 1 is evaluated regardless for its tempi.
+        wanted = parts is None or partnum in parts
+        if not wanted and partnum != 1:
+            continue
+        bars = info['bars']
+        starts = [bar[2] for bar in bars]
+        begin = max(0, bisect_right(starts, window_start) - 1)
+        end = bisect_right(starts, window_start + length - 1e-9) - 1
+        if end < begin:
+            if wanted:
+                output.append(())
+                beat_map[partnum] = ()
+                part_numbers.append(partnum)
+            continue
+        checkpoint = (begin // interval) * interval
+        text = ' '.join(source[bar[0]:bar[1]]
+                        for bar in bars[checkpoint:end + 1])
+        initial = info['checkpoints'].get(str(checkpoint))
+        tbon = MidiEvaluator(pitch_order=pitch_order, block_cache=None,
+                             initial_states={0: initial} if initial else None)
+        tbon.eval(text, verbosity=0)
+        offset = bars[checkpoint][2] - window_start
+        for m in clip_metas(tbon.meta_output, offset, length):
+            if m[0] == 'T':
+                if partnum == 1:
+                    meta.append(m)
+            elif not wanted:
+                continue
+            elif m[0] == 'K':
+                meta.append(m[:3] + (partnum - 1,))
+            elif m[0] == 'M':
+                meta.append(m[:4] + (partnum - 1,))
+            else:
+                meta.append(m[:3] + (partnum - 1,) + m[4:])
+        if not wanted:
+            continue
+        output.append(clip_notes(tbon.output[0], offset, length))
+        clicks.extend(clip_notes(tbon.metronome_output, offset, length))
+        part_numbers.append(partnum)
+        beat_map[partnum] = tbon.beat_map[1][begin - checkpoint:
+                                             end - checkpoint + 1]
+    return Excerpt(output, meta, tuple(clicks), beat_map, part_numbers)
+
+def clip_notes(notes, offset, length):
+    """
+    Return notes moved by offset and clipped to times 0 through length.
+    Notes outside the window are dropped.
+    """
+    clipped = []
+    for note in notes:
+        start, end = note[1] + offset, note[2] + offset
+        if end > 0 and start < length:
+            clipped.append((note[0], max(0, start), min(end, length))
+                           + tuple(note[3:]))
+    return tuple(clipped)
+
+def clip_metas(meta, offset, length):
+    """
+    Return the metas of one part moved by offset. Of the metas up to the
+    start of the window, only the last of each kind (and of instruments,
+    the last on each channel) is kept, moved to time 0. Metas after the
+    window are dropped.
+    """
+    current = {}
+    clipped = []
+    for m in sorted(meta, key=lambda m: m[1]):
+        time = m[1] + offset
+        if time <= 0:
+            current[m[0] if m[0] != 'I' else ('I', m[4])] = m
+        elif time < length:
+            clipped.append((m[0], time) + tuple(m[2:]))
+    return [(m[0], 0) + tuple(m[2:]) for m in current.values()] + clipped
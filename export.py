@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Streaming exporters for evaluated tbon: JSON Lines, CSV and
+             plain text event dumps.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import csv
+import json
+from heapq import merge
+
+## Columns of an exported event. Fields that don't apply to an event
+## are None (omitted from JSON, empty in CSV).
+FIELDS = ('event', 'part', 'start', 'end', 'pitch', 'velocity', 'channel',
+          'bpm', 'sharps', 'mode', 'numerator', 'denominator', 'instrument')
+
+def note_events(notes, part):
+    """
+    Yield note records. Rests and any source map column are skipped.
+    Notes evaluated with ignore_velocity have no velocity or channel.
+    """
+    for note in notes:
+        if note[0] is None:
+            continue
+        record = dict(event='note', part=part, start=note[1], end=note[2],
+                      pitch=note[0])
+        if len(note) >= 5:
+            record.update(velocity=note[3], channel=note[4])
+        yield record
+
+def meta_event(m):
+    """ Return the record for a meta_output tuple """
+    if m[0] == 'T':
+        return dict(event='tempo', start=m[1], bpm=m[2])
+    if m[0] == 'K':
+        return dict(event='key', part=m[3] + 1, start=m[1],
+                    sharps=m[2][0], mode='minor' if m[2][1] else 'major')
+    if m[0] == 'M':
+        return dict(event='meter', part=m[4] + 1, start=m[1],
+                    numerator=m[2], denominator=m[3])
+    return dict(event='instrument', part=m[3] + 1, start=m[1],
+                instrument=m[2], channel=m[4])
+
+def events(tbon, metronome=False):
+    """
+    Yield a record for every note and meta event of an evaluated
+    MidiEvaluator in order of start time. Each part's notes are already
+    in time order, so they are merged lazily rather than sorted
+    together. Metronome clicks are included as part 0 if metronome is
+    True. Metas of parts that weren't evaluated are left out.
+    """
+    parts = set(tbon.part_numbers)
+    metas = (meta_event(m) for m in tbon.meta_output)
+    ## Tempo metas apply to every part and have none.
+    streams = [sorted((e for e in metas if e.get('part', 0) in parts
+                       or 'part' not in e),
+                      key=lambda e: e['start'])]
+    for part, notes in zip(tbon.part_numbers, tbon.output):
+        streams.append(note_events(notes, part))
+    if metronome:
+        streams.append(note_events(tbon.metronome_output, 0))
+    return merge(*streams, key=lambda e: e['start'])
+
+def write_ndjson(records, outfile):
+    """ Write one JSON object per line """
+    for record in records:
+        outfile.write(json.dumps(record))
+        outfile.write('\n')
+
+def write_csv(records, outfile):
+    """ Write a header row and one row per record """
+    writer = csv.DictWriter(outfile, FIELDS)
+    writer.writeheader()
+    writer.writerows(records)
+
+def write_dump(records, outfile):
+    """ Write one readable line per record, e.g.
+          4.0000 note part=1 end=5.0 pitch=62 velocity=0.8 channel=1
+    """
+    for record in records:
+        fields = ' '.join('{}={}'.format(k, record[k]) for k in FIELDS[1:]
+                          if k in record and k != 'start')
+        outfile.write('{:10.4f} {} {}\n'.format(record['start'],
+                                               record['event'], fields))
+
+## Exporter name -> (writer, file extension). Writers take an iterable
+## of records and a text file object.
+EXPORTERS = {
+    'ndjson': (write_ndjson, '.ndjson'),
+    'csv': (write_csv, '.csv'),
+    'dump': (write_dump, '.txt'),
+}
+
+def register_exporter(name, writer, extension):
+    """ Add an export format. writer(records, outfile) does the writing. """
+    EXPORTERS[name] = (writer, extension)
+
+def export(tbon, outfile, fmt, metronome=False):
+    """
+    Stream the events of an evaluated MidiEvaluator to the specified
+    outfile name in format fmt, one of the EXPORTERS. Returns the name
+    written.
+    """
+    try:
+        writer = EXPORTERS[fmt][0]
+    except KeyError:
+        msg = "\nUnknown export format, '{}'. Must be one of {}."
+        raise ValueError(msg.format(fmt, ', '.join(sorted(EXPORTERS))))
+    with open(outfile, 'w', newline='') as output_file:
+        writer(events(tbon, metronome), output_file)
+    return outfile
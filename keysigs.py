@@ -117,3 +117,20 @@ KEYOFFSETS = {
 def key_offset_semitones(keyname):
     """ TBD """
     return KEYOFFSETS[keyname]
+
+def transpose_midisig(midisig, semitones, near=None):
+    """
+    Return the (sf, mi) key signature a transposition of semitones away
+    from midisig. Each semitone up adds 7 sharps, modulo 12. Of the
+    spellings between 7 flats and 7 sharps, the one with sf nearest to
+    near is chosen, by default the sf of midisig, so that octaves keep
+    the spelling. Ties go to the flatter key.
+    """
+    sf, mi = midisig
+    if near is None:
+        if semitones % 12 == 0:
+            return midisig
+        near = sf
+    base = (sf + 7 * semitones) % 12
+    spellings = [n for n in (base - 12, base) if n >= -7 and n <= 7]
+    return (min(spellings, key=lambda n: (abs(n - near), n)), mi)
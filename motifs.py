@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Melodic and rhythmic n-grams of evaluated tbon, for finding
+             a motif anywhere in a library whatever its key or tempo.
+             catalogue.py keeps them in an inverted index.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+from bisect import bisect_right
+from fractions import Fraction
+from pianoroll import bar_starts
+from tbon import compile_one
+
+## Notes in each n-gram of the index. A motif of fewer notes is found
+## from the starts of the n-grams.
+GRAM_NOTES = 5
+
+## Largest denominator of a duration ratio. Ratios are rounded to the
+## nearest fraction with no larger denominator.
+RATIO_DENOMINATOR = 12
+
+def melody(notes):
+    """
+    Return the sounding (pitch, start) pairs of a part in time order,
+    keeping only the highest pitch of notes that start together.
+    """
+    top = {}
+    for note in notes:
+        if note[0] is not None and note[0] > top.get(note[1], -1):
+            top[note[1]] = note[0]
+    return [(top[start], start) for start in sorted(top)]
+
+def ratio_text(ratio):
+    """ Return the text of a duration ratio, e.g. '1', '3/2' """
+    ratio = Fraction(ratio).limit_denominator(RATIO_DENOMINATOR)
+    return str(ratio)
+
+def tokens(line):
+    """
+    Return one token for each step of a melody, as from melody(). A
+    token holds the interval in semitones and, after the first, the
+    ratio of the step's time between onsets to the previous step's,
+    e.g. '2@1/2'. So the tokens don't depend on key or tempo.
+    """
+    out = []
+    for i in range(1, len(line)):
+        token = str(line[i][0] - line[i - 1][0])
+        if i > 1:
+            ioi = line[i][1] - line[i - 1][1]
+            previous = line[i - 1][1] - line[i - 2][1]
+            token += '@' + ratio_text(ioi / previous)
+        out.append(token)
+    return out
+
+def gram(line, position, notes=GRAM_NOTES):
+    """
+    Return the n-gram of the notes of line from position on, no more
+    than notes of them, as text. Its first token has no ratio, since
+    the note before position isn't part of it.
+    """
+    return ' '.join(tokens(line[position:position + notes]))
+
+def part_grams(notes, meter, beats):
+    """
+    Return (position, time, bar, beat, gram) for each note of a part
+    that begins an n-gram of two or more notes, where meter is the
+    part's sorted (time, numerator, denominator) time signatures and
+    beats its beat map, the number of beats in each bar. Bars and beats
+    are numbered from 0 as in the beat map, and beat counts the bar's
+    own beats, so in an eighth-note bar 2 is the third eighth note.
+    """
+    line = melody(notes)
+    nbars = len(beats)
+    starts = bar_starts(meter, nbars)
+    grams = []
+    for position in range(len(line) - 1):
+        time = line[position][1]
+        bar = min(max(bisect_right(starts, time) - 1, 0), nbars - 1)
+        step = (starts[bar + 1] - starts[bar]) / beats[bar]
+        grams.append((position, time, bar, (time - starts[bar]) / step,
+                      gram(line, position)))
+    return grams
+
+def motif_line(snippet, numeric=False):
+    """
+    Compile a tbon snippet, e.g. 'c d e c |', and return the melody of
+    its first part. A missing final barline is added. Raises ValueError
+    if the snippet is invalid or has fewer than two notes.
+    """
+    if not snippet.rstrip().endswith(('|', ':')):
+        snippet += ' |'
+    tbon = compile_one(snippet, numeric, midi=False)
+    if tbon.error is not None:
+        msg = "\nInvalid motif, '{}'. {}"
+        raise ValueError(msg.format(snippet, str(tbon.error).strip()))
+    line = melody(tbon.output[0]) if tbon.output else []
+    if len(line) < 2:
+        msg = "\nInvalid motif, '{}'. It needs two or more notes."
+        raise ValueError(msg.format(snippet))
+    return line
+
+def motif_grams(line, notes=GRAM_NOTES):
+    """
+    Return the (offset, gram) pairs whose postings, shifted back by
+    offset, all hold an occurrence of line. A line shorter than notes
+    gives one partial n-gram, to be matched as a prefix.
+    """
+    if len(line) < notes:
+        return [(0, gram(line, 0, notes))]
+    return [(offset, gram(line, offset, notes))
+            for offset in range(len(line) - notes + 1)]
@@ -13,17 +13,24 @@ Copyright 2017 Ellis & Grant, Inc.
 ## pylint: disable=too-many-statements, invalid-name
 ## pylint: disable=too-many-lines
 #######################################################################
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict, Counter, namedtuple
 import keysigs
 from parsimonious.grammar import Grammar
+from parsimonious.exceptions import ParseError, IncompleteParseError
 
 #pylint: disable=anomalous-backslash-in-string
-def parse(source):
-    """Parse tbon Source"""
-    grammar = Grammar(
-        """
+TBON_GRAMMAR = r"""
         score = wsc* music*
-        music = (partswitch*  bar+)+ wsc*
+        music = (partswitch*  ((wsc* include) / (wsc* startrepeat) / bar)+)+
+                wsc*
         partswitch = "P=" partnum
+        include = "{" filename "}"
+        filename = ~r"[^{}]+"
         wsc = comment / ws+
         comment = ws* ~r"/\*.*?\*/"s ws*
         bar = (wsc* (meta / beat) wsc+)+ barline
@@ -44,7 +51,9 @@ def parse(source):
         floatnum = ~r"\d*\.?\d+"i
         chnum = ~r"\d*\.?\d+"i
         beat = subbeat+
-        barline = "|" / ":"
+        barline = endrepeat / startrepeat / "|" / ":"
+        startrepeat = "|:"
+        endrepeat = ":|" ~r"(x[1-9][0-9]*)?"
         extendable = chord / roll / ornament / pitch / rest
         pitch = octave* alteration? pitchname
         chord = chordstart chorditem chorditem* rparen
@@ -73,10 +82,552 @@ def parse(source):
         pitchname = ~"[a-g1-7]"i
         ws = ~r"\s*"i
         """
-        )
-    return grammar.parse(source)
 #pylint: enable=anomalous-backslash-in-string
 
+## Default rule -> Grammar. Built on first use and shared by every
+## parse, since building the grammar costs more than parsing most
+## scores.
+_GRAMMARS = {}
+
+def grammar(rule='score'):
+    """ Return the tbon Grammar whose default rule is rule """
+    if rule not in _GRAMMARS:
+        _GRAMMARS[rule] = Grammar(TBON_GRAMMAR).default(rule)
+    return _GRAMMARS[rule]
+
+def parse(source):
+    """Parse tbon Source"""
+    return grammar().parse(source)
+
+def parse_bar(text):
+    """ Parse the text of one bar """
+    return grammar('bar').parse(text)
+
+class AstNode():
+    """
+    Compact node of the lowered parse tree. Whitespace and comments are
+    gone and the few values the evaluators need (numbers, key names,
+    pitches) are extracted once, so the evaluators never slice the source
+    text.
+
+      * expr_name = grammar rule name, used to dispatch evaluator methods
+      * value = pre-extracted value or None
+      * children = tuple of child AstNodes
+      * start, end = offsets of the node's text in the source
+    """
+    __slots__ = ('expr_name', 'value', 'children', 'start', 'end')
+
+    def __init__(self, expr_name, value=None, children=(), start=0, end=0):
+        self.expr_name = expr_name
+        self.value = value
+        self.children = children
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __repr__(self):
+        return "AstNode({!r}, {!r}, {} children)".format(
+            self.expr_name, self.value, len(self.children))
+
+## Rules that mean nothing to the evaluators.
+LOWER_DISCARD = frozenset(('wsc', 'comment', 'ws'))
+
+## Rules kept as interior or leaf nodes of the lowered tree.
+LOWER_KEEP = frozenset((
+    'score', 'bar', 'beat', 'subbeat', 'startrepeat',
+    'chordstart', 'chordhold', 'chordrest', 'rparen',
+    'rollstart', 'ornamentstart', 'rest', 'hold',
+))
+
+## Rules whose value is their text.
+LOWER_TEXT = frozenset(('barline',))
+
+## Rules of the form 'X=' value. Maps rule name to the conversion
+## applied to the text of the value.
+LOWER_META = {
+    'partswitch': int,
+    'include': str.strip,
+    'beatspec': str,
+    'key': str.strip,
+    'tempo': float,
+    'relativetempo': float,
+    'velocity': float,
+    'de_emphasis': float,
+    'channel': int,
+    'instrument': int,
+}
+
+## Rules whose octave marks, alteration and pitchname are folded
+## into a single value, (octave_shift, alteration, pitchname).
+LOWER_PITCH = frozenset(('pitch', 'chordpitch'))
+
+## Alteration symbols. None is a natural sign, which is not the same
+## as no alteration at all (0).
+ALTERATIONS = {
+    '𝄪': 2, '##': 2, '♯': 1, '#': 1,
+    '𝄫': -2, '@@': -2, '♭': -1, '@': -1,
+    '♮': None, '%': None,
+}
+
+def lower(tree):
+    """
+    Lower a parsimonious parse tree to a tree of AstNodes. Anonymous
+    nodes and rules without evaluator methods are spliced into their
+    parent so that the evaluators see the same sequence of method calls
+    on a much smaller tree.
+    """
+    nodes = []
+    _lower_into(tree, nodes)
+    if len(nodes) == 1:
+        ast = nodes[0]
+    else:
+        ast = AstNode('', children=tuple(nodes),
+                      start=tree.start, end=tree.end)
+    if ast.expr_name == 'score':
+        ast.children = group_repeats(ast.children)
+    return ast
+
+def _lower_into(node, out):
+    """ Append the lowered form of node to the list, out. """
+    name = node.expr_name
+    if name in LOWER_DISCARD:
+        return
+    if name in LOWER_KEEP:
+        children = []
+        for child in node.children:
+            _lower_into(child, children)
+        value = normalise_bar(node.text) if name == 'bar' else None
+        out.append(AstNode(name, value, tuple(children), node.start, node.end))
+    elif name in LOWER_TEXT:
+        out.append(AstNode(name, node.text, (), node.start, node.end))
+    elif name in LOWER_META:
+        value = LOWER_META[name](node.children[1].text)
+        out.append(AstNode(name, value, (), node.start, node.end))
+    elif name in LOWER_PITCH:
+        octaves, alteration, pitchname = node.children
+        shift = octaves.text.count('^') - octaves.text.count('/')
+        value = (shift, ALTERATIONS.get(alteration.text, 0), pitchname.text)
+        out.append(AstNode(name, value, (), node.start, node.end))
+    else:
+        for child in node.children:
+            _lower_into(child, out)
+
+def group_repeats(nodes):
+    """
+    Return the children of a score with repeated bars grouped into
+    repeat nodes. The value of a repeat node is the number of times
+    its bars are played.
+
+    A repeat opens after a bar ending with '|:' or at a standalone
+    '|:', and closes with a bar ending with ':|' (play twice) or
+    ':|xN' (play N times). A closing mark without an opening one
+    repeats from the start of the part or the end of the previous
+    repeat. Repeats may nest but may not contain part switches.
+    """
+    stack = [[]]
+    segment_start = 0
+    for node in nodes:
+        name = node.expr_name
+        if name == 'startrepeat':
+            stack.append([])
+            continue
+        if name == 'partswitch':
+            if len(stack) > 1:
+                msg = "\nRepeats can't contain part switches."
+                raise ValueError(msg)
+            segment_start = len(stack[0]) + 1
+        stack[-1].append(node)
+        if name != 'bar':
+            continue
+        mark = node.children[-1].value
+        if mark == '|:':
+            stack.append([])
+        elif mark.startswith(':|'):
+            count = int(mark[3:]) if len(mark) > 2 else 2
+            if len(stack) > 1:
+                body = stack.pop()
+            else:
+                body = stack[0][segment_start:]
+                del stack[0][segment_start:]
+            stack[-1].append(AstNode('repeat', count, tuple(body),
+                                     body[0].start, body[-1].end))
+            if len(stack) == 1:
+                segment_start = len(stack[0])
+    if len(stack) > 1:
+        msg = "\nRepeat start, '|:', without a matching end, ':|'."
+        raise ValueError(msg)
+    return tuple(stack[0])
+
+COMMENT = re.compile(r"/\*.*?\*/", re.S)
+
+def normalise_bar(text):
+    """
+    Return the text of a bar without comments and with each run of
+    whitespace reduced to a single space. Bars that normalise to the
+    same text evaluate the same way from the same state.
+    """
+    return ' '.join(COMMENT.sub(' ', text).split())
+
+## Top level tokens of a score for lower_bars().
+SCORE_TOKENS = re.compile(r"""
+      (?P<wsc>(?:\s+|/\*.*?\*/)+)
+    | (?P<include>\{[^{}]+\})
+    | (?P<word>(?:[^\s/{}]|/(?!\*))+)
+    """, re.S | re.X)
+PARTSWITCH = re.compile(r"P=[1-9][0-9]*$")
+BARLINE = re.compile(r"(\||:|\|:|:\|(x[1-9][0-9]*)?)$")
+## Every bar, include and repeat start contains one of these.
+UNIT_MARK = re.compile(r"[|:{]")
+
+def lower_bars(source):
+    """
+    Lower a score by splitting it into bars at the top level and parsing
+    each distinct bar only once, so scores that repeat bars many times
+    parse in time proportional to their distinct bars. Bars with the same
+    normalised text share their lowered children, whose offsets are
+    relative to the normalised text. The bar nodes themselves have the
+    offsets of the bar in source.
+
+    The splitter is a single regular expression scan, and each bar is
+    parsed on its own, so time is linear in the length of source and the
+    parser's memo table never holds more than one bar. Anything the
+    splitter doesn't understand, including every error, is handed to
+    lower_rest() at the start of the part switches and bars that follow
+    the last complete one. Raises ParseError as parse() would.
+    """
+    children = []
+    words = []
+    bar_start = gap_start = None
+    ## Where the whole grammar resumes if the rest isn't understood,
+    ## and how many children precede that point.
+    resume, keep = None, 0
+    pos = 0
+    for match in SCORE_TOKENS.finditer(source):
+        if match.start() != pos:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'wsc':
+            gap_start = match.start()
+            continue
+        text = match.group()
+        start, end = match.start(), match.end()
+        if resume is None:
+            resume, keep = start, len(children)
+        if words:
+            if kind != 'word':
+                break
+            words.append(text)
+            if BARLINE.match(text):
+                bar = lowered_bar(' '.join(words))
+                if bar is None:
+                    if not (words[0].startswith('P=') or
+                            any(UNIT_MARK.search(w) for w in words[:-1])):
+                        ## No part switch or other unit can end within
+                        ## these words, so the whole grammar fails at
+                        ## resume too.
+                        raise IncompleteParseError(source, resume,
+                                                   grammar().default_rule)
+                    break
+                children.append(AstNode('bar', bar.value, bar.children,
+                                        bar_start, end))
+                words = []
+                resume = None
+        elif kind == 'include':
+            children.append(AstNode('include', text[1:-1].strip(), (),
+                                    start, end))
+            resume = None
+        elif PARTSWITCH.match(text):
+            ## Part switches can't follow one another.
+            if children and children[-1].expr_name == 'partswitch':
+                break
+            children.append(AstNode('partswitch', int(text[2:]), (),
+                                    start, end))
+        elif text == '|:':
+            children.append(AstNode('startrepeat', None, (), start, end))
+            resume = None
+        elif BARLINE.match(text):
+            break
+        else:
+            ## Whitespace before the first bar belongs to the score.
+            if gap_start is None or not children:
+                bar_start = start
+            else:
+                bar_start = gap_start
+            words.append(text)
+        gap_start = None
+    else:
+        if pos == len(source) and resume is None:
+            return AstNode('score', None, group_repeats(children),
+                           0, len(source))
+    if resume is None:
+        resume, keep = pos, len(children)
+    return lower_rest(source, children[:keep], resume)
+
+def lower_rest(source, children, resume):
+    """
+    Return the lowered score whose first children, ending at offset
+    resume in source, have been lowered already. The rest is parsed with
+    the whole grammar from resume, which stops at the first unit that
+    doesn't parse, so an error costs little more than that unit. A rest
+    without a single barline, repeat start or include can't parse at all
+    and fails at resume without being parsed.
+    """
+    if not UNIT_MARK.search(source, resume):
+        raise IncompleteParseError(source, resume, grammar().default_rule)
+    ## Parse from the start if nothing precedes resume, so that leading
+    ## whitespace belongs to the score as usual.
+    tree = grammar().parse(source, pos=resume if children else 0)
+    rest = []
+    _lower_into(tree, rest)
+    rest = list(rest[0].children)
+    if children and rest and rest[0].expr_name == 'bar':
+        ## As in a whole parse, the whitespace before a bar is its own.
+        rest[0].start = children[-1].end
+    return AstNode('score', None, group_repeats(children + rest),
+                   0, len(source))
+
+def lowered_bar(text):
+    """
+    Return the lowered bar for normalised bar text, parsing it only if
+    it isn't in BAR_CACHE. Returns None if the text doesn't parse.
+    """
+    bar = BAR_CACHE.get(text)
+    if bar is None:
+        try:
+            bar = lower(parse_bar(text))
+        except ParseError:
+            return None
+        BAR_CACHE.put(text, bar)
+    return bar
+
+def as_ast(source, include_dir=None, share_bars=True, budget=None):
+    """
+    Return the lowered tree for source, which may be tbon text,
+    a parsimonious parse tree or an already lowered tree. Included
+    fragments are resolved relative to include_dir. If it is None,
+    includes aren't enabled and a source with one raises ValueError, so
+    text from a caller never reads files unless asked to. Lowered trees
+    are assumed to be resolved already. If share_bars is false, text is
+    always parsed as a whole so that every node has its offsets in
+    source. See lower_bars().
+    budget is a Budget whose includes limit applies, or None.
+    """
+    if isinstance(source, AstNode):
+        return source
+    if isinstance(source, str):
+        ast = lower_bars(source) if share_bars else lower(parse(source))
+    else:
+        ast = lower(source)
+    return resolve_includes(ast, include_dir, budget)
+
+class BlockCache():
+    """
+    A thread-safe least-recently-used cache holding at most maxsize
+    entries.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the value for key or None """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """ Store value, evicting the least recently used entry if full """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Empty the cache """
+        with self.lock:
+            self.entries.clear()
+
+## Lowered fragments keyed by the sha1 of their text.
+FRAGMENT_CACHE = BlockCache(256)
+
+## Lowered bars keyed by their normalised text. See lower_bars().
+BAR_CACHE = BlockCache(4096)
+
+## Evaluated blocks keyed by content and entry state. See
+## MidiEvaluator.block()
+BLOCK_CACHE = BlockCache(4096)
+
+## Lowered rules that MidiEvaluator evaluates as blocks.
+BLOCKS = frozenset(('include', 'repeat'))
+
+## Lowered rules whose evaluation MidiEvaluator caches, the blocks and
+## the bars themselves.
+CACHED = BLOCKS | frozenset(('bar',))
+
+def repeated_bars(ast):
+    """
+    Return the set of normalised bar texts that occur more than once in
+    the lowered tree, counting the bars of includes and repeats.
+    """
+    counts = Counter()
+    blocks = [ast]
+    while blocks:
+        for child in blocks.pop().children:
+            if child.expr_name == 'bar':
+                counts[child.value] += 1
+            elif child.expr_name in BLOCKS:
+                blocks.append(child)
+    return frozenset(text for text, count in counts.items() if count > 1)
+
+def resolve_includes(ast, include_dir, budget=None, _stack=(), _root=None,
+                     _used=None):
+    """
+    Return ast with each include node's children replaced by the lowered
+    bars of the included fragment. Include nodes only occur among the
+    children of the score. The value of each resolved include node is a
+    digest of the fragment text and of any fragments it includes, so it
+    identifies the content for the evaluators' block cache. Fragments,
+    and the fragments they include, must be inside include_dir, ''
+    for the current directory. If include_dir is None, includes aren't
+    enabled. The text of all fragments read counts against the includes
+    limit of budget, a Budget or None.
+    """
+    if not any(node.expr_name == 'include' for node in ast.children):
+        return ast
+    if include_dir is not None:
+        include_dir = include_dir or os.curdir
+    root = _root or (include_dir and os.path.realpath(include_dir))
+    ## Characters of fragment text read so far, shared by nested calls.
+    used = [0] if _used is None else _used
+    children = []
+    for node in ast.children:
+        if node.expr_name == 'include':
+            node = load_fragment(node, include_dir, _stack, root, budget,
+                                 used)
+        children.append(node)
+    return AstNode(ast.expr_name, ast.value, tuple(children),
+                   ast.start, ast.end)
+
+def fragment_path(name, include_dir, root):
+    """
+    Return the real path of the fragment name, relative to include_dir.
+    Raises ValueError if name is absolute or the path is outside root.
+    """
+    if os.path.isabs(name) or os.path.splitdrive(name)[0]:
+        msg = "\nInvalid include, '{}'. Include names must be relative."
+        raise ValueError(msg.format(name))
+    path = os.path.realpath(os.path.join(include_dir, name))
+    if os.path.commonpath([root, path]) != root:
+        msg = ("\nInvalid include, '{}'. Included files must be in {} "
+               "or below it.")
+        raise ValueError(msg.format(name, root))
+    return path
+
+def load_fragment(node, include_dir, stack, root, budget=None, used=None):
+    """
+    Read, parse and lower the fragment named by an include node.
+    Fragments are parsed once per distinct text. used is a one-item
+    list of the fragment characters read so far, for the budget.
+    """
+    if budget is not None and budget.includes == 0:
+        raise BudgetExceeded('includes', 0)
+    if include_dir is None:
+        msg = ("\nInvalid include, '{}'. Includes are not enabled without "
+               "an include directory.")
+        raise ValueError(msg.format(node.value))
+    path = fragment_path(node.value, include_dir, root)
+    if path in stack:
+        msg = "\nInclude cycle: {}"
+        raise ValueError(msg.format(' -> '.join(stack + (path,))))
+    with open(path) as infile:
+        if budget is not None and budget.includes is not None:
+            ## Read no more than the budget has left, plus one to tell.
+            text = infile.read(budget.includes - used[0] + 1)
+            used[0] += len(text)
+            check_limit(budget, 'includes', used[0])
+        else:
+            text = infile.read()
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    fragment = FRAGMENT_CACHE.get(digest)
+    if fragment is None:
+        ## The fragment's text isn't quoted, since it may not be tbon.
+        try:
+            fragment = lower_bars(text)
+        except ParseError as e:
+            msg = "\nInvalid include, '{}'. Line {} doesn't parse."
+            raise ValueError(msg.format(node.value, e.line()))
+        for child in fragment.children:
+            if child.expr_name == 'partswitch':
+                msg = ("\nInvalid include, '{}'. "
+                       "Included fragments can't switch parts.")
+                raise ValueError(msg.format(node.value))
+        FRAGMENT_CACHE.put(digest, fragment)
+    fragment = resolve_includes(fragment, os.path.dirname(path), budget,
+                                stack + (path,), root, used)
+    nested = [child.value for child in fragment.children
+              if child.expr_name == 'include']
+    if nested:
+        digest = hashlib.sha1(' '.join([digest] + nested).encode()).hexdigest()
+    return AstNode('include', digest, fragment.children, node.start, node.end)
+
+## Something in the source that evaluates but probably isn't what was
+## meant. part is the part number and start and end are the offsets of
+## the bar it's in, in the source or in an included fragment.
+EvalWarning = namedtuple('EvalWarning', 'message part start end')
+
+## Limits on the work a score may cause, for compiling untrusted input.
+## None means no limit.
+##   source_size -- characters of source text
+##   nodes -- lowered nodes walked, counting each repetition of a repeat
+##   subbeats_per_beat -- subbeats in any one beat
+##   notes_per_part -- notes and rests in any one part
+##   events -- notes and rests in all parts
+##   seconds -- wall-clock time to evaluate
+##   includes -- characters of included fragment text in all; 0 forbids
+##     includes, so that no file is read
+Budget = namedtuple('Budget', 'source_size nodes subbeats_per_beat '
+                    'notes_per_part events seconds includes',
+                    defaults=(None,))
+
+## Limits that no reasonable score comes near, for a public service.
+## Sources from the public can't read the server's files.
+SERVICE_BUDGET = Budget(source_size=1 << 20, nodes=2000000,
+                        subbeats_per_beat=64, notes_per_part=500000,
+                        events=2000000, seconds=10.0, includes=0)
+
+class BudgetExceeded(ValueError):
+    """
+    Raised when a score needs more than its Budget allows. budget is the
+    name of the limit that was exceeded and limit its value.
+    """
+    def __init__(self, budget, limit):
+        msg = "\nInvalid score. It exceeds the {} limit of {}."
+        super().__init__(msg.format(budget, limit))
+        self.budget = budget
+        self.limit = limit
+
+    def __reduce__(self):
+        return (BudgetExceeded, (self.budget, self.limit))
+
+def check_limit(budget, name, value):
+    """ Raise BudgetExceeded if value is over the named limit of budget """
+    limit = getattr(budget, name)
+    if limit is not None and value > limit:
+        raise BudgetExceeded(name, limit)
+
+def deadline(budget):
+    """ Return the monotonic time by which budget says to finish, or None """
+    if budget is None or budget.seconds is None:
+        return None
+    return time.monotonic() + budget.seconds
+
 ## Sub-beat tyoe constants
 NOTE = 0
 CHORD = 1
@@ -109,35 +660,95 @@ class MidiPreEvaluator():
     sub-beat durations for each beat.
     """
     #pylint: disable=dangerous-default-value
-    def __init__(self):
+    def __init__(self, pitch_order=None, initial_states=None, quiet=False,
+                 budget=None):
         self.first_tempo = 120
+        ## If true, warnings are only recorded in self.warnings.
+        self.quiet = quiet
+        ## Limits on the work the source may cause, or None. See Budget.
+        self.budget = budget
+        ## If given, pitch characters are validated against it.
+        self.pitch_order = pitch_order
+        ## Part index -> state to start the part in. See new_part_state().
+        self.initial_states = initial_states or {}
+        self.reset()
+    #pylint: enable=dangerous-default-value
+
+    def reset(self):
+        """ Clear the results of any previous evaluation """
         self.output = []
+        self.warnings = []
+        ## The bar being evaluated, for locating warnings.
+        self.current_bar = None
         self.meta_output = []
         self.beat_map = {1: []}
+        self.bar_starts = {1: []}
         self.beat_lengths = []
         self.subbeat_starts = []
         self.subbeat_lengths = []
         self.partstates = {0: self.new_part_state(0)}
         self.processing_state = self.partstates[0]
         self.current_part = 0
-    #pylint: enable=dangerous-default-value
+        self.node_count = 0
+        self.deadline = deadline(self.budget)
 
-    def eval(self, source, verbosity=2):
-        """Evaluate tbon source"""
-        node = parse(source) if isinstance(source, str) else source
-        method = getattr(self, node.expr_name, lambda node, children: children)
-        ## Recursively evaluate subtree
-        method(node, [self.eval(n, verbosity) for n in node])
-        self.show_progress(node, verbosity)
+    def eval(self, source, verbosity=2, include_dir=None):
+        """
+        Evaluate tbon source. Each call starts afresh, so one evaluator
+        can evaluate any number of sources in turn.
+        """
+        self.reset()
+        if self.budget is not None and isinstance(source, str):
+            check_limit(self.budget, 'source_size', len(source))
+        self.walk(as_ast(source, include_dir, budget=self.budget), verbosity)
         return self.output
 
+    def walk(self, node, verbosity):
+        """
+        Recursively evaluate the lowered tree, children first. The
+        children of repeat nodes are evaluated once per repetition.
+        """
+        if self.budget is not None:
+            self.count_node()
+        for _ in range(node.value if node.expr_name == 'repeat' else 1):
+            for child in node.children:
+                if child.expr_name == 'bar':
+                    self.current_bar = child
+                self.walk(child, verbosity)
+        method = getattr(self, node.expr_name, None)
+        if method is not None:
+            method(node, node.children)
+        self.show_progress(node, verbosity)
+
+    def count_node(self):
+        """
+        Count a node against the budget, checking the time too every
+        thousand or so nodes.
+        """
+        self.node_count += 1
+        check_limit(self.budget, 'nodes', self.node_count)
+        if not self.node_count & 1023 and self.deadline is not None:
+            if time.monotonic() > self.deadline:
+                raise BudgetExceeded('seconds', self.budget.seconds)
+
+    def warn(self, message):
+        """
+        Record a warning about the current bar, and print it unless
+        quiet.
+        """
+        self.warnings.append(EvalWarning(message, self.current_part + 1,
+                                         self.current_bar.start,
+                                         self.current_bar.end))
+        if not self.quiet:
+            print(message)
+
     def show_progress(self, node, verbosity):
         """ Call this *after* the node has been evaluated """
         if verbosity <= 0:
             return
 
-        if node.expr_name not in ('', 'ws', None):
-            print("Evaluated {}, '{}'".format(node.expr_name, node.text))
+        if node.expr_name:
+            print("Evaluated {}, '{}'".format(node.expr_name, node.value))
             print("output={}".format(self.output))
             if verbosity > 1:
                 print('state={}'.format(self.processing_state))
@@ -159,7 +770,7 @@ class MidiPreEvaluator():
 
     def partswitch(self, node, children):
         """ Switch to new part """
-        newpartnumber = int(node.children[1].text)
+        newpartnumber = node.value
         newpindex = newpartnumber - 1
         try:
             self.processing_state = self.partstates[newpindex]
@@ -168,12 +779,18 @@ class MidiPreEvaluator():
             pstate = self.new_part_state(newpindex)
             self.partstates[newpindex] = pstate
             self.processing_state = self.partstates[newpindex]
-            self.current_part = newpindex
             self.beat_map[newpartnumber] = []
+            self.bar_starts[newpartnumber] = []
+        self.current_part = newpindex
 
     def new_part_state(self, pindex):
-        """ Returns a new part state dict """
-        return dict(
+        """
+        Returns a new part state dict. If an initial state is given for
+        the part, e.g. from a checkpoint, its tempo, channel and beatspec
+        are used and its key and instrument are written as metas at the
+        start.
+        """
+        state = dict(
             basetempo=self.first_tempo,
             tempo=self.first_tempo,
             beat_index=0,
@@ -186,12 +803,24 @@ class MidiPreEvaluator():
             timesig=('M', 0.0, 4, 4, pindex),
             subbeat_lengths=[],
             subbeat_starts=[],
+            beat_lengths=[],
             )
+        initial = self.initial_states.get(pindex)
+        if initial:
+            for k in ('basetempo', 'tempo', 'channel', 'beatspec'):
+                state[k] = initial[k]
+            if initial['keyname'] != 'C':
+                sig = keysigs.MIDISIGS[initial['keyname']]
+                self.meta_output.append(('K', 0, sig, pindex))
+            if initial['instrument'] is not None:
+                self.meta_output.append(('I', 0, initial['instrument'],
+                                         pindex, initial['channel']))
+        return state
 
     def channel(self, node, children):
         """ Change the current channel """
         state = self.processing_state
-        newchannel = int(node.children[1].text)
+        newchannel = node.value
         if 1 <= newchannel <= 16:
             state['channel'] = newchannel
         else:
@@ -204,7 +833,7 @@ class MidiPreEvaluator():
         Change the midi instrument on the current track and channel.
         """
         state = self.processing_state
-        newinstrument = int(node.children[1].text)
+        newinstrument = node.value
         if 1 <= newinstrument <= 128:
             index = state['beat_index']
             state['instrument'] = newinstrument
@@ -216,11 +845,37 @@ class MidiPreEvaluator():
                    "Must be between 1 and 128, inclusive.")
             raise ValueError(msg.format(newinstrument))
 
+    def velocity(self, node, children):
+        """ Validate a velocity. Velocities don't affect timing. """
+        if not 0.0 <= node.value <= 1.0:
+            msg = ("\nInvalid velocity, '{}'. "
+                   "Must be between 0.0 and 1.0, inclusive")
+            raise ValueError(msg.format(node.value))
+
+    def de_emphasis(self, node, children):
+        """ Validate a de_emphasis. De-emphasis doesn't affect timing. """
+        if not 0.0 <= node.value <= 1.0:
+            msg = ("\nInvalid De-emphasis, '{}'. "
+                   "Must be between 0.0 and 1.0, inclusive.")
+            raise ValueError(msg.format(node.value))
+
+    def pitch(self, node, children):
+        """ Validate the pitch character if we know the pitch order """
+        if self.pitch_order is None:
+            return
+        pitchname = node.value[2]
+        if pitchname not in self.pitch_order:
+            msg = ("\nInvalid pitch character, '{}'. "
+                   "(Can't mix numeric and alpha pitches in same file.)")
+            raise ValueError(msg.format(pitchname))
+
+    chordpitch = pitch
+
     def tempo(self, node, children):
         """ Install a new tempo """
         if self.current_part == 0:
             state = self.processing_state
-            newtempo = int(round(float(node.children[1].text)))
+            newtempo = int(round(node.value))
             if newtempo > 1:
                 state['basetempo'] = state['tempo'] = newtempo
             else:
@@ -229,13 +884,13 @@ class MidiPreEvaluator():
                 raise ValueError(msg.format(newtempo))
             self.insert_tempo_meta(state)
         else:
-            print(
-                "Ignoring tempo spec in part {}.".format(self.current_part))
+            self.warn("Ignoring tempo spec in part {}.".format(
+                self.current_part + 1))
 
     def key(self, node, children):
         """ Insert a key signature """
         state = self.processing_state
-        keyname = node.children[1].text.strip()
+        keyname = node.value
         if keyname in keysigs.KEYSIGS.keys():
             self.processing_state['keyname'] = keyname
         else:
@@ -252,7 +907,7 @@ class MidiPreEvaluator():
         """ Adjust the current tempo without altering the base tempo """
         if self.current_part == 0:
             state = self.processing_state
-            xtempo = float(node.children[1].text)
+            xtempo = node.value
             if xtempo > 0.0:
                 state['tempo'] = int(round(xtempo * state['basetempo']))
             else:
@@ -261,8 +916,8 @@ class MidiPreEvaluator():
                 raise ValueError(msg.format(xtempo))
             self.insert_tempo_meta(state)
         else:
-            print(
-                "Ignoring tempo spec in part {}.".format(self.current_part))
+            self.warn("Ignoring tempo spec in part {}.".format(
+                self.current_part + 1))
 
     def beatspec(self, node, children):
         """
@@ -270,7 +925,7 @@ class MidiPreEvaluator():
         """
         state = self.processing_state
         oldbeatspec = state['beatspec']
-        newbeatspec = node.children[1].text
+        newbeatspec = node.value
         if oldbeatspec != newbeatspec:
             state['beatspec'] = newbeatspec
 
@@ -288,6 +943,8 @@ class MidiPreEvaluator():
         a beat.
         """
         state = self.processing_state
+        if self.budget is not None:
+            check_limit(self.budget, 'subbeats_per_beat', state['subbeats'])
         mult, numer = TIMESIG_LUT[state['beatspec']]
         #beat_length = 1
         beat_length = 4 * mult / numer
@@ -309,6 +966,7 @@ class MidiPreEvaluator():
             else:
                 self.insert_tempo_meta(state, index=0)
         state['subbeat_lengths'].append(subbeat_length)
+        state['beat_lengths'].append(beat_length)
         self.beat_lengths.append(beat_length)
 
     def barline(self, node, children):
@@ -319,6 +977,7 @@ class MidiPreEvaluator():
         mult, numer = TIMESIG_LUT[state['beatspec']]
         beat_length = 4 * mult / numer
         bar_index = state['beat_index'] - state['bar_beat_count'] * beat_length
+        self.bar_starts[partnum].append(bar_index)
         timesig = time_signature(state['beatspec'],
                                  state['bar_beat_count'],
                                  bar_index, self.current_part)
@@ -337,6 +996,24 @@ class MidiPreEvaluator():
 
 
 
+## Part state that affects the evaluation of whole bars.
+## See MidiEvaluator.block()
+BLOCK_ENTRY = ('keyname', 'octave', 'pitchname', 'beatspec',
+               'velocity', 'de_emphasis', 'channel', 'in_chord',
+               'chord_tone_count', 'prior_chord_tone_count')
+
+## Part state carried across bar boundaries. prior_chord_next_index is
+## reset by every chord before it is used, so it isn't part of the entry.
+BLOCK_STATE = BLOCK_ENTRY + ('prior_chord_next_index',)
+
+## Part state saved at a checkpoint, with the notes still sounding.
+## See MidiEvaluator.record_bar()
+CHECKPOINT_STATE = BLOCK_STATE + ('basetempo', 'tempo', 'instrument')
+
+def shifted(note, offset):
+    """ Return note as a tuple with its start and end moved by offset """
+    return (note[0], note[1] + offset, note[2] + offset) + tuple(note[3:])
+
 class MidiEvaluator():
     """
     Parses and evaluates a tbon source and produces a time-ordered list of
@@ -361,7 +1038,10 @@ class MidiEvaluator():
     format is
     [ ((p,s,e,v,c), ...), ((p,s,e,v,c), ...)),  ... ]
 
-    The top-level tuples are ordered by part number.
+    The top-level tuples are ordered by part number. If the constructor's
+    "parts" argument is given, only those part numbers are evaluated and
+    self.part_numbers lists the part number of each top-level tuple.
+    Meta events are still computed for every part.
 
     Other outputs:
     self.meta_output holds Tempo, Key and Time Signature events.
@@ -380,7 +1060,7 @@ class MidiEvaluator():
              numerator = denominator notes per measure
              denominator = one of [2, 4, 8, 16]
 
-    self.metronome_output. Tuples of metronome clicks in part 1, one per beat.
+    self.metronome_output. Tuples of metronome clicks, one per beat.
         * same format as note events (p,s,e,v,c).
         * channel is always 10,
         * velocity follows the music
@@ -388,18 +1068,67 @@ class MidiEvaluator():
         * other beats are low wood block (77)
 
     self.beat_map: List of number of beats in each measure
+
+    The output, metronome_output and beat_map products are computed
+    lazily the first time they are accessed, so callers pay only for
+    the products they use. The metronome in particular is built in one
+    pass from the beat timing and the bar structure found by the
+    MidiPreEvaluator.
     """
     def __init__(self,
                  pitch_order=tuple('cdefgab'),
-                 ignore_velocity=False):
+                 ignore_velocity=False,
+                 parts=None,
+                 block_cache=BLOCK_CACHE,
+                 initial_states=None,
+                 checkpoint_interval=None,
+                 source_map=False,
+                 quiet=False,
+                 budget=None):
         self.first_tempo = 120
+        ## If true, warnings are only recorded in self.warnings.
+        self.quiet = quiet
+        ## Limits on the work the source may cause, or None. See Budget.
+        self.budget = budget
         self.pitch_order = pitch_order
         self.ignore_velocity = ignore_velocity
+        ## If true, each note gets a last column with the (start, end)
+        ## offsets of the pitch or rest in the source that produced it.
+        self.source_map = source_map
+        ## Cache of evaluated blocks or None to evaluate every block.
+        ## Cached notes would carry the spans of the first occurrence and
+        ## cached bars aren't recorded for checkpoints, so there's no
+        ## caching with a source map or checkpoints.
+        self.block_cache = (None if source_map or checkpoint_interval
+                            else block_cache)
+        ## Part index -> state to start the part in, from a checkpoint.
+        self.initial_states = initial_states or {}
+        ## If given, self.bars records the source span and start and end
+        ## times of every bar, and self.checkpoints the part state at the
+        ## start of every checkpoint_interval'th bar. See record_bar().
+        self.checkpoint_interval = checkpoint_interval
+        ## Part numbers to evaluate or None for all parts.
+        self.parts = None if parts is None else frozenset(parts)
         self.pitch_midinumber = dict(zip(pitch_order, (0, 2, 4, 5, 7, 9, 11)))
-        self.output = []
-        self.metronome_output = []
+        self.pre_evaluator = MidiPreEvaluator(
+            initial_states=self.initial_states, quiet=quiet, budget=budget)
+        self.reset()
+
+    def reset(self):
+        """ Clear the results of any previous evaluation """
+        self.bars = {}
+        self.checkpoints = {}
+        ## Bar texts that recur in the score. Only these are cached, as
+        ## caching a bar costs more than walking it.
+        self.repeated_bars = frozenset()
+        self.skipping = False
+        self.warnings = []
+        self.deadline = deadline(self.budget)
+        self._output = None
+        self._metronome_output = None
+        self._beat_map = None
         self.meta_output = []
-        self.beat_map = ()
+        self.pre_beat_map = {}
         self.subbeat_starts = []
         self.subbeat_lengths = None
         self.beat_lengths = []
@@ -408,8 +1137,11 @@ class MidiEvaluator():
         self.current_part = None
 
     def new_part_state(self, newpartnumber):
-        """ Returns a new part state dict """
-        return dict(
+        """
+        Returns a new part state dict, started from the part's initial
+        state if one was given.
+        """
+        state = dict(
             notes=[],
             basetempo=self.first_tempo,
             tempo=self.first_tempo,
@@ -418,7 +1150,6 @@ class MidiEvaluator():
             bar_beat_index=0,
             bar_subbeats=0,
             octave=5, ## middle C, midi number 60
-            alteration=0,
             pitchname=self.pitch_order[0],
             bar_accidentals={},
             in_chord=NOTE,
@@ -426,46 +1157,179 @@ class MidiEvaluator():
             prior_chord_tone_count=0,
             prior_chord_next_index=0,
             keyname="C",
+            beatspec="4",
             velocity=0.8,
             de_emphasis=1.0,
+            ## (beat_index, velocity, de_emphasis) at each change.
+            dynamics=[(0, 0.8, 1.0)],
             channel=1,
+            instrument=None,
             output=[],
             )
+        initial = self.initial_states.get(newpartnumber)
+        if initial:
+            state.update((k, initial[k]) for k in CHECKPOINT_STATE)
+            state['notes'] = [list(note) for note in initial['notes']]
+            state['dynamics'] = [(0, state['velocity'], state['de_emphasis'])]
+        return state
+
+    def eval(self, source, verbosity=2, include_dir=None):
+        """
+        Evaluate tbon source. Each call starts afresh, so one evaluator
+        can evaluate any number of sources in turn.
+        """
+        self.reset()
+        if self.budget is not None and isinstance(source, str):
+            check_limit(self.budget, 'source_size', len(source))
+        ## Parse and lower once. Both passes walk the same tree.
+        ast = as_ast(source, include_dir, share_bars=not self.source_map,
+                     budget=self.budget)
+        self.repeated_bars = repeated_bars(ast)
+        ## Preprocess with the pre-evaluator, reused across calls.
+        mp = self.pre_evaluator
+        mp.eval(ast, verbosity=0)
+        self.subbeat_lengths = mp.subbeat_lengths
+        self.subbeat_starts = mp.subbeat_starts
+        self.beat_lengths = mp.beat_lengths
+        self.meta_output = mp.meta_output
+        self.pre_beat_map = mp.beat_map
+        self.warnings.extend(mp.warnings)
+        ## Update each partstate
+        pstates = self.partstates ## shorter name
+        for num, state in mp.partstates.items():
+            pstates[num] = self.new_part_state(num)
+            pstates[num]['subbeat_starts'] = state['subbeat_starts']
+            pstates[num]['subbeat_lengths'] = state['subbeat_lengths']
+            pstates[num]['beat_lengths'] = state['beat_lengths']
+        self.processing_state = pstates[0]
+        self.current_part = 0
+        self.skipping = not self.wanted(0)
+        #print("PreEval {}".format(mp.output))
 
-    def eval(self, source, verbosity=2):
-        """Evaluate tbon source"""
-        ## Preprocess once only.
-        if self.subbeat_lengths is None:
-            mp = MidiPreEvaluator()
-            mp.eval(source, verbosity=0)
-            self.subbeat_lengths = mp.subbeat_lengths
-            self.subbeat_starts = mp.subbeat_starts
-            self.beat_lengths = mp.beat_lengths
-            self.meta_output = mp.meta_output
-            self.beat_map = {k: tuple(v) for k, v in mp.beat_map.items()}
-            ## Update each partstate
-            pstates = self.partstates ## shorter name
-            for num, state in mp.partstates.items():
-                pstates[num] = self.new_part_state(num)
-                pstates[num]['subbeat_starts'] = state['subbeat_starts']
-                pstates[num]['subbeat_lengths'] = state['subbeat_lengths']
-            self.processing_state = pstates[0]
-            self.current_part = 0
-            #print("PreEval {}".format(mp.output))
-
-        node = parse(source) if isinstance(source, str) else source
-        method = getattr(self, node.expr_name, lambda node, children: children)
-        ## Recursively evaluate subtree
-        method(node, [self.eval(n, verbosity) for n in node])
-        self.show_progress(node, verbosity)
+        self.walk(ast, verbosity)
         return self.output
 
+    def walk(self, node, verbosity):
+        """
+        Recursively evaluate the lowered tree, children first. Everything
+        but part switches is skipped while in a part we don't want.
+        """
+        for child in node.children:
+            if self.skipping and child.expr_name != 'partswitch':
+                continue
+            if child.expr_name in CACHED:
+                self.evaluate_block(child, verbosity)
+                if self.budget is not None:
+                    self.check_budget()
+            else:
+                self.walk(child, verbosity)
+        method = getattr(self, node.expr_name, None)
+        if method is not None:
+            method(node, node.children)
+        self.show_progress(node, verbosity)
+
+    def check_budget(self):
+        """
+        Raise BudgetExceeded if the notes so far or the time taken are
+        over budget. Called after every bar and block.
+        """
+        check_limit(self.budget, 'notes_per_part',
+                    len(self.processing_state['output']))
+        check_limit(self.budget, 'events',
+                    sum(len(state['output'])
+                        for state in self.partstates.values()))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded('seconds', self.budget.seconds)
+
+    def evaluate_block(self, node, verbosity):
+        """
+        Included fragments and bars are cached across evaluations by
+        content, bars by their normalised text, so a bar that recurs
+        with the same entry state, as in percussion parts and ostinati,
+        is walked only once. The bars of a repeat are cached for the
+        repeat alone, so they're evaluated once per distinct entry
+        state, usually once or twice, and copied for the remaining
+        repetitions.
+        """
+        if node.expr_name == 'repeat':
+            cache = None if self.block_cache is None else BlockCache(4)
+            for _ in range(node.value):
+                self.block(node, verbosity, cache, ('repeat',))
+        elif node.expr_name == 'bar' and node.value not in self.repeated_bars:
+            self.walk(node, verbosity)
+        else:
+            key = (node.expr_name, node.value, self.pitch_order)
+            self.block(node, verbosity, self.block_cache, key)
+
+    def block(self, node, verbosity, cache, content_key):
+        """
+        Evaluate a block of whole bars, e.g. an included fragment.
+
+        The events a block produces depend only on its content and on
+        the part state when it starts, so the first evaluation is cached
+        as events relative to the block's start time. Later occurrences
+        with the same content and entry state copy the cached events,
+        shifted to their own start, instead of walking the bars again.
+        The state that matters at a bar boundary is the key, octave,
+        pitchname, beatspec, velocity, de_emphasis, channel, chord
+        counters and the notes still sounding from before the block.
+        """
+        state = self.processing_state
+        bindex = state['beat_index']
+        if cache is None or bindex >= len(state['subbeat_starts']):
+            self.walk(node, verbosity)
+            return
+        origin = state['subbeat_starts'][bindex][0]
+        key = content_key + self.block_entry(state, origin)
+        cached = cache.get(key)
+        if cached is None:
+            noutput = len(state['output'])
+            ndynamics = len(state['dynamics'])
+            self.walk(node, verbosity)
+            events = tuple(shifted(note, -origin)
+                           for note in state['output'][noutput:])
+            notes = tuple(shifted(note, -origin) for note in state['notes'])
+            dynamics = tuple((index - bindex, velocity, de_emphasis)
+                             for index, velocity, de_emphasis
+                             in state['dynamics'][ndynamics:])
+            exit_state = {k: state[k] for k in BLOCK_STATE}
+            nbeats = state['beat_index'] - bindex
+            cache.put(key, (events, notes, dynamics, exit_state, nbeats))
+        else:
+            events, notes, dynamics, exit_state, nbeats = cached
+            state['output'].extend(shifted(note, origin) for note in events)
+            state['notes'] = [list(shifted(note, origin)) for note in notes]
+            state['dynamics'].extend((index + bindex, velocity, de_emphasis)
+                                     for index, velocity, de_emphasis
+                                     in dynamics)
+            state.update(exit_state)
+            state['beat_index'] += nbeats
+
+    def block_entry(self, state, origin):
+        """
+        Return the hashable part of state that determines what a block
+        starting at time origin produces.
+        """
+        notes = tuple((note[0], round(note[1] - origin, 9),
+                       round(note[2] - origin, 9), note[3], note[4])
+                      for note in state['notes'])
+        return tuple(state[k] for k in BLOCK_ENTRY) + (notes,)
+
+    def wanted(self, pindex):
+        """ True if the part at pindex is to be evaluated """
+        return self.parts is None or pindex + 1 in self.parts
+
+    @property
+    def part_numbers(self):
+        """ The part number of each entry in self.output """
+        return [num + 1 for num in self.partstates if self.wanted(num)]
+
     def show_progress(self, node, verbosity):
-        """ Call this in self.eval() *after* the node has been evaluated """
+        """ Call this in self.walk() *after* the node has been evaluated """
         if verbosity <= 0:
             return
-        if node.expr_name not in ('', 'ws', None):
-            print("Evaluated {}, '{}'".format(node.expr_name, node.text))
+        if node.expr_name:
+            print("Evaluated {}, '{}'".format(node.expr_name, node.value))
             print("output={}".format(self.output))
             print("subbeat_lengths={}".format(self.subbeat_lengths))
             if verbosity > 1:
@@ -473,62 +1337,111 @@ class MidiEvaluator():
 
     def score(self, node, children):
         """
-        Add the last note or chord to the list,
-        Then convert output list items to tuples.
-        If we're ignoring velocity (and channel), the tuples are:
-            (pitch, start, end)
-        otherwise
-            (pitch, start, end, velocity, channel)
-
-        Finally, gather outputs for all parts.
+        Add the last note or chord to the list of each part and sort it
+        by start time. Conversion to the output tuples is deferred until
+        self.output is accessed.
         """
         for _, state in self.partstates.items():
             ## Add the last note or chord to the list,
             for note in state['notes']:
                 state['output'].append(note)
+            state['notes'] = []
 
             ## sort output by start time
             state['output'] = sorted(state['output'], key=lambda x: x[1])
+        self._output = None
+        self._metronome_output = None
 
-            ## Convert the music output
-            converted = []
-            for item in state['output']:
-                pitch = item[0]
-                start = item[1]
-                end = item[2]
-                velocity = item[3]
-                channel = item[4]
-                if self.ignore_velocity:
-                    converted.append((pitch, start, end))
-                else:
-                    converted.append((pitch, start, end,
-                                      velocity, channel))
-
-            state['output'] = converted
-
-        ## Convert the metronome output
-        converted = []
-
-        for item in self.metronome_output:
-            pitch = item[0]
-            start = item[1]
-            end = item[2]
-            velocity = item[3]
-            channel = 10 # MIDI Percussion channel
+    def convert(self, items):
+        """
+        Convert output list items to tuples.
+        If we're ignoring velocity (and channel), the tuples are:
+            (pitch, start, end)
+        otherwise
+            (pitch, start, end, velocity, channel)
+        With a source map, the (start, end) source span is appended.
+        """
+        if self.source_map:
             if self.ignore_velocity:
-                converted.append((pitch, start, end))
-            else:
-                converted.append((pitch, start, end, velocity, channel))
-
-        self.metronome_output = converted
-
-        ## Gather outputs from all parts
-        for _, d in self.partstates.items():
-            self.output.append(tuple(d['output']))
+                return tuple((item[0], item[1], item[2], item[5])
+                             for item in items)
+            return tuple((item[0], item[1], item[2], item[3], item[4],
+                          item[5]) for item in items)
+        if self.ignore_velocity:
+            return tuple((item[0], item[1], item[2]) for item in items)
+        return tuple((item[0], item[1], item[2], item[3], item[4])
+                     for item in items)
+
+    @property
+    def output(self):
+        """ Converted notes of all parts, ordered by part number """
+        if self._output is None:
+            self._output = [self.convert(state['output'])
+                            for num, state in self.partstates.items()
+                            if self.wanted(num)]
+        return self._output
+
+    @property
+    def beat_map(self):
+        """ Number of beats in each bar, keyed by part number """
+        if self._beat_map is None:
+            self._beat_map = {k: tuple(v)
+                              for k, v in self.pre_beat_map.items()}
+        return self._beat_map
+
+    @property
+    def metronome_output(self):
+        """ Metronome clicks for every beat of every part """
+        if self._metronome_output is None:
+            clicks = []
+            for num, state in self.partstates.items():
+                if not self.wanted(num):
+                    continue
+                clicks.extend(self.metronome_clicks(
+                    state, self.pre_beat_map.get(num + 1, ())))
+            if self.source_map:
+                ## Clicks don't come from the source.
+                clicks = [click + (None,) for click in clicks]
+            self._metronome_output = self.convert(clicks)
+        return self._metronome_output
+
+    def metronome_clicks(self, state, bar_beat_counts):
+        """
+        Return the metronome clicks for one part as (pitch, start, end,
+        velocity, channel) tuples. Downbeats of each bar are marked from
+        the bar_beat_counts and velocities follow the part's dynamics.
+        """
+        starts = [beat[0] for beat in state['subbeat_starts']]
+        lengths = state['beat_lengths']
+        nbeats = len(starts)
+        ## Velocity of each beat from the (index, velocity, de_emphasis)
+        ## changes recorded during evaluation.
+        downbeat_velocity = [0.0] * nbeats
+        offbeat_velocity = [0.0] * nbeats
+        dynamics = state['dynamics']
+        for i, (index, velocity, de_emphasis) in enumerate(dynamics):
+            try:
+                stop = dynamics[i + 1][0]
+            except IndexError:
+                stop = nbeats
+            count = stop - index
+            if count > 0:
+                downbeat_velocity[index:stop] = [velocity] * count
+                offbeat_velocity[index:stop] = [velocity * de_emphasis] * count
+        downbeats = [False] * nbeats
+        index = 0
+        for count in bar_beat_counts:
+            if index < nbeats:
+                downbeats[index] = True
+            index += count
+        return [(76, start, start + length, downbeat_velocity[i], 10)
+                if downbeats[i] else
+                (77, start, start + length, offbeat_velocity[i], 10)
+                for i, (start, length) in enumerate(zip(starts, lengths))]
 
     def partswitch(self, node, children):
         """ Switch to new part """
-        newpartnumber = int(node.children[1].text)
+        newpartnumber = node.value
         newpindex = newpartnumber - 1
         try:
             self.processing_state = self.partstates[newpindex]
@@ -538,39 +1451,41 @@ class MidiEvaluator():
             self.partstates[newpindex] = pstate
             self.processing_state = self.partstates[newpindex]
         self.current_part = newpindex
+        self.skipping = not self.wanted(newpindex)
 
     def tempo(self, node, children):
         """ Install a new tempo """
         if self.current_part == 0:
             state = self.processing_state
-            newtempo = float(node.children[1].text)
+            newtempo = node.value
             if newtempo > 1:
                 state['basetempo'] = state['tempo'] = newtempo
             else:
                 msg = ("\nInvalid Tempo, {}. "
                        "Tempo must be greater than 1.")
                 raise ValueError(msg.format(newtempo))
-        else:
-            print(
-                "Ignoring tempo spec in part {}.".format(self.current_part))
+        ## Else the MidiPreEvaluator has warned that it's ignored.
 
     def relativetempo(self, node, children):
         """ Adjust the current tempo without altering the base tempo """
         if self.current_part == 0:
             state = self.processing_state
-            newtempo = float(node.children[1].text)
+            newtempo = node.value
             assert newtempo != 0.0
             state['tempo'] = newtempo * state['basetempo']
-        else:
-            print(
-                "Ignoring tempo spec in part {}.".format(self.current_part))
+        ## Else the MidiPreEvaluator has warned that it's ignored.
+
+    def beatspec(self, node, children):
+        """ Track the beat note. Timing comes from the MidiPreEvaluator. """
+        self.processing_state['beatspec'] = node.value
 
     def velocity(self, node, children):
         """ Change the current velocity """
         state = self.processing_state
-        newvelocity = float(node.children[1].text)
+        newvelocity = node.value
         if 0.0 <= newvelocity <= 1.0:
             state['velocity'] = newvelocity
+            self.record_dynamics(state)
         else:
             msg = ("\nInvalid velocity, '{}'. "
                    "Must be between 0.0 and 1.0, inclusive")
@@ -579,7 +1494,7 @@ class MidiEvaluator():
     def channel(self, node, children):
         """ Change the current channel """
         state = self.processing_state
-        newchannel = int(node.children[1].text)
+        newchannel = node.value
         if 1 <= newchannel <= 16:
             state['channel'] = newchannel
         else:
@@ -590,40 +1505,59 @@ class MidiEvaluator():
     def de_emphasis(self, node, children):
         """ Change the current de_emphasis """
         state = self.processing_state
-        newde_emphasis = float(node.children[1].text)
+        newde_emphasis = node.value
         if 0.0 <= newde_emphasis <= 1.0:
             state['de_emphasis'] = 1.0 - newde_emphasis
+            self.record_dynamics(state)
         else:
             msg = ("\nInvalid De-emphasis, '{}'. "
                    "Must be between 0.0 and 1.0, inclusive.")
             raise ValueError(msg.format(newde_emphasis))
 
+    def record_dynamics(self, state):
+        """ Note a velocity or de_emphasis change for the metronome """
+        state['dynamics'].append((state['beat_index'],
+                                  state['velocity'],
+                                  state['de_emphasis']))
+
     def bar(self, node, children):
         """ Clear any accidentals """
         self.clear_bar_accidentals()
         state = self.processing_state
         state['bar_beat_index'] = 0
         state['bar_subbeats'] = 0
+        if self.checkpoint_interval:
+            self.record_bar(node, state)
 
-    def beat(self, node, children):
-        """ Update the beat indices and add to metronome_output"""
-        state = self.processing_state
-
-        ## Metronome
-        velocity = state['velocity']
-        channel = 10
-        if state['bar_beat_index'] == 0:
-            pitchnumber = 76
+    def record_bar(self, node, state):
+        """
+        Record the source span and times of the bar just finished and,
+        every checkpoint_interval bars, the state the next bar starts in.
+        Note times in a checkpoint are relative to the start of its bar.
+        """
+        partnum = self.current_part + 1
+        bars = self.bars.setdefault(partnum, [])
+        index = state['beat_index']
+        if index < len(state['subbeat_starts']):
+            end = state['subbeat_starts'][index][0]
         else:
-            pitchnumber = 77
-            velocity *= state['de_emphasis']
-        bindex = state['beat_index']
-        start = state['subbeat_starts'][bindex][0]
-        end = start + self.beat_lengths[bindex]
-        self.metronome_output.append([pitchnumber, start, end,
-                                      velocity, channel])
+            end = state['subbeat_starts'][-1][0] + state['beat_lengths'][-1]
+        start = bars[-1][3] if bars else 0.0
+        bars.append((node.start, node.end, start, end))
+        if len(bars) % self.checkpoint_interval == 0:
+            checkpoint = {k: state[k] for k in CHECKPOINT_STATE}
+            checkpoint['notes'] = [
+                [note[0], note[1] - end, note[2] - end] + list(note[3:])
+                for note in state['notes']]
+            self.checkpoints.setdefault(partnum, {})[len(bars)] = checkpoint
 
-        ## Update indices
+    def instrument(self, node, children):
+        """ Note the instrument for checkpoints. PE writes the meta. """
+        self.processing_state['instrument'] = node.value
+
+    def beat(self, node, children):
+        """ Update the beat indices """
+        state = self.processing_state
         state['subbeats'] = 0
         state['beat_index'] += 1
         state['bar_beat_index'] += 1
@@ -738,49 +1672,6 @@ class MidiEvaluator():
         state['chord_tone_count'] = 0
 
 
-    def octave_up(self, node, children):
-        """
-        Octave up adds 1 to the octave shift count for next pitch.
-        """
-        state = self.processing_state
-        state['octave'] += 1
-
-    def octave_down(self, node, children):
-        """
-        Octave down subtracts 1 from the octave shift count for next pitch.
-        """
-        state = self.processing_state
-        state['octave'] -= 1
-
-    def doublesharp(self, node, children):
-        """ Adds 1 to current pitch alteration count """
-        state = self.processing_state
-        state['alteration'] += 2
-
-    def sharp(self, node, children):
-        """ Adds 1 to current pitch alteration count """
-        state = self.processing_state
-        state['alteration'] += 1
-
-    def doubleflat(self, node, children):
-        """ Subtracts 1 from  current pitch alteration count """
-        state = self.processing_state
-        state['alteration'] -= 2
-
-    def flat(self, node, children):
-        """ Subtracts 1 from  current pitch alteration count """
-        state = self.processing_state
-        state['alteration'] -= 1
-
-    def natural(self, node, children):
-        """
-        Sets alteration count to None (not 0) so other code will
-        know to cancel any prior accidentals in the bar for next pitch.
-        """
-        state = self.processing_state
-        state['alteration'] = None
-
-
     def rest(self, node, children):
         """  rest = "z"
         Encountering a rest triggers the following actions:
@@ -805,41 +1696,40 @@ class MidiEvaluator():
             state['bar_subbeats'] += 1
             state['chord_tone_count'] = 0
             state['prior_chord_tone_count'] = 0
-        state['notes'].append([None, start, end,
-                               state['velocity'],
-                               state['channel'],
-                              ])
-
-    def pitchname(self, node, children):
-        """  pitchname = ~"[a-g]"i
-        Encountering a pitchname triggers the following actions:
-          * Close the preceding note
-          * Open a new one
+        newnote = [None, start, end, state['velocity'], state['channel']]
+        if self.source_map:
+            newnote.append((node.start, node.end))
+        state['notes'].append(newnote)
+
+    def pending_note(self, state, value):
+        """
+        Prepare the midi pitch for a pitch or chordpitch node. The value
+        is the (octave_shift, alteration, pitchname) extracted by lower().
           * Look up the midi pitch
             * Adjust relative to prior pitch
           * Apply octave and alterations
-          * Insert new midi pitch into current note (the new one)
-          * Empty the current alteration and octave accumulators
+          * Store the new midi pitch, velocity and channel as the
+            pending note
         TODO Relative pitch needs work.
         """
-        state = self.processing_state
-        pitchname = node.text.strip()
+        octave_shift, alteration, pitchname = value
         if pitchname not in self.pitch_order:
             ## User is trying to mix alpha and numeric pitches
             msg = ("\nInvalid pitch character, '{}'. "
                    "(Can't mix numeric and alpha pitches in same file.)")
             msg = msg.format(pitchname)
             raise ValueError(msg)
+        state['octave'] += octave_shift
         state['octave'] += self.octave_change(state['pitchname'], pitchname)
 
-        if state['alteration'] != 0:
+        if alteration != 0:
             ## Check for None which indicatas a natural sign.
-            if state['alteration'] is None:
-                state['alteration'] = 0
+            if alteration is None:
+                alteration = 0
             ## Update the bar accidentals dict
             self.set_bar_accidental(pitchname,
                                     state['octave'],
-                                    state['alteration'])
+                                    alteration)
         alteration = self.get_bar_accidental(pitchname, state['octave'])
         ## For numeric pitchnames the 'alteration' above includes an
         ## offset that maps 1 to the tonic of the current key.
@@ -852,7 +1742,6 @@ class MidiEvaluator():
         else:
             velocity = state['velocity'] * state['de_emphasis']
 
-        state['alteration'] = 0
         state['pitchname'] = pitchname
         channel = state['channel']
         state['pending_note'] = (pitchnumber,
@@ -863,6 +1752,7 @@ class MidiEvaluator():
         Deal with non-chord tones.
         """
         state = self.processing_state
+        self.pending_note(state, node.value)
         index = state['beat_index']
         duration = state['subbeat_lengths'][index]
         #start = state['subbeat_starts'][part][index][state['subbeats']]
@@ -875,23 +1765,25 @@ class MidiEvaluator():
 
         end = start + duration
         pitchnumber, velocity, channel = state['pending_note']
+        newnote = [pitchnumber, start, end, velocity, channel]
+        if self.source_map:
+            newnote.append((node.start, node.end))
         if not state['in_chord']:
             state['notes'] = []
             state['subbeats'] += 1
             state['bar_subbeats'] += 1
-            state['notes'].append([pitchnumber, start, end,
-                                   velocity, channel])
+            state['notes'].append(newnote)
             state['chord_tone_count'] = 0
             state['prior_chord_tone_count'] = 1
         elif state['in_chord'] in (ROLL, ORNAMENT):
             ## Rolls and Ornaments
-            state['notes'].append([pitchnumber, start, end,
-                                   velocity, channel])
+            state['notes'].append(newnote)
             state['chord_tone_count'] += 1
 
     def chordpitch(self, node, children):
         """ Deal with chord tones """
         state = self.processing_state
+        self.pending_note(state, node.value)
         index = state['beat_index']
         duration = state['subbeat_lengths'][index]
         pitchnumber, velocity, channel = state['pending_note']
@@ -899,6 +1791,8 @@ class MidiEvaluator():
         end = start + duration
         newnote = [pitchnumber, start, end,
                    velocity, channel]
+        if self.source_map:
+            newnote.append((node.start, node.end))
         pchindex = state['prior_chord_next_index']
         try:
             ## Replace if possible, left to right
@@ -919,7 +1813,11 @@ class MidiEvaluator():
         newend = state['subbeat_starts'][index][state['subbeats']] + duration
         if state['in_chord'] in (CHORD,):
             index = state['prior_chord_next_index']
-            state['notes'][index][2] = newend
+            try:
+                state['notes'][index][2] = newend
+            except IndexError:
+                msg = "\nInvalid chord hold. Not enough notes in prior chord."
+                raise ValueError(msg)
             state['prior_chord_next_index'] += 1
             state['prior_chord_tone_count'] -= 1
             state['chord_tone_count'] += 1
@@ -959,18 +1857,18 @@ class MidiEvaluator():
         end = start + duration
         newnote = [pitchnumber, start, end,
                    velocity, channel]
+        if self.source_map:
+            newnote.append((node.start, node.end))
         pchindex = state['prior_chord_next_index']
         try:
             ## Replace if possible, left to right
             state['output'].append(state['notes'][pchindex])
             state['notes'][pchindex] = newnote
             state['prior_chord_next_index'] += 1
-            print("Replaced with rest.")
             state['chord_tone_count'] += 1
         except IndexError:
-            msg = "Not enough notes in prior chord."
-            print(msg)
-            raise
+            msg = "\nInvalid chord rest. Not enough notes in prior chord."
+            raise ValueError(msg)
 
     def pitchname_interval_ascending(self, pname0, pname1):
         """
@@ -1005,9 +1903,9 @@ class MidiEvaluator():
 
         return result
 
-    def keyname(self, node, children):
+    def key(self, node, children):
         """ Install new keyname """
-        kn = node.text.strip()
+        kn = node.value
         if kn in keysigs.KEYSIGS.keys():
             self.processing_state['keyname'] = kn
         else:
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Piano-roll views of evaluated tbon as SVG or PNG, with a
+             colour per part, bar lines from the time signatures and the
+             beat map overlaid. Notes are found through an interval index,
+             so a view of a few bars of a long score only visits the notes
+             it shows, and views with more notes than pixels are drawn
+             from a pixel grid rather than note by note.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+import re
+import zlib
+import struct
+from bisect import bisect_right
+from collections import namedtuple
+from sourcemap import IntervalIndex
+
+## Part colours, cycled for parts beyond the last.
+COLOURS = ('#1f77b4', '#d62728', '#2ca02c', '#ff7f0e', '#9467bd',
+           '#8c564b', '#e377c2', '#17becf', '#bcbd22', '#7f7f7f')
+BACKGROUND = '#ffffff'
+BLACK_KEY_ROW = '#f0f0f0'
+BARLINE = '#999999'
+BEAT_TICK = '#cccccc'
+
+## Margins in pixels. The top margin holds the beat map.
+LEFT, TOP = 30, 24
+
+## Least spacing in pixels of bar lines and beat ticks, and of labels.
+MIN_GAP, LABEL_GAP = 3, 40
+
+## Pitch classes of the black keys.
+BLACK_KEYS = frozenset((1, 3, 6, 8, 10))
+
+## What a view draws, in pixels. rects are (x, y, width, height,
+## colour), lines are (x, y1, y2, colour) and labels are (x, y, text).
+Drawing = namedtuple('Drawing', 'width height rects lines labels')
+
+class PianoRoll():
+    """
+    Piano-roll renderer for an evaluated score, a MidiEvaluator or
+    anything with the same output, part_numbers, meta_output and
+    beat_map, such as a tbon.Compiled result. Bars are numbered from 0
+    as in the beat map and labelled from firstbar.
+    """
+    def __init__(self, tbon, firstbar=0):
+        self.firstbar = firstbar
+        self.part_numbers = list(tbon.part_numbers)
+        self.beat_map = tbon.beat_map
+        ## One index of sounding notes per part.
+        self.indexes = [IntervalIndex((note[1], note[2], note)
+                                      for note in notes
+                                      if note[0] is not None)
+                        for notes in tbon.output]
+        self.bar_starts = {}
+        for partnum in self.part_numbers:
+            sigs = sorted((m[1], m[2], m[3]) for m in tbon.meta_output
+                          if m[0] == 'M' and m[4] == partnum - 1)
+            self.bar_starts[partnum] = bar_starts(
+                sigs, len(self.beat_map.get(partnum, ())))
+
+    def bar_times(self, first_bar=0, last_bar=None, partnum=None):
+        """
+        Return the start time of first_bar and the end time of last_bar,
+        numbered from 0 as in the beat map of partnum, by default the
+        first part. last_bar defaults to the last bar.
+        """
+        starts = self.bar_starts[partnum or self.part_numbers[0]]
+        last_bar = len(starts) - 2 if last_bar is None else last_bar
+        if not 0 <= first_bar <= last_bar < len(starts) - 1:
+            msg = "\nInvalid bar range, {}:{}. The part has bars 0 to {}."
+            raise ValueError(msg.format(first_bar, last_bar,
+                                        len(starts) - 2))
+        return starts[first_bar], starts[last_bar + 1]
+
+    def draw(self, first_bar=0, last_bar=None, low=None, high=None,
+             width=1200, height=600):
+        """
+        Return the Drawing of bars first_bar through last_bar and midi
+        pitches low through high, by default those of the visible notes.
+        """
+        start, end = self.bar_times(first_bar, last_bar)
+        visible = [index.overlapping(start, end) for index in self.indexes]
+        pitches = [note[0] for notes in visible for note in notes]
+        if low is None:
+            low = min(pitches, default=60) - 1
+        if high is None:
+            high = max(pitches, default=72) + 1
+        plot_width, plot_height = width - LEFT, height - TOP
+        xscale = plot_width / (end - start)
+        row = plot_height / (high - low + 1)
+        def x_at(time):
+            return LEFT + (time - start) * xscale
+        def y_at(pitch):
+            return TOP + (high - pitch) * row
+        rects = []
+        if row >= 2:
+            rects = [(LEFT, y_at(p), plot_width, row, BLACK_KEY_ROW)
+                     for p in range(low, high + 1) if p % 12 in BLACK_KEYS]
+        lines = []
+        labels = []
+        ## Bar lines and the beat map of each part, first part on top.
+        ## Bar lines, labels and ticks closer than a few pixels to the
+        ## last one drawn are left out.
+        for pindex, partnum in enumerate(self.part_numbers):
+            starts = self.bar_starts[partnum]
+            beats = self.beat_map.get(partnum, ())
+            tick = (pindex + 1) * TOP / (len(self.part_numbers) + 1)
+            first = max(bisect_right(starts, start) - 1, 0)
+            last_line = last_label = last_tick = -LEFT
+            for bar in range(first, len(starts) - 1):
+                bar_start, bar_end = starts[bar], starts[bar + 1]
+                if bar_start >= end:
+                    break
+                x = x_at(bar_start)
+                if pindex == 0 and x - last_line >= MIN_GAP:
+                    lines.append((x, TOP, height, BARLINE))
+                    last_line = x
+                    if x - last_label >= LABEL_GAP:
+                        labels.append((x + 2, TOP + 10,
+                                       "{}:{}".format(bar + self.firstbar,
+                                                     beats[bar])))
+                        last_label = x
+                step = (bar_end - bar_start) / beats[bar]
+                for beat in range(beats[bar]):
+                    x = x_at(bar_start + beat * step)
+                    if x - last_tick >= MIN_GAP:
+                        lines.append((x, tick - 2, tick + 2, BEAT_TICK))
+                        last_tick = x
+        for pindex, notes in enumerate(visible):
+            colour = COLOURS[pindex % len(COLOURS)]
+            notes = [n for n in notes if low <= n[0] <= high]
+            if len(notes) > plot_width:
+                rects.extend(decimated(notes, x_at, y_at, row, plot_width,
+                                       colour))
+            else:
+                for note in notes:
+                    x = max(x_at(note[1]), LEFT)
+                    x2 = min(x_at(note[2]), width)
+                    rects.append((x, y_at(note[0]), max(x2 - x, 1), row,
+                                  colour))
+        return Drawing(width, height, rects, lines, labels)
+
+    def svg(self, first_bar=0, last_bar=None, low=None, high=None,
+            width=1200, height=600):
+        """ Return the view as SVG text. Arguments are as for draw(). """
+        return to_svg(self.draw(first_bar, last_bar, low, high,
+                                width, height))
+
+    def png(self, first_bar=0, last_bar=None, low=None, high=None,
+            width=1200, height=600):
+        """
+        Return the view as PNG bytes. Arguments are as for draw(). The
+        beat map is shown by its ticks alone, since PNGs have no text.
+        """
+        return to_png(self.draw(first_bar, last_bar, low, high,
+                                width, height))
+
+def bar_starts(sigs, nbars):
+    """
+    Return the start times of nbars bars and the end of the last, from
+    a part's sorted (time, numerator, denominator) time signatures. Each
+    signature's bars last numerator * 4 / denominator quarter notes and
+    run until the next signature.
+    """
+    starts = []
+    time = 0.0
+    for i, (sig_time, numerator, denominator) in enumerate(sigs):
+        time = sig_time
+        length = numerator * 4.0 / denominator
+        until = sigs[i + 1][0] if i + 1 < len(sigs) else None
+        while len(starts) < nbars and (until is None or time < until - 1e-9):
+            starts.append(time)
+            time += length
+    starts.append(time)
+    return starts
+
+def decimated(notes, x_at, y_at, row, plot_width, colour):
+    """
+    Return rectangles covering the pixels the notes sound in, one per
+    run of columns in each pixel row, so that drawing costs no more than
+    the pixels the notes cover.
+    """
+    columns = int(plot_width) + 1
+    height = max(row, 1)
+    grid = {}
+    for note in notes:
+        y = int(y_at(note[0]))
+        cells = grid.get(y)
+        if cells is None:
+            cells = grid[y] = bytearray(columns)
+        first = min(max(int(x_at(note[1]) - LEFT), 0), columns - 1)
+        last = min(max(int(x_at(note[2]) - LEFT), first + 1), columns)
+        cells[first:last] = b'\x01' * (last - first)
+    rects = []
+    for y, cells in grid.items():
+        for run in re.finditer(b'\x01+', cells):
+            rects.append((LEFT + run.start(), y, run.end() - run.start(),
+                          height, colour))
+    return rects
+
+def to_svg(drawing):
+    """ Return the SVG text of a Drawing """
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}" '
+           'height="{1}" viewBox="0 0 {0} {1}">'.format(drawing.width,
+                                                         drawing.height),
+           '<rect width="100%" height="100%" fill="{}"/>'.format(BACKGROUND)]
+    for x, y, w, h, colour in drawing.rects:
+        out.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" '
+                   'height="{:.1f}" fill="{}"/>'.format(x, y, w, h, colour))
+    for x, y1, y2, colour in drawing.lines:
+        out.append('<line x1="{0:.1f}" y1="{1:.1f}" x2="{0:.1f}" '
+                   'y2="{2:.1f}" stroke="{3}"/>'.format(x, y1, y2, colour))
+    for x, y, text in drawing.labels:
+        out.append('<text x="{:.1f}" y="{:.1f}" font-size="9" '
+                   'font-family="sans-serif">{}</text>'.format(x, y, text))
+    out.append('</svg>\n')
+    return '\n'.join(out)
+
+def to_png(drawing):
+    """ Return the PNG bytes of a Drawing, an 8-bit RGB image """
+    width, height = drawing.width, drawing.height
+    canvas = bytearray(rgb(BACKGROUND) * (width * height))
+    def fill(x, y, w, h, colour):
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        x1 = min(max(int(x + w), x0 + 1), width)
+        y1 = min(max(int(y + h), y0 + 1), height)
+        if x1 <= x0:
+            return
+        span = rgb(colour) * (x1 - x0)
+        for line in range(y0, y1):
+            offset = 3 * (line * width + x0)
+            canvas[offset:offset + len(span)] = span
+    for rect in drawing.rects:
+        fill(*rect)
+    for x, y1, y2, colour in drawing.lines:
+        fill(x, y1, 1, y2 - y1, colour)
+    stride = 3 * width
+    raw = b''.join(b'\x00' + bytes(canvas[y * stride:(y + 1) * stride])
+                   for y in range(height))
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                       8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw)) +
+            chunk(b'IEND', b''))
+
+def rgb(colour):
+    """ Return the bytes of a '#rrggbb' colour """
+    return bytes.fromhex(colour[1:])
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Key-parametric numeric scores. A .tbn score is evaluated
+             once into a key-relative form, then instantiated in any key
+             of the same mode without evaluating it again.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+from bisect import bisect_right
+import keysigs
+from tbon import Compiled, evaluate, make_midi
+
+## (sf, mi) -> key name. Every key name has a signature of its own.
+KEYNAMES = {sig: name for name, sig in keysigs.MIDISIGS.items()}
+
+## One key for each of the 12 tonics, by mode.
+TWELVE_KEYS = {
+    0: ('C', 'D@', 'D', 'E@', 'E', 'F', 'F#', 'G', 'A@', 'A', 'B@', 'B'),
+    1: ('c', 'c#', 'd', 'e@', 'e', 'f', 'f#', 'g', 'g#', 'a', 'b@', 'b'),
+}
+
+def check_keyname(keyname):
+    """ Raise ValueError unless keyname is a key tbon knows """
+    if keyname not in keysigs.KEYSIGS:
+        msg = "\nInvalid key name, '{}'. Must be one of {}."
+        raise ValueError(msg.format(keyname,
+                                    ', '.join(sorted(keysigs.KEYSIGS))))
+
+class KeyRelative():
+    """
+    An evaluated numeric score with each note's pitch stored relative to
+    the tonic of the key it was played in.
+
+    Numeric pitches are placed by adding key_offset_semitones() of the
+    current key to a pitch that depends only on degrees, octave marks,
+    accidentals and, for minor keys, the mode. So a note played in key k
+    would be played in key k2 of the same mode key_offset_semitones(k2)
+    - key_offset_semitones(k) semitones away, wrapping as the offsets
+    do.
+
+      * tbon = a MidiEvaluator that evaluated numeric source, or a
+        tbon.Compiled result of one
+    """
+    def __init__(self, tbon):
+        if getattr(tbon, 'pitch_order', '1')[0] != '1':
+            raise ValueError("\nOnly numeric scores can change key.")
+        self.meta_output = tbon.meta_output
+        self.metronome_output = tbon.metronome_output
+        self.beat_map = tbon.beat_map
+        self.part_numbers = tbon.part_numbers
+        self.warnings = list(getattr(tbon, 'warnings', None) or ())
+        ## Part index -> sorted key change times and key names.
+        changes = {}
+        for m in sorted((m for m in self.meta_output if m[0] == 'K'),
+                        key=lambda m: m[1]):
+            times, names = changes.setdefault(m[3], ([], []))
+            times.append(m[1])
+            names.append(KEYNAMES[m[2]])
+        self.key_changes = changes
+        first = changes.get(self.part_numbers[0] - 1) \
+            if self.part_numbers else None
+        self.home = first[1][0] if first and first[0][0] == 0 else 'C'
+        ## For each part, the keys played in and, per note, the pitch
+        ## relative to its key's tonic and the index of that key.
+        self.keys = []
+        self.relative = []
+        for partnum, notes in zip(self.part_numbers, tbon.output):
+            times, names = changes.get(partnum - 1, ([], []))
+            keys = ['C'] + names
+            offsets = [keysigs.key_offset_semitones(k) for k in keys]
+            relative = []
+            for note in notes:
+                index = bisect_right(times, note[1])
+                pitch = note[0]
+                if pitch is not None:
+                    pitch -= offsets[index]
+                relative.append((pitch, index) + tuple(note[1:]))
+            self.keys.append(keys)
+            self.relative.append(relative)
+
+    def key_map(self, keyname):
+        """
+        Return a function mapping each key of the score to the key it is
+        played in when the score is instantiated in keyname. The home
+        key, the key the first part starts in, becomes keyname, and the
+        others move by the same interval, spelled with as many more
+        sharps or flats as keyname has than the home key.
+        """
+        check_keyname(keyname)
+        home = keysigs.MIDISIGS[self.home]
+        if keysigs.MIDISIGS[keyname][1] != home[1]:
+            mode = 'minor' if home[1] else 'major'
+            msg = ("\nInvalid key, '{}'. The score is in {}, so it can "
+                   "only be instantiated in {} keys.")
+            raise ValueError(msg.format(keyname, self.home, mode))
+        interval = (keysigs.key_offset_semitones(keyname) -
+                    keysigs.key_offset_semitones(self.home))
+        ## Other keys are respelled as the home key is, e.g. C# becomes
+        ## D@ when F# becomes G@.
+        shift = keysigs.MIDISIGS[keyname][0] - home[0]
+        def mapped(key):
+            if key == self.home:
+                return keyname
+            sig = keysigs.MIDISIGS[key]
+            return KEYNAMES[keysigs.transpose_midisig(sig, interval,
+                                                      sig[0] + shift)]
+        return mapped
+
+    def instantiate(self, keyname):
+        """
+        Return the score as played in keyname, as a tbon.Compiled result
+        with the key signatures updated, e.g. for make_midi(). Each
+        part's notes are shifted in one pass. Raises ValueError if
+        keyname has a different mode from the score or a pitch leaves
+        the MIDI range.
+        """
+        mapped = self.key_map(keyname)
+        output = []
+        for keys, relative in zip(self.keys, self.relative):
+            offsets = [keysigs.key_offset_semitones(mapped(k)) for k in keys]
+            notes = tuple((None if n[0] is None else n[0] + offsets[n[1]],)
+                          + n[2:] for n in relative)
+            if any(n[0] is not None and not 0 <= n[0] <= 127 for n in notes):
+                msg = "\nIn {}, pitches leave the MIDI range 0 to 127."
+                raise ValueError(msg.format(keyname))
+            output.append(notes)
+        meta = [m[:2] + (keysigs.MIDISIGS[mapped(KEYNAMES[m[2]])],) + m[3:]
+                if m[0] == 'K' else m for m in self.meta_output]
+        ## Parts that start in C have no key signature of their own.
+        start = keysigs.MIDISIGS[mapped('C')]
+        if mapped('C') != 'C':
+            for partnum in reversed(self.part_numbers):
+                times = self.key_changes.get(partnum - 1, ([],))[0]
+                if not times or times[0] != 0:
+                    meta.insert(0, ('K', 0, start, partnum - 1))
+        return Compiled(output, meta, self.metronome_output,
+                        self.beat_map, self.part_numbers, None,
+                        self.warnings, None)
+
+    def twelve_keys(self):
+        """ Return a dict of key name -> instantiate() for all 12 tonics """
+        mode = keysigs.MIDISIGS[self.home][1]
+        return {k: self.instantiate(k) for k in TWELVE_KEYS[mode]}
+
+def key_relative(source, parts=None, include_dir=None, ignore_velocity=False):
+    """ Evaluate numeric tbon source once and return its KeyRelative """
+    return KeyRelative(evaluate(source, True, parts, include_dir,
+                                ignore_velocity))
+
+def key_variant_name(basename, keyname):
+    """ Return the midi file name for a key, e.g. 'scale_kB@.mid' """
+    return "{}_k{}.mid".format(basename, keyname)
+
+def make_keys(tbon, basename, keynames):
+    """
+    Write one midi file for each of keynames from the evaluated numeric
+    tbon. 'all' stands for the 12 keys of the score's mode. Returns the
+    list of file names written.
+    """
+    relative = KeyRelative(tbon)
+    if 'all' in keynames:
+        keynames = TWELVE_KEYS[keysigs.MIDISIGS[relative.home][1]]
+    written = []
+    for keyname in keynames:
+        outfile = key_variant_name(basename, keyname)
+        make_midi(relative.instantiate(keyname), outfile, quiet=True)
+        written.append(outfile)
+    return written
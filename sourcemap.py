@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Two-way lookup between evaluated notes and the source text
+             that produced them, for playback highlighting and error
+             reporting.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+from bisect import bisect_left, bisect_right
+
+class IntervalIndex():
+    """
+    Static index of half-open intervals [start, end), each with an item.
+    at(point) returns the items of every interval containing point, and
+    overlapping(lo, hi) those of every interval overlapping [lo, hi), in
+    O(log n) per item found.
+
+    Intervals are sorted by start and a segment tree holds the largest
+    end in each range of them. A query looks only at intervals starting
+    at or before point and skips every subtree whose largest end isn't
+    past point.
+    """
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key=lambda i: i[0])
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+        self.items = [i[2] for i in intervals]
+        size = 1
+        while size < len(intervals):
+            size *= 2
+        self.size = size
+        ## Leaves at size..2*size-1, the maximum of nodes n*2 and n*2+1
+        ## at node n.
+        tree = [float('-inf')] * (2 * size)
+        tree[size:size + len(self.ends)] = self.ends
+        for n in range(size - 1, 0, -1):
+            tree[n] = max(tree[2 * n], tree[2 * n + 1])
+        self.max_end = tree
+
+    def __len__(self):
+        return len(self.items)
+
+    def at(self, point):
+        """ Items of the intervals containing point, ordered by start """
+        return self.search(bisect_right(self.starts, point), point)
+
+    def overlapping(self, lo, hi):
+        """
+        Items of the intervals overlapping [lo, hi), ordered by start.
+        Only those intervals and the subtrees above them are visited.
+        """
+        return self.search(bisect_left(self.starts, hi), lo)
+
+    def search(self, count, point):
+        """ Items of the first count intervals that end after point """
+        found = []
+        if not count:
+            return found
+        tree = self.max_end
+        ## Depth-first over the subtrees covering leaves 0..count-1,
+        ## leftmost first.
+        stack = [(1, 0, self.size)]
+        while stack:
+            n, lo, hi = stack.pop()
+            if lo >= count or tree[n] <= point:
+                continue
+            if n >= self.size:
+                found.append(self.items[lo])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * n + 1, mid, hi))
+            stack.append((2 * n, lo, mid))
+        return found
+
+class SourceMap():
+    """
+    Lookups between the notes of a MidiEvaluator run with source_map=True
+    and the source spans that produced them.
+      * notes_at_time(t) -- notes sounding at time t
+      * spans_at_time(t) -- source spans of the notes sounding at time t
+      * notes_at_offset(i) -- notes produced by the character at offset i
+    Notes are returned as (part number, note tuple). Rests are included.
+    """
+    def __init__(self, tbon):
+        self.notes = [(partnum, note)
+                      for partnum, notes in zip(tbon.part_numbers, tbon.output)
+                      for note in notes]
+        self.by_time = IntervalIndex(
+            (note[1], note[2], i) for i, (_, note) in enumerate(self.notes))
+        self.by_offset = IntervalIndex(
+            (note[-1][0], note[-1][1], i)
+            for i, (_, note) in enumerate(self.notes))
+
+    def notes_at_time(self, time):
+        """ Notes sounding at time, in quarter-note beats """
+        return [self.notes[i] for i in self.by_time.at(time)]
+
+    def spans_at_time(self, time):
+        """ Source (start, end) spans of the notes sounding at time """
+        return [self.notes[i][1][-1] for i in self.by_time.at(time)]
+
+    def notes_at_offset(self, offset):
+        """ Notes produced by the source character at offset """
+        return [self.notes[i] for i in self.by_offset.at(offset)]
@@ -6,44 +6,139 @@ Author: Mike Ellis
 Copyright 2017 Ellis & Grant, Inc.
 """
 #pylint: disable=too-many-branches
+import io
 import os
+import sys
 import argparse
-from midiutil import MIDIFile, SHARPS, FLATS, MAJOR, MINOR
-from parser import MidiEvaluator
-def evaluate(source, numeric=True):
-    """ Run the MidiEvaluator and return the output """
+from bisect import bisect_right
+from collections import namedtuple
+from parsimonious.exceptions import ParseError
+from parser import MidiEvaluator, MidiPreEvaluator
+from export import EXPORTERS, export
+from excerpt import index_path, load_index, render_bars
+import keysigs
+
+def pitch_order(numeric):
+    """ Return the pitch names for numeric or alpha notation """
     if numeric:
-        pitches = tuple('1234567')
-    else:
-        pitches = tuple('cdefgab')
+        return tuple('1234567')
+    return tuple('cdefgab')
 
-    tbon = MidiEvaluator(pitch_order=pitches)
-    tbon.eval(source, verbosity=0)
+def evaluate(source, numeric=True, parts=None, include_dir=None,
+             ignore_velocity=False):
+    """
+    Run the MidiEvaluator and return the output. If parts is given, only
+    those part numbers are evaluated. Included fragments are found
+    relative to include_dir, and aren't allowed if it is None.
+    """
+    tbon = MidiEvaluator(pitch_order=pitch_order(numeric), parts=parts,
+                         ignore_velocity=ignore_velocity)
+    tbon.eval(source, verbosity=0, include_dir=include_dir)
     return tbon
 
+## One result of compile_many(). The first five fields are copies of
+## the evaluator's products, so a result can be passed to make_midi() or
+## export(). midi is the midi file as bytes, or None if it wasn't asked
+## for. warnings is a list of parser.EvalWarning. If the source is
+## invalid, error is the exception and the other fields are None.
+Compiled = namedtuple('Compiled', 'output meta_output metronome_output '
+                      'beat_map part_numbers midi warnings error')
+
+def compile_with(tbon, source, include_dir=None, midi=True, options=None):
+    """
+    Evaluate source with the MidiEvaluator tbon and return a Compiled
+    result. ParseError, ValueError and OSError are returned in the
+    result rather than raised.
+    """
+    try:
+        tbon.eval(source, verbosity=0, include_dir=include_dir)
+        data = midi_bytes(tbon, **(options or {})) if midi else None
+    except (ParseError, ValueError, OSError) as e:
+        return Compiled(None, None, None, None, None, None, None, e)
+    return Compiled(tbon.output, tbon.meta_output, tbon.metronome_output,
+                    tbon.beat_map, tbon.part_numbers, data, tbon.warnings,
+                    None)
+
+def compile_one(source, numeric=True, parts=None, include_dir=None,
+                ignore_velocity=False, midi=True, options=None, budget=None):
+    """
+    Evaluate one source with a new evaluator, printing nothing, and
+    return a Compiled result. For running in a worker thread or process.
+    budget is a parser.Budget or None.
+    """
+    tbon = MidiEvaluator(pitch_order=pitch_order(numeric), parts=parts,
+                         ignore_velocity=ignore_velocity, quiet=True,
+                         budget=budget)
+    return compile_with(tbon, source, include_dir, midi, options)
+
+def compile_many(sources, numeric=True, parts=None, include_dir=None,
+                 ignore_velocity=False, midi=True, budget=None, **options):
+    """
+    Evaluate each of sources, and encode it as midi if midi is true, and
+    return a list of Compiled results in the same order. options are
+    passed to make_midi(). An invalid source, or one over budget, a
+    parser.Budget, doesn't stop the batch; its result holds the exception
+    instead. Nothing is printed.
+
+    One evaluator is reused for the whole batch and the grammar and
+    block caches are shared, so a batch of small scores pays the setup
+    costs once.
+    """
+    tbon = MidiEvaluator(pitch_order=pitch_order(numeric), parts=parts,
+                         ignore_velocity=ignore_velocity, quiet=True,
+                         budget=budget)
+    return [compile_with(tbon, source, include_dir, midi, options)
+            for source in sources]
+
+def check(source, numeric=True, include_dir=None):
+    """
+    Validate source without generating any notes. Raises ParseError for
+    syntax errors and ValueError for invalid keys, channels, instruments,
+    tempi, velocities or pitch characters. Returns the MidiPreEvaluator,
+    whose beat_map, bar_starts and meta_output hold the beat maps and
+    time signatures.
+    """
+    pre = MidiPreEvaluator(pitch_order=pitch_order(numeric))
+    pre.eval(source, verbosity=0, include_dir=include_dir)
+    return pre
+
 def make_midi(tbon, outfile,
               firstbar=0,
               quiet=False,
-              metronome=0):
+              metronome=0,
+              transpose=0,
+              tempo_scale=1.0,
+              velocity_scale=1.0,
+              merge_overlaps=True):
     """
-    Parse and evaluate the source string. Write the output
-    to the specified outfile name.
+    Write the evaluated tbon output to outfile, a file name or a binary
+    file object.
 
     kwargs:
+      firstbar -- measure number of the first measure in the beat map.
+      quiet -- don't print the number of parts or the beat map.
+      metronome -- 0 for music only, 1 for metronome only, 2 for both.
       transpose -- Number of semitones to transpose the output.
-                   May be positive or negative.
-      volume -- MIDI track volume
-      track  -- Midi file track number
-      channel -- MIDI channel number
-      octave  -- Initial MIDI octave number (0 - 10)
-      numeric -- tbon notation can be either named pitches (cdefgab) or
-                 numbers (1234567) with 1 corresponding to 'c'.
+                   May be positive or negative. Key signatures follow.
+      tempo_scale -- Multiplier applied to every tempo.
+      velocity_scale -- Multiplier applied to every note velocity.
+                        Velocities are clipped to the MIDI maximum.
+      merge_overlaps -- Resolve overlapping notes of the same pitch and
+                        channel first. See resolve_overlaps().
+
+    Raises ValueError if tbon was evaluated with ignore_velocity.
     """
 
+    ## Imported here so that checking doesn't pay for it.
+    from midiutil import MIDIFile, SHARPS, FLATS, MAJOR, MINOR
+
     parts = tbon.output
+    if any(notes and len(notes[0]) < 5 for notes in parts):
+        raise ValueError("\nMidi needs velocities and channels, which "
+                         "output evaluated with ignore_velocity lacks.")
     numparts = len(parts)
-    print("Found {} parts".format(numparts))
-    metronotes = tbon.metronome_output
+    if not quiet:
+        print("Found {} parts".format(numparts))
     if metronome == 0:
         numTracks = numparts
     elif metronome == 1:
@@ -52,29 +147,35 @@ def make_midi(tbon, outfile,
         numTracks = 1 + numparts
     meta = tbon.meta_output
     beat_map = tbon.beat_map
+    ## Map part indices to tracks. Metas of parts that weren't
+    ## evaluated are dropped.
+    if metronome == 1:
+        tracks = {tbon.part_numbers[0] - 1: 0} if numparts else {}
+    else:
+        tracks = {num - 1: trk for trk, num in enumerate(tbon.part_numbers)}
     MyMIDI = MIDIFile(numTracks, adjust_origin=True,
                       removeDuplicates=False, deinterleave=False)
     #MyMIDI.addTempo(track, 0, tempo)
     trk0 = 0
     for m in meta:
         if m[0] == 'T':
-            MyMIDI.addTempo(trk0, m[1], m[2])
-        elif m[0] == 'K' and metronome != 1:
+            MyMIDI.addTempo(trk0, m[1], m[2] * tempo_scale)
+        elif m[0] == 'K' and metronome != 1 and m[3] in tracks:
             time = m[1]
-            sf, mi = m[2]
-            track = m[3]
+            sf, mi = keysigs.transpose_midisig(m[2], transpose)
+            track = tracks[m[3]]
             mode = MINOR if mi == 1 else MAJOR
             accidentals = abs(sf)
             acc_type = SHARPS if sf > 0 else FLATS
             #print("Inserting key signature at time {}".format(time))
             #print(accidentals, acc_type, mode)
             MyMIDI.addKeySignature(track, time, accidentals, acc_type, mode)
-        elif m[0] == 'M':
+        elif m[0] == 'M' and m[4] in tracks:
             ## Time signature
             time = m[1]
             numerator = m[2]
             denominator = m[3]
-            track = m[4]
+            track = tracks[m[4]]
             ## midi denominator specified a power of 2
             midi_denom = {2:1, 4:2, 8:3, 16:4}[denominator]
             ## We want to make the midi metronome match beat duration.
@@ -98,11 +199,11 @@ def make_midi(tbon, outfile,
                                     numerator,
                                     denominator=midi_denom,
                                     clocks_per_tick=metro_clocks)
-        elif m[0] == 'I' and metronome != 1:
+        elif m[0] == 'I' and metronome != 1 and m[3] in tracks:
             ## Instrument change
             time = m[1]
             instrument = m[2] - 1 ## convert to 0 index
-            track = m[3] + 1
+            track = tracks[m[3]]
             chan = m[4] - 1
             MyMIDI.addProgramChange(track, chan, time, instrument)
 
@@ -114,26 +215,144 @@ def make_midi(tbon, outfile,
                                pitch, start,
                                stop - start,
                                int(velocity * 127))
+    if transpose or velocity_scale != 1.0:
+        parts = [transform_notes(notes, transpose, velocity_scale)
+                 for notes in parts]
+    if merge_overlaps:
+        parts = resolve_overlaps(parts)
     if metronome == 0:
         for track, notes in enumerate(parts):
             add_notes(notes, track)
     elif metronome == 1:
         ## Metronome output only.
-        add_notes(metronotes, trk0)
+        add_notes(tbon.metronome_output, trk0)
     else:
         ## Both
         for track, notes in enumerate(parts):
             add_notes(notes, track)
         metrotrack = numparts ## because 0-indexing
-        add_notes(metronotes, metrotrack)
+        add_notes(tbon.metronome_output, metrotrack)
 
-    with open(outfile, "wb") as output_file:
-        MyMIDI.writeFile(output_file)
+    if hasattr(outfile, 'write'):
+        MyMIDI.writeFile(outfile)
+    else:
+        with open(outfile, "wb") as output_file:
+            MyMIDI.writeFile(output_file)
 
     if not quiet:
         for partnum, pmap in beat_map.items():
             print_beat_map(partnum, pmap, first_bar_number=firstbar)
 
+def midi_bytes(tbon, **kwargs):
+    """
+    Return the midi file for the evaluated tbon output as bytes, without
+    printing anything. kwargs are as for make_midi().
+    """
+    kwargs['quiet'] = True
+    buf = io.BytesIO()
+    make_midi(tbon, buf, **kwargs)
+    return buf.getvalue()
+
+def transform_notes(notes, transpose=0, velocity_scale=1.0):
+    """
+    Return notes with pitches shifted by transpose semitones and
+    velocities multiplied by velocity_scale. Rests are unchanged.
+    Raises ValueError if a pitch leaves the MIDI range.
+    """
+    result = [(None if p is None else p + transpose, s, e,
+               min(1.0, v * velocity_scale), c)
+              for p, s, e, v, c in notes]
+    pitches = [n[0] for n in result if n[0] is not None]
+    if pitches and (min(pitches) < 0 or max(pitches) > 127):
+        msg = ("\nTransposing by {} semitones moves pitches "
+               "outside the MIDI range 0 to 127.")
+        raise ValueError(msg.format(transpose))
+    return result
+
+def resolve_overlaps(parts):
+    """
+    Return parts with overlapping notes of the same pitch on the same
+    channel resolved, so each (channel, pitch) sounds at most one note at
+    a time. Parts sharing a channel are resolved together since they
+    share MIDI note-on/off pairs. For each (channel, pitch), a sweep in
+    start order
+      * drops exact duplicates,
+      * merges notes starting together into the one in the lowest part,
+        extended to the latest end,
+      * truncates a sounding note where the next one starts.
+    Notes keep their part, order and any extra columns.
+    """
+    voices = {}
+    for pindex, notes in enumerate(parts):
+        for nindex, note in enumerate(notes):
+            if note[0] is not None:
+                key = (note[4], note[0])
+                voices.setdefault(key, []).append(
+                    (note[1], pindex, nindex, note[2]))
+    ## (pindex, nindex) -> new end, or None to drop the note.
+    changes = {}
+    for entries in voices.values():
+        entries.sort()
+        sounding = None
+        for start, pindex, nindex, end in entries:
+            if sounding is not None and start < sounding_end:
+                if start == sounding_start:
+                    changes[(pindex, nindex)] = None
+                    if end > sounding_end:
+                        sounding_end = changes[sounding] = end
+                    continue
+                changes[sounding] = start
+            sounding = (pindex, nindex)
+            sounding_start, sounding_end = start, end
+    if not changes:
+        return parts
+    resolved = []
+    for pindex, notes in enumerate(parts):
+        part = []
+        for nindex, note in enumerate(notes):
+            end = changes.get((pindex, nindex), note[2])
+            if end is not None:
+                part.append(note if end == note[2] else
+                            (note[0], note[1], end) + tuple(note[3:]))
+        resolved.append(part)
+    return resolved
+
+def variant_name(basename, transpose=0, tempo_scale=1.0, velocity_scale=1.0):
+    """
+    Return the midi file name for a variant, e.g. 'song_t-2_x0.8.mid'.
+    """
+    suffix = ''
+    if transpose:
+        suffix += "_t{:+d}".format(transpose)
+    if tempo_scale != 1.0:
+        suffix += "_x{:g}".format(tempo_scale)
+    if velocity_scale != 1.0:
+        suffix += "_v{:g}".format(velocity_scale)
+    return basename + suffix + ".mid"
+
+def make_variants(tbon, basename,
+                  transpositions=(0,),
+                  tempo_scales=(1.0,),
+                  velocity_scales=(1.0,),
+                  metronome=0):
+    """
+    Write one midi file for every combination of transposition, tempo
+    scale and velocity scale, all from the same evaluated output.
+    Returns the list of file names written.
+    """
+    written = []
+    for transpose in transpositions:
+        for tempo_scale in tempo_scales:
+            for velocity_scale in velocity_scales:
+                outfile = variant_name(basename, transpose,
+                                       tempo_scale, velocity_scale)
+                make_midi(tbon, outfile, quiet=True, metronome=metronome,
+                          transpose=transpose,
+                          tempo_scale=tempo_scale,
+                          velocity_scale=velocity_scale)
+                written.append(outfile)
+    return written
+
 def print_beat_map(partnum, beat_map, first_bar_number=0):
     """
     Output the beat map in a nice readable display with
@@ -170,51 +389,217 @@ def print_beat_map(partnum, beat_map, first_bar_number=0):
         if endmap:
             break
 
-if __name__ == '__main__':
-    _parser = argparse.ArgumentParser()
-    _parser.add_argument('-b', '--firstbar', type=int, default=0,
-                         help="The measure number of the first measure."
-                         " (Used to align beat map output)")
-    _parser.add_argument('-q', '--quiet', action='store_true',
-                         help="Don't print the input file and "
-                         "bar map to stdout.")
-    _parser.add_argument('-v', '--verbose', action='store_true',
-                         help="dump the MidiEvaluator output to stdout")
-    _parser.add_argument("filename", nargs='+',
-                         help="one or more files of tbon notation")
-    _args = _parser.parse_args()
-    for f in _args.filename:
-        _name, _ext = os.path.splitext(f)
-        if _ext.lower() not in (".tba", ".tbn"):
+def print_time_signatures(partnum, meta, bar_starts, first_bar_number=0):
+    """
+    Output the time signatures of a part with the number of the bar
+    where each one takes effect.
+       Part 1 Time Signatures: 0: 3/4  8: 4/4
+    """
+    sigs = []
+    for m in meta:
+        if m[0] == 'M' and m[4] == partnum - 1:
+            bar = bisect_right(bar_starts, m[1]) - 1 + first_bar_number
+            sigs.append("{}: {}/{}".format(bar, m[2], m[3]))
+    print("Part {} Time Signatures: {}".format(partnum, '  '.join(sigs)))
+
+def check_file(filename, source, numeric, firstbar=0, quiet=False):
+    """
+    Validate source and print its beat maps and time signatures.
+    Returns True if the source is valid, else prints the error and
+    returns False.
+    """
+    if not quiet:
+        print("Checking {}".format(filename))
+    try:
+        pre = check(source, numeric, os.path.dirname(filename) or os.curdir)
+    except (ParseError, ValueError, OSError) as e:
+        print("{}: {}".format(filename, str(e).strip()))
+        return False
+    if not quiet:
+        for partnum, pmap in pre.beat_map.items():
+            print_beat_map(partnum, pmap, first_bar_number=firstbar)
+            print_time_signatures(partnum, pre.meta_output,
+                                  pre.bar_starts[partnum],
+                                  first_bar_number=firstbar)
+    return True
+
+def make_arg_parser(prog=None):
+    """
+    Return the command line argument parser. prog is the program name
+    shown in usage messages, by default the name of the script.
+    """
+    arg_parser = argparse.ArgumentParser(prog=prog)
+    arg_parser.add_argument('-b', '--firstbar', type=int, default=0,
+                            help="The measure number of the first measure."
+                            " (Used to align beat map output)")
+    arg_parser.add_argument('-q', '--quiet', action='store_true',
+                            help="Don't print the input file and "
+                            "bar map to stdout.")
+    arg_parser.add_argument('-v', '--verbose', action='store_true',
+                            help="dump the MidiEvaluator output to stdout")
+    arg_parser.add_argument('-c', '--check', action='store_true',
+                            help="Only check the files for errors and print "
+                            "the beat maps and time signatures. No midi "
+                            "files are written.")
+    arg_parser.add_argument('-t', '--transpose', type=int, action='append',
+                            default=[], metavar='SEMITONES',
+                            help="Also write a copy transposed by SEMITONES. "
+                            "May be repeated.")
+    arg_parser.add_argument('-x', '--tempo-scale', type=float, action='append',
+                            default=[], metavar='FACTOR',
+                            help="Also write a copy with every tempo "
+                            "multiplied by FACTOR. May be repeated.")
+    arg_parser.add_argument('--velocity-scale', type=float, action='append',
+                            default=[], metavar='FACTOR',
+                            help="Also write a copy with every velocity "
+                            "multiplied by FACTOR. May be repeated.")
+    arg_parser.add_argument('-k', '--key', action='append', default=[],
+                            metavar='KEY',
+                            help="Also write a copy of a .tbn file in KEY, "
+                            "e.g. D or b@, evaluated only once for all "
+                            "keys. 'all' means all 12 keys of the score's "
+                            "mode. May be repeated.")
+    arg_parser.add_argument('-p', '--part', type=int, action='append',
+                            dest='parts', metavar='PARTNUM',
+                            help="Only render part PARTNUM. May be repeated.")
+    arg_parser.add_argument('-w', '--wav', action='store_true',
+                            help="Also render the music with and without the "
+                            "metronome to WAV files. Requires NumPy.")
+    arg_parser.add_argument('-e', '--export', action='append', default=[],
+                            choices=sorted(EXPORTERS), metavar='FORMAT',
+                            help="Also write the note and meta events in "
+                            "FORMAT, one of {}. May be repeated.".format(
+                            ', '.join(sorted(EXPORTERS))))
+    arg_parser.add_argument('--roll', action='append', default=[],
+                            choices=('png', 'svg'), metavar='FORMAT',
+                            help="Also draw a piano roll of the music as "
+                            "FORMAT, svg or png. May be repeated.")
+    arg_parser.add_argument('--bars', metavar='FIRST:LAST',
+                            help="Only render bars FIRST through LAST, "
+                            "numbered as in the beat map. A checkpoint "
+                            "index is kept in a .tbc file next to the "
+                            "source so later ranges are fast.")
+    arg_parser.add_argument("filename", nargs='+',
+                            help="one or more files of tbon notation")
+    return arg_parser
+
+def main(argv=None, prog=None):
+    """
+    Run the command line with argv, sys.argv[1:] if None. Returns the
+    exit status. prog is as for make_arg_parser().
+    """
+    args = make_arg_parser(prog).parse_args(argv)
+    failed = False
+    for f in args.filename:
+        name, ext = os.path.splitext(f)
+        if ext.lower() not in (".tba", ".tbn"):
             raise Exception("File xxtension must be .tba or .tbn")
         else:
-            _numeric = _ext.lower() == ".tbn"
+            numeric = ext.lower() == ".tbn"
 
-        _outfile = _name + ".mid"
-        _metro_outfile = _name + "_metronome_only.mid"
-        _both_outfile = _name + "_with_metronome.mid"
+        if args.parts:
+            name += ''.join("_p{}".format(n) for n in args.parts)
+        outfile = name + ".mid"
+        metro_outfile = name + "_metronome_only.mid"
+        both_outfile = name + "_with_metronome.mid"
 
-        print("Processing {}".format(f))
         with open(f) as infile:
-            _source = infile.read()
-        if not _args.quiet:
-            print(_source)
-        _tbon = evaluate(_source, _numeric)
-        if _args.verbose:
-            print(_tbon.output)
-
-        make_midi(_tbon, _outfile,
-                  firstbar=_args.firstbar,
-                  quiet=_args.quiet,
+            source = infile.read()
+        if args.check:
+            if not check_file(f, source, numeric,
+                              firstbar=args.firstbar, quiet=args.quiet):
+                failed = True
+            continue
+
+        print("Processing {}".format(f))
+        if not args.quiet:
+            print(source)
+        firstbar = args.firstbar
+        if args.bars:
+            first, last = (int(n) for n in args.bars.split(':'))
+            index = load_index(source, pitch_order(numeric), index_path(f))
+            tbon = render_bars(source, index, first - args.firstbar,
+                               last - args.firstbar,
+                               pitch_order(numeric), parts=args.parts)
+            firstbar = first
+            name += "_bars{}-{}".format(first, last)
+            outfile = name + ".mid"
+            metro_outfile = name + "_metronome_only.mid"
+            both_outfile = name + "_with_metronome.mid"
+        else:
+            tbon = evaluate(source, numeric, parts=args.parts,
+                            include_dir=os.path.dirname(f) or os.curdir)
+        missing = [n for n in args.parts or () if n not in tbon.part_numbers]
+        if missing:
+            print("{}: No part {} in the score.".format(
+                f, ', '.join(str(n) for n in missing)))
+            failed = True
+            continue
+        if args.verbose:
+            print(tbon.output)
+
+        make_midi(tbon, outfile,
+                  firstbar=firstbar,
+                  quiet=args.quiet,
                   metronome=0)
-        print("Created {}".format(_outfile))
-        make_midi(_tbon, _metro_outfile,
-                  firstbar=_args.firstbar,
+        print("Created {}".format(outfile))
+        make_midi(tbon, metro_outfile,
+                  firstbar=firstbar,
                   quiet=True,
                   metronome=1)
-        print("Created {}".format(_metro_outfile))
-        make_midi(_tbon, _both_outfile,
-                  firstbar=_args.firstbar,
+        print("Created {}".format(metro_outfile))
+        make_midi(tbon, both_outfile,
+                  firstbar=firstbar,
                   quiet=True,
                   metronome=2)
-        print("Created {}".format(_both_outfile))
+        print("Created {}".format(both_outfile))
+        for fmt in args.export:
+            exportfile = export(tbon, name + EXPORTERS[fmt][1], fmt)
+            print("Created {}".format(exportfile))
+        if args.wav:
+            from audio import make_wav
+            try:
+                for wavfile, metronome in ((name + ".wav", 0),
+                                           (name + "_with_metronome.wav",
+                                            2)):
+                    make_wav(tbon, wavfile, metronome=metronome)
+                    print("Created {}".format(wavfile))
+            except ValueError as e:
+                print("{}: {}".format(f, str(e).strip()))
+                failed = True
+        if args.roll:
+            from pianoroll import PianoRoll
+            roll = PianoRoll(tbon, firstbar)
+            for fmt in args.roll:
+                rollfile = name + "." + fmt
+                if fmt == 'svg':
+                    with open(rollfile, 'w') as roll_output:
+                        roll_output.write(roll.svg())
+                else:
+                    with open(rollfile, 'wb') as roll_output:
+                        roll_output.write(roll.png())
+                print("Created {}".format(rollfile))
+        if args.transpose or args.tempo_scale or args.velocity_scale:
+            for variant in make_variants(
+                    tbon, name,
+                    transpositions=args.transpose or [0],
+                    tempo_scales=args.tempo_scale or [1.0],
+                    velocity_scales=args.velocity_scale or [1.0]):
+                print("Created {}".format(variant))
+        if args.key:
+            if not numeric:
+                print("{}: Only numeric (.tbn) files can change "
+                      "key.".format(f))
+                failed = True
+                continue
+            from rekey import make_keys
+            try:
+                for keyfile in make_keys(tbon, name, args.key):
+                    print("Created {}".format(keyfile))
+            except ValueError as e:
+                print("{}: {}".format(f, str(e).strip()))
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description: Thin command line client. Takes the same arguments as
+             tbon.py and runs them in a daemon.py server if one is
+             running, else in this process.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc.
+"""
+import os
+import sys
+import json
+import stat
+import socket
+
+def socket_path(create=False):
+    """
+    Return the daemon's socket name: $TBON_SOCKET if set, else
+    tbon.sock in $XDG_RUNTIME_DIR, else in a tbon-<uid> directory of
+    the temporary directory that only this user can use. If create is
+    true, that directory is made if missing. Raises ValueError if it
+    belongs to another user or others can use it.
+    """
+    if 'TBON_SOCKET' in os.environ:
+        return os.environ['TBON_SOCKET']
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, 'tbon.sock')
+    import tempfile
+    folder = os.path.join(tempfile.gettempdir(),
+                          'tbon-{}'.format(os.getuid()))
+    if create:
+        try:
+            os.mkdir(folder, 0o700)
+        except FileExistsError:
+            pass
+    if os.path.lexists(folder):
+        info = os.lstat(folder)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+                or info.st_mode & 0o077):
+            msg = "\nUnsafe socket directory, {}. It must be yours, mode 700."
+            raise ValueError(msg.format(folder))
+    return os.path.join(folder, 'tbon.sock')
+
+def owned_socket(path):
+    """ Return True if path is a socket belonging to this user """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+def run_remote(argv, path=None):
+    """
+    Run argv in the daemon, copying its output to stdout and stderr.
+    Returns the exit status, or None if no daemon is listening. Sockets
+    that belong to another user are never used, since their owner would
+    see argv and could fake the output.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        path = path or socket_path()
+    except ValueError:
+        return None
+    if not owned_socket(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    with conn, conn.makefile('rb') as replies:
+        request = dict(argv=argv, cwd=os.getcwd(),
+                       prog=os.path.basename(sys.argv[0]))
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        for line in replies:
+            reply = json.loads(line.decode('utf-8'))
+            if 'exit' in reply:
+                return reply['exit']
+            stream = sys.stdout if 'out' in reply else sys.stderr
+            stream.write(reply.get('out', reply.get('err')))
+            stream.flush()
+    ## The daemon went away mid-request.
+    return 1
+
+def main(argv=None):
+    """ Run argv remotely if possible, else in process """
+    argv = sys.argv[1:] if argv is None else argv
+    status = run_remote(argv)
+    if status is None:
+        import tbon
+        status = tbon.main(argv)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+"""
+To be run with pytest. Contains tests of the asyncio compile API.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_compile_async(capsys):
+    import asyncio
+    from aio import compile_async, compile_many_async, make_executor
+    from tbon import compile_many
+    sources = ['P=1 c d | P=2 T=90 e f |', 'c d | e']
+    expected = compile_many(sources, numeric=False)
+    assert [w[:2] for w in expected[0].warnings] == [
+        ('Ignoring tempo spec in part 2.', 2)]
+    assert sources[0][expected[0].warnings[0].start:
+                      expected[0].warnings[0].end].strip() == 'T=90 e f |'
+
+    async def run(executor):
+        one = await compile_async(sources[0], numeric=False,
+                                  executor=executor)
+        many = await compile_many_async(sources, numeric=False,
+                                        executor=executor, timeout=30)
+        return one, many
+
+    for kind in ('thread', 'process'):
+        with make_executor(kind, 2) as executor:
+            one, many = asyncio.run(run(executor))
+        assert one == expected[0]
+        assert many[0] == expected[0]
+        assert str(many[1].error) == str(expected[1].error)
+    ## Nothing was printed.
+    assert capsys.readouterr().out == ''
+    with make_executor('thread', 1) as executor:
+        late = asyncio.run(compile_many_async(sources * 20, numeric=False,
+                                              executor=executor, timeout=0))
+    assert any(isinstance(r.error, asyncio.TimeoutError) for r in late)
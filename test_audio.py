@@ -0,0 +1,72 @@
+"""
+To be run with pytest. Contains tests of tempo maps and audio rendering.
+"""
+from parser import MidiEvaluator
+from timing import TempoMap
+from pytest import approx, importorskip
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_tempo_map():
+    m = MidiEvaluator()
+    m.eval('T=60 c d | t=2 e f | T=120 g a |')
+    tempo_map = TempoMap(m.meta_output)
+    assert tempo_map.seconds(0) == 0
+    assert tempo_map.seconds(2) == approx(2.0)
+    assert tempo_map.seconds(4) == approx(3.0)
+    assert tempo_map.seconds(5) == approx(3.5)
+    assert TempoMap(m.meta_output, tempo_scale=2).seconds(5) == approx(1.75)
+    ## No tempo events means the midi default, 120 bpm.
+    assert TempoMap([]).seconds(3) == approx(1.5)
+    np = importorskip('numpy')
+    beats = np.array([0, 2, 4, 5, 7.5])
+    assert list(tempo_map.seconds_array(beats)) == approx(
+        [tempo_map.seconds(b) for b in beats])
+
+def test_render():
+    np = importorskip('numpy')
+    import audio
+    m = MidiEvaluator()
+    m.eval('T=60 c d | e - | (ceg) - |' * 4)
+    rate = 8000
+    music = audio.render(m, rate=rate, workers=1)
+    ## 24 seconds of music, plus the release of the last chord.
+    assert len(music) == 24 * rate + int(audio.VOICES[audio.PIANO].release
+                                         * rate)
+    assert np.abs(music).max() == approx(0.9)
+    clicks = audio.render(m, metronome=1, rate=rate, workers=1)
+    assert clicks[:rate // 100].any() and not clicks[rate // 2:rate].any()
+    ## Rendering in time slices gives the same samples.
+    sliced = audio.render(m, rate=rate, workers=2, slice_seconds=5.0)
+    assert np.abs(sliced - music).max() < 1e-5
+
+def test_render_range():
+    np = importorskip('numpy')
+    from pytest import raises
+    import audio
+    from tbon import evaluate
+    ## Relative octaves can climb past the midi range.
+    m = evaluate('c e g ^c | ' * 40, numeric=False)
+    with raises(ValueError) as info:
+        audio.render(m, workers=1)
+    assert 'Invalid pitch' in str(info.value)
+    ## Notes above half the sample rate are dropped.
+    m = evaluate('c | ^^^^c |', numeric=False)
+    starts = audio.note_table(m, rate=8000)[0]
+    assert len(starts) == 1
+    assert np.isfinite(audio.render(m, rate=8000, workers=1)).all()
+
+def test_render_note_shapes():
+    np = importorskip('numpy')
+    import audio
+    source = 'T=60 c d | (ceg) - |'
+    m = MidiEvaluator()
+    m.eval(source)
+    expected = audio.render(m, rate=8000, workers=1)
+    ## Notes without velocity and channel, or with a source span, render
+    ## like the 5-field notes they come from.
+    for options in (dict(ignore_velocity=True), dict(source_map=True),
+                    dict(ignore_velocity=True, source_map=True)):
+        m = MidiEvaluator(**options)
+        m.eval(source)
+        assert np.abs(audio.render(m, rate=8000, workers=1)
+                      - expected).max() < 1e-5
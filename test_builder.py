@@ -0,0 +1,45 @@
+"""
+To be run with pytest. Contains tests of the score builder.
+"""
+from parser import MidiEvaluator
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_builder():
+    from pytest import raises
+    from parser import lower, parse
+    from builder import (Score, note, chord, roll, ornament, key, tempo,
+                         velocity, channel, relativetempo, HOLD, REST)
+    score = Score()
+    score.part(1).bar(key('D'), tempo(90), 'd', ['e', 'f'], HOLD)
+    score.bar(chord('d', note('f', 1), 'a'),
+              [chord('-', '_', note('b', -1, 1))], roll('a', 'd'), REST)
+    score.bar(ornament(note('g', octave=-1), 'a'), velocity(0.5), 'c',
+              barline='|:')
+    score.bar('c', 'd', barline=':|x3')
+    score.part(2).bar(channel(10), relativetempo(1.5), 'c', 'c', 'c', 'c')
+    score.start_repeat().bar('e', barline=':|')
+    text = score.to_tbon()
+    assert text == ('P=1 K=D T=90 d ef - | (d#fa) (-_^@b) (:ad) _ |'
+                    ' (~/ga) V=0.5 c |: c d :|x3\n'
+                    'P=2 C=10 t=1.5 c c c c | |: e :|')
+    built = MidiEvaluator()
+    built.eval(score.ast(), verbosity=0)
+    parsed = MidiEvaluator()
+    parsed.eval(text, verbosity=0)
+    assert built.output == parsed.output
+    assert built.meta_output == parsed.meta_output
+    assert built.metronome_output == parsed.metronome_output
+    assert built.beat_map == parsed.beat_map
+    ## Offsets are those of the text.
+    ast = score.ast()
+    full = lower(parse(text))
+    assert [(c.expr_name, c.value, c.start, c.end) for c in ast.children] == \
+           [(c.expr_name, c.value, c.start, c.end) for c in full.children]
+    with raises(ValueError):
+        note('h')
+    with raises(ValueError):
+        roll('c')
+    with raises(ValueError):
+        Score().bar('c', barline='||')
+    with raises(ValueError):
+        Score().part(1).part(2)
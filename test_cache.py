@@ -0,0 +1,67 @@
+"""
+To be run with pytest. Contains tests of the result and block caches.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_result_cache():
+    from threading import Thread
+    from cache import ResultCache, cached_midi
+    from tbon import evaluate, midi_bytes
+    cache = ResultCache(max_bytes=10)
+    cache.put('a', 'A', 4)
+    cache.put('b', 'B', 4)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 4)
+    assert cache.get('b') is None and cache.get('c') == 'C'
+    cache.put('d', 'D', 11)
+    assert cache.get('d') is None
+    assert cache.stats() == (2, 2, 1, 2, 8)
+
+    cache = ResultCache()
+    src = 'P=1 c d e f | P=2 /c - /g - |'
+    data = cached_midi(src, numeric=False, cache=cache, metronome=2)
+    assert data == midi_bytes(evaluate(src, numeric=False), metronome=2)
+    results = []
+    threads = [Thread(target=lambda: results.append(
+        cached_midi(src, numeric=False, cache=cache, metronome=2)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [data] * 8
+    ## Other options re-encode the cached evaluation.
+    assert cached_midi(src, numeric=False, cache=cache, transpose=2) != data
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.entries) == (9, 3, 3)
+    from pytest import raises
+    with raises(ValueError):
+        cached_midi(src, numeric=False, ignore_velocity=True, cache=cache)
+
+def test_block_cache_threads():
+    import sys
+    from threading import Thread
+    from parser import BlockCache
+    cache = BlockCache(4)
+    errors = []
+    def hammer(offset):
+        try:
+            for i in range(5000):
+                key = (i + offset) % 7
+                if cache.get(key) is None:
+                    cache.put(key, key)
+        except Exception as e: # pylint: disable=broad-except
+            errors.append(e)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [Thread(target=hammer, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(cache.entries) <= 4
+    assert all(cache.get(key) in (None, key) for key in range(7))
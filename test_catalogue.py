@@ -0,0 +1,74 @@
+"""
+To be run with pytest. Contains tests of the score catalogue.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_catalogue(tmp_path):
+    import os
+    from catalogue import Catalogue
+    library = tmp_path / 'library'
+    library.mkdir()
+    (library / 'a.tba').write_text('P=1 K=E@ B=8 c d e f g a b | '
+                                   'P=2 c - - - - - - | P=3 c |')
+    (library / 'b.tbn').write_text('K=d 1 2 3 | 4 5 6 |')
+    (library / 'bad.tba').write_text('P=1 c (d |')
+    catalogue = Catalogue(str(tmp_path / 'cat.db'))
+    stats = catalogue.update([str(library)], workers=2)
+    assert (stats.added, stats.failed) == (3, 1)
+    a, b = str(library / 'a.tba'), str(library / 'b.tbn')
+    assert catalogue.find(key='E@', meter='7/8') == [a]
+    assert catalogue.find(min_parts=3) == [a]
+    assert catalogue.find(key='d', meter=(3, 4)) == [b]
+    assert catalogue.find(key='D') == []
+    ## A part with no key signature is in C.
+    assert catalogue.find(key='C') == [a]
+    assert catalogue.query('SELECT part, key FROM keys WHERE path = ? '
+                           'ORDER BY part', (a,)) == [(1, 'E@'), (2, 'C'),
+                                                      (3, 'C')]
+    assert catalogue.query('SELECT parts, bars, notes FROM scores '
+                           'WHERE path = ?', (b,)) == [(1, 2, 6)]
+    assert catalogue.query('SELECT part, beat_map FROM parts '
+                           'WHERE path = ?', (a,)) == [(1, '7'), (2, '7'),
+                                                       (3, '1')]
+    ## Unchanged files aren't analysed again, even if touched.
+    os.utime(a, (0, 0))
+    stats = catalogue.update([str(library)], workers=1)
+    assert stats[1:] == (0, 1, 2, 0, 0)
+    (library / 'b.tbn').write_text('K=d 1 2 3 |')
+    (library / 'bad.tba').unlink()
+    stats = catalogue.update([str(library)], workers=1)
+    assert stats[1:] == (1, 0, 1, 1, 0)
+    assert catalogue.query('SELECT bars FROM scores WHERE path = ?',
+                           (b,)) == [(1,)]
+    assert catalogue.query('SELECT count(*) FROM parts') == [(4,)]
+    catalogue.close()
+
+def test_catalogue_bad_files(tmp_path, monkeypatch):
+    import catalogue as catalogue_module
+    from catalogue import Catalogue
+    (tmp_path / 'a.tba').write_text('c d e f |')
+    (tmp_path / 'latin1.tba').write_bytes(b'c d e | % caf\xe9')
+    (tmp_path / 'crash.tba').write_text('c d e |')
+    gone = str(tmp_path / 'gone.tba')
+    listed = catalogue_module.tbon_files
+    monkeypatch.setattr(catalogue_module, 'tbon_files',
+                        lambda paths: listed(paths) + [gone])
+    analyse = catalogue_module.analyse
+    def crashing(path, source):
+        if path.endswith('crash.tba'):
+            raise RuntimeError('worker crashed')
+        return analyse(path, source)
+    monkeypatch.setattr(catalogue_module, 'analyse', crashing)
+    catalogue = Catalogue(str(tmp_path / 'cat.db'))
+    stats = catalogue.update([str(tmp_path)], workers=1)
+    assert (stats.added, stats.failed) == (3, 3)
+    assert catalogue.find(low=60, high=65) == [str(tmp_path / 'a.tba')]
+    assert catalogue.find(high=64) == []
+    assert catalogue.find(key='C') == [str(tmp_path / 'a.tba')]
+    errors = dict(catalogue.query('SELECT path, error FROM scores'))
+    assert errors[str(tmp_path / 'crash.tba')] == 'worker crashed'
+    assert 'utf-8' in errors[str(tmp_path / 'latin1.tba')]
+    assert gone not in errors
+    catalogue.close()
+    assert catalogue_module.main(['--db', str(tmp_path / 'cat.db'), 'find',
+                                  '--low', '60', '--high', '65']) == 0
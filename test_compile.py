@@ -0,0 +1,33 @@
+"""
+To be run with pytest. Contains tests of compiling many sources with
+one evaluator.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_compile_many():
+    from parsimonious.exceptions import ParseError
+    from tbon import compile_many, evaluate, midi_bytes
+    sources = ['P=1 c d | P=2 e f |', 'c d | e', 'C=99 c |', 'T=90 (ceg) - |']
+    results = compile_many(sources, numeric=False, metronome=2)
+    assert results[0].error is None and results[3].error is None
+    assert isinstance(results[1].error, ParseError)
+    assert isinstance(results[2].error, ValueError)
+    for source, result in zip(sources[::3], results[::3]):
+        tbon = evaluate(source, numeric=False)
+        assert result.output == tbon.output
+        assert result.beat_map == tbon.beat_map
+        assert result.midi == midi_bytes(tbon, metronome=2)
+    assert results[1].output is None and results[1].midi is None
+    assert compile_many(sources[:1], numeric=False, midi=False)[0].midi is None
+    from tbon import compile_one
+    result = compile_one(sources[0], False, ignore_velocity=True)
+    assert isinstance(result.error, ValueError)
+    result = compile_one(sources[0], False, ignore_velocity=True, midi=False)
+    assert result.error is None and result.output[0][0] == (60, 0.0, 1.0)
+    ## An evaluation error in one source leaves the others compiled.
+    results = compile_many(['c d |', '(-) |', 'e f |'], numeric=False)
+    assert isinstance(results[1].error, ValueError)
+    assert results[1].midi is None
+    assert [r.error for r in results[::2]] == [None, None]
+    assert results[2].output[0][0][:3] == (64, 0.0, 1.0)
+    assert results[2].midi is not None
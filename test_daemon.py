@@ -0,0 +1,70 @@
+"""
+To be run with pytest. Contains tests of the compile daemon and its client.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_daemon(tmp_path, capsys, monkeypatch):
+    import os
+    import sys
+    import time
+    import subprocess
+    from tbonc import run_remote
+    path = str(tmp_path / 'tbon.sock')
+    (tmp_path / 'song.tba').write_text('c d e f | g - - - |')
+    (tmp_path / 'bad.tba').write_text('c d | e')
+    here = os.path.dirname(os.path.abspath(__file__))
+    monkeypatch.chdir(tmp_path)
+    assert run_remote(['-q', 'song.tba'], path) is None
+    ## The server redirects sys.stdout, so it has a process of its own.
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(here, 'daemon.py'),
+                               '--socket', path], cwd=here)
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        assert run_remote(['-q', 'song.tba'], path) == 0
+        assert 'Created song.mid' in capsys.readouterr().out
+        assert (tmp_path / 'song.mid').exists()
+        assert run_remote(['-c', 'bad.tba'], path) == 1
+        assert 'bad.tba: Rule' in capsys.readouterr().out
+        assert run_remote(['--no-such-option'], path) == 2
+        assert 'usage' in capsys.readouterr().err
+    finally:
+        server.terminate()
+        server.wait()
+    assert not os.path.exists(path)
+
+def test_socket_safety(tmp_path, monkeypatch):
+    import os
+    import stat
+    from pytest import raises
+    from daemon import make_server
+    from tbonc import run_remote, socket_path
+    ## Only sockets of ours are used or replaced.
+    imposter = tmp_path / 'not_a_socket'
+    imposter.write_text('precious')
+    assert run_remote(['-q', 'song.tba'], str(imposter)) is None
+    with raises(ValueError):
+        make_server(str(imposter))
+    assert imposter.read_text() == 'precious'
+    monkeypatch.delenv('TBON_SOCKET', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    assert socket_path() == str(tmp_path / 'tbon.sock')
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    import tempfile
+    monkeypatch.setattr(tempfile, 'tempdir', None)
+    path = socket_path(create=True)
+    folder = os.path.dirname(path)
+    assert stat.S_IMODE(os.stat(folder).st_mode) == 0o700
+    server = make_server(path)
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) & 0o077 == 0
+    finally:
+        server.server_close()
+        os.unlink(path)
+    os.chmod(folder, 0o755)
+    with raises(ValueError):
+        socket_path()
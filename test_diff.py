@@ -0,0 +1,27 @@
+"""
+To be run with pytest. Contains tests of event diffs and patches.
+"""
+from parser import MidiEvaluator
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_diff():
+    from diff import diff, since, apply_patch
+    old = MidiEvaluator()
+    old.eval('P=1 c d e f | (ceg) - - - | P=2 /c - /g - | /c - - - |',
+             verbosity=0)
+    new = MidiEvaluator()
+    new.eval('P=1 T=90 c d e e | (ceg) - - - | P=2 /c - /g - | /c - - - |'
+             ' P=3 a |', verbosity=0)
+    patch = diff(old, new)
+    assert patch.removed == [(1, (65, 3.0, 4.0, 0.8, 1))]
+    assert patch.inserted == [(1, (64, 3.0, 4.0, 0.8, 1)),
+                              (3, (57, 0.0, 1.0, 0.8, 1))]
+    assert patch.inserted_meta[0] == ('T', 0, 90)
+    assert diff(new, new) == ([], [], [], [])
+    parts = dict(zip(old.part_numbers, old.output))
+    patched = apply_patch(parts, patch)
+    assert [tuple(patched[n]) for n in (1, 2, 3)] == list(new.output)
+    ## Changes before the safe point are left alone.
+    assert since(patch, 2.0).inserted == patch.inserted[:1]
+    patched = apply_patch(parts, patch, time=2.0)
+    assert 3 not in patched and patched[1] == list(new.output[0])
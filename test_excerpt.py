@@ -0,0 +1,38 @@
+"""
+To be run with pytest. Contains tests of rendering bar ranges from a
+checkpoint index.
+"""
+from parser import MidiEvaluator
+from pytest import raises
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_render_bars():
+    from excerpt import build_index, render_bars
+    bars = ['c d e |', 'K=D (ce)- |', '- e f |', 'V=0.5 B=8 g a |',
+            'I=20 c - d |', 'e f |']
+    src = ('P=1 T=90 ' + ' '.join(bars[:3]) + ' P=2 ' + ' '.join(bars) +
+           ' P=1 ' + ' '.join(bars[3:]))
+    m = MidiEvaluator(block_cache=None)
+    m.eval(src)
+    index = build_index(src, tuple('cdefgab'), interval=2)
+    ## Bars 3 and 4 of part 1 run from beat 7 to beat 9.5.
+    assert index['parts']['1']['bars'][3][2:] == [7.0, 8.0]
+    assert index['parts']['1']['bars'][4][2:] == [8.0, 9.5]
+    ex = render_bars(src, index, 3, 4, tuple('cdefgab'))
+    assert ex.part_numbers == [1, 2]
+    for got, full in zip(ex.output, m.output):
+        want = tuple((p, max(0, s - 7), min(e - 7, 2.5), v, c)
+                     for p, s, e, v, c in full if e > 7 and s < 9.5)
+        assert got == want
+    assert ('K', 0, (2, 0), 0) in ex.meta_output
+    assert ('T', 0, 90) in ex.meta_output
+    assert ('I', 1.0, 20, 0, 1) in ex.meta_output
+    assert ex.beat_map == {1: (2, 3), 2: (2, 3)}
+    ex = render_bars(src, index, 4, 5, tuple('cdefgab'), parts=[2])
+    assert ex.part_numbers == [2]
+    assert ('T', 0, 90) in ex.meta_output
+    ## Includes and repeats are refused before any file is read.
+    for score in ('c | {frag.tba} d |', 'c |: d :| e |'):
+        with raises(ValueError) as info:
+            build_index(score, tuple('cdefgab'))
+        assert 'includes or repeats' in str(info.value)
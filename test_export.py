@@ -0,0 +1,34 @@
+"""
+To be run with pytest. Contains tests of the streaming event exporters.
+"""
+from parser import MidiEvaluator
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_export(tmp_path):
+    import csv
+    import json
+    from export import export
+    m = MidiEvaluator()
+    m.eval('P=1 T=90 c d | P=2 I=33 /c - |')
+    export(m, str(tmp_path / 'out.ndjson'), 'ndjson')
+    with open(str(tmp_path / 'out.ndjson')) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['event'] for r in records] == [
+        'tempo', 'meter', 'instrument', 'meter', 'note', 'note', 'note']
+    assert [r['start'] for r in records] == sorted(r['start'] for r in records)
+    assert records[-1] == dict(event='note', part=1, start=1.0, end=2.0,
+                               pitch=62, velocity=0.8, channel=1)
+    export(m, str(tmp_path / 'out.csv'), 'csv', metronome=True)
+    with open(str(tmp_path / 'out.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(records) + len(m.metronome_output)
+    assert rows[0]['bpm'] == '90' and rows[0]['pitch'] == ''
+    ## Only the metas of the evaluated parts, and notes without
+    ## velocity and channel, are exported.
+    from export import events
+    m = MidiEvaluator(parts=[2], ignore_velocity=True)
+    m.eval('P=1 T=90 c d | P=2 I=33 /c - |', verbosity=0)
+    assert [(r['event'], r.get('part')) for r in events(m)] == [
+        ('tempo', None), ('instrument', 2), ('meter', 2), ('note', 2)]
+    assert list(events(m))[-1] == dict(event='note', part=2, start=0.0,
+                                       end=2.0, pitch=48)
@@ -0,0 +1,126 @@
+"""
+To be run with pytest. Contains tests of midi output: transposition,
+tempo and velocity scaling and variant files.
+"""
+from pytest import approx, raises
+from tbon import (evaluate, midi_bytes, transform_notes, variant_name,
+                  make_variants)
+#pylint: disable=missing-docstring, invalid-name,
+
+def read_midi(data):
+    """
+    Return the events of each track of a midi file as (tick, kind,
+    values) tuples, where kind is 'note' with (pitch, velocity) for
+    note-ons, 'tempo' with microseconds per quarter note, or 'key' with
+    (sharps, minor). Other events are skipped.
+    """
+    assert data[:4] == b'MThd'
+    pos = 8 + int.from_bytes(data[4:8], 'big')
+    tracks = []
+    while pos < len(data):
+        assert data[pos:pos + 4] == b'MTrk'
+        end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], 'big')
+        pos += 8
+        tick, status, events = 0, None, []
+        def number():
+            nonlocal pos
+            value = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                value = (value << 7) | (byte & 0x7f)
+                if byte < 0x80:
+                    return value
+        while pos < end:
+            tick += number()
+            if data[pos] >= 0x80:
+                status = data[pos]
+                pos += 1
+            if status == 0xff:
+                kind = data[pos]
+                pos += 1
+                length = number()
+                body = data[pos:pos + length]
+                pos += length
+                if kind == 0x51:
+                    events.append((tick, 'tempo',
+                                   int.from_bytes(body, 'big')))
+                elif kind == 0x59:
+                    sharps = int.from_bytes(body[:1], 'big', signed=True)
+                    events.append((tick, 'key', (sharps, body[1])))
+            elif status in (0xf0, 0xf7):
+                pos += number()
+            elif status >> 4 in (0xc, 0xd):
+                pos += 1
+            else:
+                if status >> 4 == 0x9 and data[pos + 1]:
+                    events.append((tick, 'note',
+                                   (data[pos], data[pos + 1])))
+                pos += 2
+        tracks.append(events)
+    return tracks
+
+def kinds(tracks, kind):
+    return [(tick, values) for track in tracks
+            for tick, k, values in track if k == kind]
+
+def test_transform_notes():
+    notes = [(60, 0.0, 1.0, 0.8, 1), (None, 1.0, 2.0, 0.8, 1),
+             (67, 2.0, 3.0, 0.5, 2)]
+    assert transform_notes(notes, 2, 1.5) == [
+        (62, 0.0, 1.0, 1.0, 1), (None, 1.0, 2.0, approx(1.0), 1),
+        (69, 2.0, 3.0, 0.75, 2)]
+    assert transform_notes(notes, -60) == [
+        (0, 0.0, 1.0, 0.8, 1), (None, 1.0, 2.0, 0.8, 1),
+        (7, 2.0, 3.0, 0.5, 2)]
+    with raises(ValueError):
+        transform_notes(notes, 61)
+    with raises(ValueError):
+        transform_notes(notes, -61)
+
+def test_midi_transpose_and_scale():
+    tbon = evaluate('K=D T=90 d e | V=0.6 f - |', numeric=False)
+    plain = read_midi(midi_bytes(tbon))
+    notes = kinds(plain, 'note')
+    assert [n[1] for n in notes] == [(62, 101), (64, 101), (66, 76)]
+    assert kinds(plain, 'key') == [(0, (2, 0))]
+    assert kinds(plain, 'tempo') == [(0, int(60e6 / 90))]
+    ## Transposing moves pitches and the key signature.
+    up = read_midi(midi_bytes(tbon, transpose=2))
+    assert [n[1][0] for n in kinds(up, 'note')] == [64, 66, 68]
+    assert kinds(up, 'key') == [(0, (4, 0))]
+    down = read_midi(midi_bytes(tbon, transpose=-3))
+    assert [n[1][0] for n in kinds(down, 'note')] == [59, 61, 63]
+    assert kinds(down, 'key') == [(0, (5, 0))]
+    ## Scaling the tempo changes the tempo metas and so the time in
+    ## seconds of each note, not the notes' beats.
+    fast = read_midi(midi_bytes(tbon, tempo_scale=2.0))
+    assert kinds(fast, 'tempo') == [(0, int(60e6 / 180))]
+    assert [n[0] for n in kinds(fast, 'note')] == [n[0] for n in notes]
+    ## Scaled velocities are clamped to the midi maximum.
+    loud = read_midi(midi_bytes(tbon, velocity_scale=1.5))
+    assert [n[1][1] for n in kinds(loud, 'note')] == [127, 127, 114]
+    with raises(ValueError):
+        midi_bytes(tbon, transpose=70)
+
+def test_variants(tmp_path):
+    assert variant_name('song') == 'song.mid'
+    assert variant_name('song', -2, 0.8) == 'song_t-2_x0.8.mid'
+    assert variant_name('song', 3, 1.0, 1.25) == 'song_t+3_v1.25.mid'
+    tbon = evaluate('c d | e - |', numeric=False)
+    base = str(tmp_path / 'song')
+    written = make_variants(tbon, base, transpositions=(0, 5),
+                            tempo_scales=(1.0, 0.5))
+    assert written == [base + '.mid', base + '_x0.5.mid',
+                       base + '_t+5.mid', base + '_t+5_x0.5.mid']
+    for name, transpose, tempo_scale in zip(written, (0, 0, 5, 5),
+                                            (1.0, 0.5, 1.0, 0.5)):
+        with open(name, 'rb') as infile:
+            data = infile.read()
+        assert data == midi_bytes(tbon, transpose=transpose,
+                                  tempo_scale=tempo_scale)
+        tracks = read_midi(data)
+        assert [n[1][0] for n in kinds(tracks, 'note')] == \
+               [60 + transpose, 62 + transpose, 64 + transpose]
+        assert kinds(tracks, 'tempo') == [(0, int(60e6 / (120 *
+                                                          tempo_scale)))]
@@ -0,0 +1,41 @@
+"""
+To be run with pytest. Contains tests of motif search.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_find_motif(tmp_path, capsys):
+    from pytest import raises
+    from catalogue import Catalogue, main
+    from motifs import melody, tokens
+    assert melody([(60, 0, 1), (64, 0, 1), (None, 1, 2), (62, 2, 3)]) == \
+           [(64, 0), (62, 2)]
+    assert tokens([(60, 0), (62, 1), (59, 1.5), (60, 3)]) == \
+           ['2', '-3@1/2', '1@3']
+    (tmp_path / 'a.tba').write_text('T=90 c d e c | c d e c | e f g - |'
+                                    ' P=2 c - g - | e - (gc) - |')
+    (tmp_path / 'b.tba').write_text('K=D T=200 B=8 _ - dd e d | g f - - |')
+    (tmp_path / 'c.tbn').write_text('K=F 5 6 7 5 | 5 6 7 5 |')
+    catalogue = Catalogue(str(tmp_path / 'cat.db'))
+    catalogue.update([str(tmp_path)], workers=1)
+    a, b, c = (str(tmp_path / name) for name in ('a.tba', 'b.tba', 'c.tbn'))
+    found = catalogue.find_motif('c d e c')
+    assert [(m.path, m.part, m.bar, m.beat) for m in found] == \
+           [(a, 1, 0, 0), (a, 1, 1, 0), (c, 1, 0, 0), (c, 1, 1, 0)]
+    ## Any key, any tempo and beat note.
+    found = catalogue.find_motif('gg a g c | b', numeric=False)
+    assert [(m.path, m.bar, m.beat, m.time) for m in found] == \
+           [(b, 0, 2, 1)]
+    found = catalogue.find_motif('5 5 6 5 1 | 7', numeric=True)
+    assert found == []
+    ## A long motif is matched from several n-grams.
+    found = catalogue.find_motif('c d e c c d e c e f g')
+    assert [(m.path, m.time) for m in found] == [(a, 0)]
+    found = catalogue.find_motif('B=2 c g | e (gc) |')
+    assert [(m.path, m.part, m.time) for m in found] == [(a, 2, 0)]
+    with raises(ValueError):
+        catalogue.find_motif('c')
+    catalogue.close()
+    capsys.readouterr()
+    assert main(['--db', str(tmp_path / 'cat.db'), 'motif',
+                 'gg a g c | b']) == 0
+    assert capsys.readouterr().out == b + ' part 1 bar 0 beat 2\n'
@@ -1,12 +1,31 @@
 """
 To be run with pytest
 """
-from parser import (MidiEvaluator, MidiPreEvaluator, time_signature)
-from pytest import approx
+from parser import (MidiEvaluator, MidiPreEvaluator, time_signature,
+                    parse, lower, lower_bars, as_ast, BlockCache)
+from parsimonious.exceptions import ParseError
+from pytest import approx, raises, mark
+import os
+import sys
+import time
 import keysigs
 #pylint: disable=missing-docstring, invalid-name, singleton-comparison
 
 
+def test_lower():
+    ast = lower(parse('/* c */ K=D ^#d - (c%e) |'))
+    assert ast.expr_name == 'score'
+    bar, = ast.children
+    assert [n.expr_name for n in bar] == ['key', 'beat', 'beat',
+                                          'beat', 'barline']
+    assert bar.children[0].value == 'D'
+    pitch = bar.children[1].children[0].children[0]
+    assert (pitch.expr_name, pitch.value) == ('pitch', (1, 1, 'd'))
+    chord = bar.children[3].children[0]
+    assert [n.expr_name for n in chord] == ['chordstart', 'chordpitch',
+                                            'chordpitch', 'rparen']
+    assert chord.children[2].value == (0, None, 'e')
+
 def test_pre_evaluation():
     mp = MidiPreEvaluator()
     mp.eval('#d - - - |')
@@ -79,6 +98,17 @@ def test_polymeters():
                               ('M', 0.0, 6, 8, 1)]
 
 
+def test_pre_evaluation_validation():
+    mp = MidiPreEvaluator(pitch_order=tuple('1234567'))
+    with raises(ValueError):
+        mp.eval('1 2 c |')
+    mp = MidiPreEvaluator()
+    with raises(ValueError):
+        mp.eval('V=1.5 c d |')
+    mp = MidiPreEvaluator()
+    mp.eval('c d | e f g |')
+    assert mp.bar_starts == {1: [0.0, 2.0]}
+
 def test_beat_map():
     mp = MidiPreEvaluator()
     mp.eval('a b cd | e f - a |')
@@ -288,6 +318,21 @@ def test_midisigs():
     assert keysigs.MIDISIGS['A'] == (3, 0)
     assert keysigs.MIDISIGS['A@'] == (-4, 0)
 
+def test_transpose_midisig():
+    assert keysigs.transpose_midisig((0, 0), 0) == (0, 0)
+    assert keysigs.transpose_midisig((0, 0), 2) == (2, 0) # C -> D
+    assert keysigs.transpose_midisig((-1, 0), -5) == (0, 0) # F -> C
+    assert keysigs.transpose_midisig((3, 1), 12) == (3, 1)
+    assert keysigs.transpose_midisig((0, 1), 1) == (-5, 1) # a -> b@
+    ## Octaves keep the spelling and C# and C@ can be reached.
+    assert keysigs.transpose_midisig((6, 0), 12) == (6, 0) # F# -> F#
+    assert keysigs.transpose_midisig((-6, 0), -24) == (-6, 0) # G@ -> G@
+    assert keysigs.transpose_midisig((5, 0), 2) == (7, 0) # B -> C#
+    assert keysigs.transpose_midisig((-5, 0), -2) == (-7, 0) # D@ -> C@
+    assert keysigs.transpose_midisig((7, 0), 12) == (7, 0) # C# -> C#
+    ## Given near, the spelling nearest it wins.
+    assert keysigs.transpose_midisig((6, 0), -12, -6) == (-6, 0) # G@
+
 def test_get_key_alteration():
     assert keysigs.get_alteration('c', 'C') == 0
     assert keysigs.get_alteration('c', 'D') == 1
@@ -406,3 +451,277 @@ def metroevaluate(source, expected,
     print(m.metronome_output)
     for i, t in enumerate(m.metronome_output):
         assert t == approx(expected[i])
+
+def test_include(tmp_path):
+    refrain = 'c d (ce)- | - e (:fa) - |'
+    (tmp_path / 'refrain.tba').write_text(refrain)
+    (tmp_path / 'outer.tba').write_text('K=D d | {refrain.tba} g - |')
+    src = 'a - | {refrain.tba} /a - | {refrain.tba} {outer.tba} g |'
+    expected = ('a - | ' + refrain + ' /a - | ' + refrain +
+                ' K=D d | ' + refrain + ' g - | g |')
+    cache = BlockCache(16)
+    m = MidiEvaluator(block_cache=cache)
+    m.eval(src, include_dir=str(tmp_path))
+    ## The second refrain has the same entry state as the first, so it
+    ## comes from the cache. The one in outer.tba is in another key.
+    assert sum(key[0] == 'include' for key in cache.entries) == 3
+    m2 = MidiEvaluator(block_cache=None)
+    m2.eval(expected)
+    assert len(m.output[0]) == len(m2.output[0])
+    for got, want in zip(m.output[0], m2.output[0]):
+        assert got == approx(want)
+    for got, want in zip(m.metronome_output, m2.metronome_output):
+        assert got == approx(want)
+    assert m.beat_map == m2.beat_map
+
+def test_include_confined(tmp_path):
+    inside = tmp_path / 'scores'
+    (inside / 'sub').mkdir(parents=True)
+    (inside / 'sub' / 'a.tba').write_text('c d | {../b.tba}')
+    (inside / 'b.tba').write_text('e f |')
+    (inside / 'notes.tba').write_text('secret: not tbon')
+    (tmp_path / 'outside.tba').write_text('g a |')
+    m = MidiEvaluator()
+    m.eval('c | {sub/a.tba}', include_dir=str(inside))
+    assert len(m.output[0]) == 5
+    for name in (str(tmp_path / 'outside.tba'), '../outside.tba',
+                 'sub/../../outside.tba'):
+        with raises(ValueError) as info:
+            MidiEvaluator().eval('c | {%s}' % name, include_dir=str(inside))
+        assert 'Invalid include' in str(info.value)
+    ## Errors name the include but don't quote what's in it.
+    with raises(ValueError) as info:
+        MidiEvaluator().eval('c | {notes.tba}', include_dir=str(inside))
+    assert "'notes.tba'. Line 1" in str(info.value)
+    assert 'secret' not in str(info.value)
+
+def test_include_disabled(tmp_path, monkeypatch):
+    from cache import cached_midi
+    from tbon import compile_one
+    (tmp_path / 'frag.tba').write_text('e f |')
+    monkeypatch.chdir(tmp_path)
+    ## Without an include directory, nothing is read, not even from the
+    ## current directory.
+    with raises(ValueError) as info:
+        MidiEvaluator().eval('{frag.tba} c |')
+    assert 'not enabled' in str(info.value)
+    with raises(ValueError):
+        cached_midi('{frag.tba} c |', numeric=False)
+    assert isinstance(compile_one('{frag.tba} c |', False).error,
+                      ValueError)
+    ## '' is the current directory.
+    m = MidiEvaluator()
+    m.eval('{frag.tba} c |', include_dir='')
+    assert len(m.output[0]) == 3
+
+def test_repeats():
+    src = 'P=1 a b |: c d | e f :|x3 |: g - | (ac) - :| P=2 c - | d - :|'
+    expected = ('P=1 a b | c d | e f | c d | e f | c d | e f | g - | (ac) - |'
+                ' g - | (ac) - | P=2 c - | d - | c - | d - |')
+    m = MidiEvaluator()
+    m.eval(src)
+    m2 = MidiEvaluator(block_cache=None)
+    m2.eval(expected)
+    assert m.output == m2.output
+    assert m.metronome_output == m2.metronome_output
+    assert m.beat_map == m2.beat_map
+    with raises(ValueError):
+        MidiEvaluator().eval('a |: b | P=2 c :|')
+    with raises(ValueError):
+        MidiEvaluator().eval('a |: b |')
+
+def test_bar_memo():
+    ostinato = 'c #d e - | (ce) - /g - | '
+    src = ('P=1 ' + ostinato * 6 + 'K=D d - - - | ' + ostinato * 3 +
+           'e - - (ac) | - - - a | ' + ostinato * 2 +
+           'P=2 C=10 /* drums */ ' + 'c c c  c |\n' * 8)
+    fast = lower_bars(src)
+    assert fast is not None
+    full = lower(parse(src))
+    assert [(c.expr_name, c.value) for c in fast.children] == \
+           [(c.expr_name, c.value) for c in full.children]
+    assert [(c.start, c.end) for c in fast.children] == \
+           [(c.start, c.end) for c in full.children]
+    cache = BlockCache(64)
+    m = MidiEvaluator(block_cache=cache)
+    m.eval(src, verbosity=0)
+    assert any(key[0] == 'bar' for key in cache.entries)
+    m2 = MidiEvaluator(block_cache=None)
+    m2.eval(full, verbosity=0)
+    assert m.output == m2.output
+    assert m.metronome_output == m2.metronome_output
+    assert m.beat_map == m2.beat_map
+    ## Anything the bar splitter doesn't understand is parsed with the
+    ## whole grammar, which reports errors in place.
+    for src in ('P=1 P=2 c |', 'c d | e', 'c |d |', 'c | P=2d |'):
+        try:
+            expected = lower(parse(src))
+        except ParseError as e:
+            with raises(ParseError) as info:
+                lower_bars(src)
+            assert str(info.value) == str(e)
+        else:
+            fast = lower_bars(src)
+            assert [(c.expr_name, c.value, c.start, c.end)
+                    for c in fast.children] == \
+                   [(c.expr_name, c.value, c.start, c.end)
+                    for c in expected.children]
+
+## Inputs an editor sees mid-typing. Each makes a score of about n
+## characters.
+ADVERSARIAL = {
+    'whitespace': lambda n: 'c ' + ' ' * n + '|',
+    'newlines': lambda n: 'c |' + '\n' * n + 'd |',
+    'unterminated_comment': lambda n: 'c d | /* ' + 'x ' * (n // 2),
+    'comment_opens': lambda n: 'c d | ' + '/* ' * (n // 3),
+    'comment_stars': lambda n: 'c | /*' + '*' * n,
+    'comments': lambda n: 'c | ' + '/* */ ' * (n // 6) + 'd |',
+    'open_parens': lambda n: 'c ' + '(' * n + ' |',
+    'unclosed_chord': lambda n: '(' + 'c' * n + ' |',
+    'open_rolls': lambda n: '(:' * (n // 2),
+    'no_barline': lambda n: 'c ' * (n // 2),
+    'part_switches': lambda n: 'P=1 ' * (n // 4),
+    'error_at_end': lambda n: 'c d e f | ' * (n // 10) + 'x',
+    'error_at_start': lambda n: 'x ' + 'c d e f | ' * (n // 10),
+}
+
+def shape(node):
+    return (node.expr_name, node.value, node.start, node.end,
+            tuple(shape(child) for child in node.children)
+            if node.expr_name != 'bar' else ())
+
+def test_adversarial_input():
+    for name, make in ADVERSARIAL.items():
+        src = make(200)
+        try:
+            expected = lower(parse(src))
+        except ParseError as e:
+            with raises(ParseError) as info:
+                as_ast(src)
+            assert str(info.value) == str(e), name
+        else:
+            assert shape(as_ast(src)) == shape(expected), name
+
+def test_linear_parse_work():
+    from parser import BAR_CACHE, grammar
+    grammar()
+    grammar('bar')
+    def calls(src):
+        """ Python and builtin calls made lowering src, a measure of work """
+        BAR_CACHE.clear()
+        count = [0]
+        def profile(frame, event, arg):
+            if event in ('call', 'c_call'):
+                count[0] += 1
+        sys.setprofile(profile)
+        try:
+            as_ast(src)
+        except ParseError:
+            pass
+        finally:
+            sys.setprofile(None)
+        return count[0]
+    for name, make in ADVERSARIAL.items():
+        small, large = calls(make(2000)), calls(make(16000))
+        ## 8 times the input; quadratic work would be 64 times more.
+        assert large <= 10 * small, name
+
+@mark.skipif(not os.environ.get('TBON_TIMING_TESTS'),
+             reason="wall-clock test; set TBON_TIMING_TESTS=1 to run")
+def test_linear_parse_time():
+    def seconds(src):
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            try:
+                as_ast(src)
+            except ParseError:
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    for name, make in ADVERSARIAL.items():
+        small, large = seconds(make(2000)), seconds(make(16000))
+        ## 8 times the input; quadratic time would take 64 times longer.
+        assert large < 20 * max(small, 1e-3), name
+
+def test_reuse_evaluator():
+    m = MidiEvaluator()
+    m.eval('P=1 T=90 c d e | P=2 /g - - |')
+    first = (m.output, m.metronome_output, m.meta_output, m.beat_map)
+    m.eval('K=D d - | e |')
+    m2 = MidiEvaluator()
+    m2.eval('K=D d - | e |')
+    assert (m.output, m.meta_output, m.beat_map) == \
+           (m2.output, m2.meta_output, m2.beat_map)
+    m.eval('P=1 T=90 c d e | P=2 /g - - |')
+    assert (m.output, m.metronome_output, m.meta_output, m.beat_map) == first
+
+def test_budget():
+    import pickle
+    from parser import Budget, BudgetExceeded
+    def over(source, **limits):
+        budget = Budget(**dict(dict.fromkeys(Budget._fields), **limits))
+        with raises(BudgetExceeded) as info:
+            MidiEvaluator(budget=budget).eval(source, verbosity=0)
+        return info.value.budget
+    assert over('c d e f |' * 10, source_size=50) == 'source_size'
+    assert over('|: c d e f :|x1000', nodes=5000) == 'nodes'
+    assert over('c' * 65 + ' |', subbeats_per_beat=64) == 'subbeats_per_beat'
+    assert over('|: (cegc) - :|x100', notes_per_part=300) == 'notes_per_part'
+    assert over('P=1 c d e f | P=2 c d e f |' * 10,
+                events=50) == 'events'
+    assert over('|: c d e f :|x100000', seconds=0.01) == 'seconds'
+    ## Within budget, nothing changes.
+    budget = Budget(1000, 1000, 4, 100, 100, 10)
+    m = MidiEvaluator(budget=budget)
+    m.eval('c d e f | (ceg) - cc - |', verbosity=0)
+    m2 = MidiEvaluator()
+    m2.eval('c d e f | (ceg) - cc - |', verbosity=0)
+    assert m.output == m2.output
+    assert Budget(1000, 1000, 4, 100, 100, 10).includes is None
+    e = pickle.loads(pickle.dumps(BudgetExceeded('nodes', 10)))
+    assert (e.budget, e.limit, isinstance(e, ValueError)) == \
+           ('nodes', 10, True)
+
+def test_budget_includes(tmp_path):
+    from parser import Budget, BudgetExceeded, SERVICE_BUDGET
+    (tmp_path / 'a.tba').write_text('c d e f | {b.tba}')
+    (tmp_path / 'b.tba').write_text('g a b c |')
+    src = 'c | {a.tba} {a.tba}'
+    def run(budget):
+        m = MidiEvaluator(budget=budget)
+        m.eval(src, verbosity=0, include_dir=str(tmp_path))
+        return m
+    ## Fragment text counts each time it's read, nested or not.
+    assert len(run(Budget(*[None] * 6, includes=52)).output[0]) == 17
+    with raises(BudgetExceeded) as info:
+        run(Budget(*[None] * 6, includes=51))
+    assert info.value.budget == 'includes'
+    assert SERVICE_BUDGET.includes == 0
+    with raises(BudgetExceeded) as info:
+        run(SERVICE_BUDGET)
+    assert info.value.budget == 'includes'
+
+def test_source_map():
+    from sourcemap import IntervalIndex, SourceMap
+    index = IntervalIndex([(0, 4, 'a'), (1, 2, 'b'), (2, 3, 'c'), (5, 6, 'd')])
+    assert index.at(1.5) == ['a', 'b']
+    assert index.at(2) == ['a', 'c']
+    assert index.at(4.5) == []
+    assert index.at(-1) == []
+    assert index.overlapping(3, 5) == ['a']
+    assert index.overlapping(2, 5.5) == ['a', 'c', 'd']
+    assert index.overlapping(6, 9) == []
+    src = 'P=1 c (eg)- | z d | P=2 /c - d |'
+    m = MidiEvaluator(source_map=True)
+    m.eval(src)
+    assert m.output[0][:2] == ((60, 0.0, 1.0, 0.8, 1, (4, 5)),
+                               (64, 1.0, 2.0, 0.8, 1, (7, 8)))
+    low_c = (src.index('/c'), src.index('/c') + 2)
+    assert m.output[1][0] == (48, 0.0, 2.0, 0.8, 1, low_c)
+    source_map = SourceMap(m)
+    assert sorted(source_map.spans_at_time(1.5)) == [(7, 8), (8, 9), low_c]
+    assert source_map.notes_at_offset(low_c[0] + 1) == [
+        (2, (48, 0.0, 2.0, 0.8, 1, low_c))]
+    assert source_map.notes_at_offset(src.index('|')) == []
@@ -0,0 +1,36 @@
+"""
+To be run with pytest. Contains tests of the piano roll renderer.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_piano_roll():
+    import struct
+    import zlib
+    from pytest import raises
+    from tbon import evaluate
+    from pianoroll import PianoRoll, COLOURS, LEFT
+    tbon = evaluate('P=1 c d e | f g | a b ^c d |'
+                    ' P=2 /c - - | /g - | c - - - |', numeric=False)
+    roll = PianoRoll(tbon)
+    assert roll.bar_starts == {1: [0, 3, 5, 9], 2: [0, 3, 5, 9]}
+    assert roll.bar_times(1, 1) == (3, 5)
+    with raises(ValueError):
+        roll.bar_times(2, 3)
+    ## Only the notes of bar 1 are drawn.
+    drawing = roll.draw(1, 1, width=230, height=124)
+    notes = [r for r in drawing.rects if r[4] in COLOURS]
+    assert len(notes) == 3
+    assert sorted(r[0] for r in notes) == [LEFT, LEFT, LEFT + 100]
+    assert [label for x, y, label in drawing.labels] == ['1:2']
+    svg = roll.svg(1, 1, low=64, high=80)
+    assert svg.count('fill="{}"'.format(COLOURS[0])) == 2
+    assert svg.count('fill="{}"'.format(COLOURS[1])) == 0
+    ## Many notes in few pixels are drawn as runs of pixels.
+    long = evaluate('P=1 ' + 'c d e f g f e d | ' * 500, numeric=False)
+    drawing = PianoRoll(long).draw(width=130, height=100)
+    assert len([r for r in drawing.rects if r[4] in COLOURS]) <= 5
+    png = PianoRoll(long).png(width=130, height=100)
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', png[16:24])
+    assert (width, height) == (130, 100)
+    assert len(zlib.decompress(png[41:-12])) == height * (3 * width + 1)
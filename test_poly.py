@@ -22,6 +22,25 @@ def test_partswitch():
     evaluate('P=1 c | P=2 //ce |',
              [((60, 0, 1.0),), ((36, 0, 0.5), (40, 0.5, 1.0))],)
 
+def test_part_filter():
+    src = 'P=1 c | P=2 //ce | P=3 K=D c | P=1 d |'
+    m = MidiEvaluator(ignore_velocity=True, parts=[2, 3])
+    m.eval(src)
+    assert m.part_numbers == [2, 3]
+    assert m.output == [((36, 0, 0.5), (40, 0.5, 1.0)), ((61, 0, 1.0),)]
+    assert ('K', 0, (2, 0), 2) in m.meta_output
+    assert len(m.metronome_output) == 2
+
+def test_part_filter_missing(tmp_path, capsys):
+    from tbon import main
+    score = tmp_path / 'score.tba'
+    score.write_text('P=1 c | P=2 d |')
+    assert main(['-q', '-p', '2', '-p', '3', '-p', '5', str(score)]) == 1
+    assert 'No part 3, 5 in the score.' in capsys.readouterr().out
+    assert not list(tmp_path.glob('*.mid'))
+    assert main(['-q', '-p', '2', str(score)]) == 0
+    assert (tmp_path / 'score_p2.mid').exists()
+
 def pre_evaluate(source, expected, target='subbeat_lengths'):
     m = MidiPreEvaluator()
     m.eval(source)
@@ -47,3 +66,23 @@ def evaluate(source, expected,
     for i, part in enumerate(m.output):
         for j, note in enumerate(part):
             assert note == approx(expected[i][j])
+
+def test_resolve_overlaps():
+    from tbon import resolve_overlaps
+    parts = [[(60, 0.0, 2.0, 0.8, 1), (64, 0.0, 1.0, 0.8, 1),
+              (60, 1.0, 3.0, 0.8, 1)],
+             [(60, 1.0, 2.0, 0.5, 1), (64, 0.0, 1.0, 0.8, 1),
+              (None, 1.0, 2.0, 0.8, 1), (60, 1.0, 2.0, 0.8, 2)]]
+    assert resolve_overlaps(parts) == [
+        [(60, 0.0, 1.0, 0.8, 1), (64, 0.0, 1.0, 0.8, 1),
+         (60, 1.0, 3.0, 0.8, 1)],
+        [(None, 1.0, 2.0, 0.8, 1), (60, 1.0, 2.0, 0.8, 2)]]
+    ## Extra columns are kept.
+    assert resolve_overlaps([[(60, 0, 2, 0.8, 1, 'a'),
+                              (60, 1, 2, 0.8, 1, 'b')]]) == \
+           [[(60, 0, 1, 0.8, 1, 'a'), (60, 1, 2, 0.8, 1, 'b')]]
+
+def test_return_to_part_beat_map():
+    m = MidiEvaluator()
+    m.eval('P=1 c d | P=2 d | P=1 e f g |')
+    assert m.beat_map == {1: (2, 3), 2: (1,)}
@@ -0,0 +1,33 @@
+"""
+To be run with pytest. Contains tests of compiling numeric scores in any key.
+"""
+#pylint: disable=missing-docstring, invalid-name,
+
+def test_key_relative():
+    from pytest import raises
+    from tbon import evaluate
+    from rekey import key_relative
+    src = ('K={0} 1 2 3 4 | 5 - @7 #4 | (135) - ^1 /5 | K={1} 1 3 5 7 |'
+           ' P=2 K={0} /1 - /5 - | 3 4 5 6 |')
+    relative = key_relative(src.format('D', 'A'))
+    keys = relative.twelve_keys()
+    assert len(keys) == 12
+    for keyname, mapped in (('D', 'A'), ('G', 'D'), ('B@', 'F'),
+                            ('F#', 'C#')):
+        expected = evaluate(src.format(keyname, mapped), numeric=True)
+        assert keys[keyname].output == expected.output
+        assert sorted(keys[keyname].meta_output, key=str) == \
+               sorted(expected.meta_output, key=str)
+    ## Enharmonic homes respell the other keys to match.
+    src = 'K={} 1 2 3 | K={} 1 2 3 | K={} 1 - - |'
+    relative = key_relative(src.format('F#', 'C#', 'B'))
+    for keyname, others in (('F#', ('C#', 'B')), ('G@', ('D@', 'C@')),
+                            ('G', ('D', 'C'))):
+        got = relative.instantiate(keyname)
+        expected = evaluate(src.format(keyname, *others), numeric=True)
+        assert got.output == expected.output
+        assert got.meta_output == expected.meta_output
+    with raises(ValueError):
+        relative.instantiate('b')
+    with raises(ValueError):
+        relative.instantiate('H')
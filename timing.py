@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Converts quarter-note beat times to seconds.
+Author: Mike Ellis
+Copyright 2017 Ellis & Grant, Inc
+"""
+from bisect import bisect_right
+
+## Tempo assumed by MIDI players until the first tempo event.
+DEFAULT_TEMPO = 120
+
+class TempoMap():
+    """
+    Maps times in quarter-note beats, as used in MidiEvaluator output,
+    to seconds from the start of the music. Built from the ('T', start,
+    bpm) events in meta_output. When several tempi start at the same
+    beat, the last one wins, as it does in a midi file.
+    """
+    def __init__(self, meta, tempo_scale=1.0):
+        tempi = {}
+        for m in meta:
+            if m[0] == 'T':
+                tempi[m[1]] = m[2] * tempo_scale
+        if 0 not in tempi:
+            tempi[0] = DEFAULT_TEMPO * tempo_scale
+        ## Parallel lists: the beat at which each tempo starts, the time
+        ## in seconds of that beat and the seconds per beat from there on.
+        self.beats = sorted(tempi)
+        self.spb = [60.0 / tempi[b] for b in self.beats]
+        self.offsets = [0.0]
+        for i in range(1, len(self.beats)):
+            length = self.beats[i] - self.beats[i - 1]
+            self.offsets.append(self.offsets[-1] + length * self.spb[i - 1])
+
+    def seconds(self, beat):
+        """ Return the time in seconds of beat """
+        i = max(0, bisect_right(self.beats, beat) - 1)
+        return self.offsets[i] + (beat - self.beats[i]) * self.spb[i]
+
+    def seconds_array(self, beats):
+        """
+        Return the times in seconds of a NumPy array of beats, as
+        seconds() gives them one at a time. Requires NumPy.
+        """
+        import numpy as np
+        i = np.maximum(np.searchsorted(self.beats, beats, side='right') - 1,
+                       0)
+        return (np.take(self.offsets, i) +
+                (beats - np.take(self.beats, i)) * np.take(self.spb, i))